@@ -14,6 +14,7 @@ from anki.db import *
 from anki.models import CardModel, Model, FieldModel
 from anki.facts import Fact, factsTable, Field
 from anki.utils import parseTags, findTag, stripHTML, genID
+from anki.tags import TagIndexExtension
 
 # Cards
 ##########################################################################
@@ -134,13 +135,13 @@ class Card(object):
                             self.fact.model.tags)
         return findTag(tag, alltags)
 
-mapper(Card, cardsTable, properties={
+mapper(Card, cardsTable, extension=TagIndexExtension("cards"), properties={
     'cardModel': relation(CardModel),
     'fact': relation(Fact, backref="cards", primaryjoin=
                      cardsTable.c.factId == factsTable.c.id),
     })
 
-mapper(Fact, factsTable, properties={
+mapper(Fact, factsTable, extension=TagIndexExtension("facts"), properties={
     'model': relation(Model),
     'fields': relation(Field, backref="fact", order_by=Field.c.ordinal),
     'lastCard': relation(Card, post_update=True, primaryjoin=
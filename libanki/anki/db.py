@@ -13,6 +13,9 @@ some convenience routines, and manages transactions itself.
 object_session() is a replacement for the standard object_session(), which
 provides the features of SessionHelper, and avoids taking out another
 transaction.
+
+SQL passed to the SessionHelper routines is compiled once and kept in
+statementCache, a bounded LRU cache shared by all sessions.
 """
 __docformat__ = 'restructuredtext'
 
@@ -20,8 +23,8 @@ from sqlalchemy import (Table, Integer, Float, Column, MetaData,
                         ForeignKey, Boolean, String, Date, UniqueConstraint)
 from sqlalchemy import create_engine
 from sqlalchemy.orm import mapper, sessionmaker, relation, backref, \
-     object_session as _object_session
-from sqlalchemy.sql import select, text, and_
+     object_session as _object_session, MapperExtension, EXT_CONTINUE
+from sqlalchemy.sql import select, text, and_, bindparam
 from sqlalchemy.exceptions import DBAPIError, OperationalError
 
 # sqlalchemy didn't handle the move to unicodetext nicely
@@ -33,6 +36,57 @@ except ImportError:
 
 metadata = MetaData()
 
+class StatementCache(object):
+    "A bounded LRU cache of compiled SQL text, keyed by SQL and dialect."
+
+    def __init__(self, size=500, maxLength=4000):
+        self.size = size
+        # very long statements are usually built with a list of ids, and
+        # are unlikely to be seen again
+        self.maxLength = maxLength
+        self.cache = {}
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, sql, dialect):
+        "Return SQL compiled for DIALECT."
+        key = (sql, dialect.__class__, dialect.paramstyle)
+        self.tick += 1
+        entry = self.cache.get(key)
+        if entry:
+            self.hits += 1
+            entry[1] = self.tick
+            return entry[0]
+        self.misses += 1
+        compiled = text(sql).compile(dialect=dialect)
+        if len(sql) <= self.maxLength:
+            if len(self.cache) >= self.size:
+                self.evict()
+            self.cache[key] = [compiled, self.tick]
+        return compiled
+
+    def evict(self):
+        "Drop the least recently used quarter of the cache."
+        entries = sorted(self.cache.items(), key=lambda x: x[1][1])
+        for (key, entry) in entries[:max(1, len(entries) / 4)]:
+            self.cache.pop(key, None)
+
+    def clear(self):
+        self.cache = {}
+
+    def stats(self):
+        "Return a dict of hits, misses, hit rate and size."
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': total and self.hits / float(total) or 0.0,
+            'size': len(self.cache),
+            }
+
+statementCache = StatementCache()
+
 class SessionHelper(object):
     "Add some convenience routines to a session."
 
@@ -48,27 +102,44 @@ class SessionHelper(object):
     def __getattr__(self, k):
         return getattr(self.__dict__['session'], k)
 
+    def compile(self, sql):
+        "Return SQL compiled for our engine, using the shared cache."
+        bind = self.session.bind
+        if bind is None:
+            return text(sql)
+        return statementCache.compile(sql, bind.dialect)
+
     def scalar(self, sql, **args):
-        return self.execute(text(sql), args).scalar()
+        return self.execute(self.compile(sql), args).scalar()
 
     def all(self, sql, **args):
-        return self.execute(text(sql), args).fetchall()
+        return self.execute(self.compile(sql), args).fetchall()
 
     def first(self, sql, **args):
-        return self.execute(text(sql), args).fetchone()
+        return self.execute(self.compile(sql), args).fetchone()
 
     def column0(self, sql, **args):
-        return [x[0] for x in self.execute(text(sql), args).fetchall()]
+        return [x[0] for x in self.execute(self.compile(sql), args).fetchall()]
+
+    def iterate(self, sql, chunk=1000, **args):
+        "Yield the rows of SQL, fetching CHUNK at a time."
+        res = self.execute(self.compile(sql), args)
+        while True:
+            rows = res.fetchmany(chunk)
+            if not rows:
+                break
+            for row in rows:
+                yield row
 
     def statement(self, sql, **kwargs):
         "Execute a statement without returning any results. Flush first."
         self.flush()
-        self.execute(text(sql), kwargs)
+        self.execute(self.compile(sql), kwargs)
 
     def statements(self, sql, data):
         "Execute a statement across data. Flush first."
         self.flush()
-        self.execute(text(sql), data)
+        self.execute(self.compile(sql), data)
 
     def __repr__(self):
         return repr(self.session)
@@ -25,21 +25,31 @@ from anki.db import *
 from anki.lang import _
 from anki.errors import DeckAccessError, DeckWrongFormatError
 from anki.stdmodels import BasicModel
-from anki.utils import parseTags
+from anki.utils import parseTags, ids2str
 from anki.history import CardHistoryEntry
 from anki.models import Model
 
 # ensure all the metadata in other files is loaded before proceeding
-import anki.models, anki.facts, anki.cards, anki.stats, anki.history
+import anki.models, anki.facts, anki.cards, anki.stats, anki.history, anki.tags
+import anki.media
 
 PRIORITY_HIGH = 4
 PRIORITY_MED = 3
 PRIORITY_NORM = 2
 PRIORITY_LOW = 1
 PRIORITY_NONE = 0
+# the order in which tags override each other
+PRIORITY_ORDER = (PRIORITY_NONE, PRIORITY_HIGH, PRIORITY_MED,
+                  PRIORITY_LOW, PRIORITY_NORM)
 
 MATURE_THRESHOLD = 21
 
+# sorts after any time or card id
+INF = float("inf")
+
+# decks from version 1 keep the tag index in anki.tags up to date
+DECK_VERSION = 1
+
 NewCardOrder = {
     0: _("Show new cards in random order"),
     1: _("Show new cards in order they were added"),
@@ -52,7 +62,7 @@ decksTable = Table(
     Column('created', Float, nullable=False, default=time.time),
     Column('modified', Float, nullable=False, default=time.time),
     Column('description', UnicodeText, nullable=False, default=u""),
-    Column('version', Integer, nullable=False, default=0),
+    Column('version', Integer, nullable=False, default=DECK_VERSION),
     Column('currentModelId', Integer, ForeignKey("models.id")),
     # syncing
     Column('syncName', UnicodeText),
@@ -84,6 +94,23 @@ decksTable = Table(
     # limit the number of failed cards in play
     Column('failedCardMax', Integer, nullable=False, default=20))
 
+# progress of an interrupted sync, so it can be resumed
+syncStateTable = Table(
+    'syncState', metadata,
+    Column('id', Integer, primary_key=True),
+    # the server being synced with
+    Column('peer', UnicodeText, nullable=False, default=u""),
+    # the lastSync the sync started from
+    Column('lastSync', Float, nullable=False),
+    # the last phase the server acknowledged, and the last history entry
+    # sent within it
+    Column('phase', UnicodeText, nullable=False, default=u""),
+    Column('historyTime', Float, nullable=False, default=0),
+    Column('historyCardId', Integer, nullable=False, default=0),
+    # the server's modified and lastSync once it had finished, or 0
+    Column('serverModified', Float, nullable=False, default=0),
+    Column('modified', Float, nullable=False, default=time.time))
+
 class Deck(object):
     "Top-level object. Manages facts, cards and scheduling information."
 
@@ -105,10 +132,60 @@ class Deck(object):
     factorFour = 1.3
     initialFactor = 2.5
     maxScheduleTime = 1825
+    # failed/future cards are loaded this many seconds past the point where
+    # they're needed, and the window is extended as time moves on
+    queueLookahead = 86400
+    # the revision and acquisition queues are topped up this many at a time
+    queueLimit = 500
+    # the revision order depends on the time, and is recomputed this often
+    revQueueRekey = 60
+    # cards are refreshed this many at a time, so statements stay within
+    # SQLite's limits and the compiled statement is reused
+    idChunk = 100
 
     _queue = ("select type, due, id, modified, priority, reps, successive, interval, "
               "factId, ordinal, created from typedCards")
 
+    # The typedCards view has to classify every card, so the scheduler
+    # selects each type from cards directly instead, which can use the
+    # indices in DeckStorage._addIndices(). These must agree with the view.
+    _typed = """
+select %d, (case
+when (cards.reps != 0 and cards.successive = 0) or cards.id = facts.lastCardId
+then cards.due
+else max(cards.due, facts.spaceUntil) end) as due2, cards.id, cards.modified,
+cards.priority, cards.reps, cards.successive, cards.interval, cards.factId,
+cards.ordinal, cards.created from cards, facts where cards.factId = facts.id
+and """
+    _countTyped = """
+select count(cards.id) from cards, facts where cards.factId = facts.id and """
+    _failedCards = """
+cards.successive = 0 and cards.reps > 0 and cards.priority != 0"""
+    _dueCards = """
+cards.due < strftime('%s', 'now') and
+(facts.lastCardId is null or facts.lastCardId = cards.id or
+ facts.spaceUntil < strftime('%s', 'now'))"""
+    _revCards = """
+cards.priority in (2, 3, 4) and
+(cards.priority = 4 or (cards.reps != 0 and cards.successive != 0)) and
+(cards.reps = 0 or cards.successive != 0) and """ + _dueCards
+    _acqCards = """
+cards.priority in (1, 2, 3) and
+(cards.reps = 0 or cards.priority = 1) and
+(cards.reps = 0 or cards.successive != 0) and """ + _dueCards
+    # future cards in (lo, hi]: not yet due, or due but spaced
+    _futureCards = ("""
+cards.priority in (1, 2, 3, 4) and
+cards.due >= strftime('%s', 'now') and cards.due <= :hi and
+(cards.reps = 0 or cards.successive != 0) and
+due2 > :lo and due2 <= :hi
+union all """ + _typed % 3 + """
+facts.spaceUntil > :lo and facts.spaceUntil <= :hi and
+facts.spaceUntil >= strftime('%s', 'now') and
+facts.lastCardId != cards.id and cards.priority != 0 and
+cards.due < strftime('%s', 'now') and
+(cards.reps = 0 or cards.successive != 0)""")
+
     _earliest = """
 select (case
 -- failed cards minus delay0/1 lookahead
@@ -134,40 +211,153 @@ limit 1
         # ensure all card objects are written to db first
         self.s.flush()
         self.factSpacing = {}
-        if self.newCardOrder == 0: acq = AcqRandomItem
-        else: acq = AcqOrderedItem
-        queue = self.s.all(self._queue)
-        def ilist(type, itemClass, q):
-            return [itemClass(*x[1:]) for x in q if x[0]==type]
-        self.failedQueue = ilist(0, FailedItem, queue)
-        self.revQueue = ilist(1, RevItem, queue)
-        self.acqQueue = ilist(2, acq, queue)
-        self.futureQueue = ilist(3, FutureItem, queue)
-        heapify(self.failedQueue)
-        heapify(self.revQueue)
-        heapify(self.acqQueue)
-        heapify(self.futureQueue)
+        if self.newCardOrder == 0: acqKey = acqRandomKey
+        else: acqKey = acqOrderedKey
+        self.failedQueue = FailedQueue()
+        self.revQueue = CardQueue(revKey)
+        self.acqQueue = CardQueue(acqKey)
+        self.futureQueue = CardQueue(dueKey)
+        # failed & future cards are loaded up to this time
+        self.queueCutoff = 0
+        # revision & acquisition cards in the DB that are not yet loaded.
+        # None means unknown.
+        self.queueBacklog = {1: None, 2: None}
+        self.fillQueues()
+
+    def queueIsBuilt(self):
+        return getattr(self, 'failedQueue', None) is not None
+
+    def fillQueues(self, now=None):
+        "Extend the lookahead window and top up any drained queues."
+        if not now:
+            now = time.time()
+        horizon = max(self.collapseTime, self.delay0, self.delay1)
+        if now > self.queueCutoff:
+            # cards which came due after the window ran out are revision or
+            # acquisition cards now, so probe for them again
+            self.queueBacklog = {1: None, 2: None}
+        if now + horizon > self.queueCutoff:
+            cutoff = now + horizon + self.queueLookahead
+            self._addQueueRows(self.s.all(
+                self._typed % 0 + self._failedCards +
+                " and cards.due > :lo and cards.due <= :hi union all " +
+                self._typed % 3 + self._futureCards,
+                lo=self.queueCutoff, hi=cutoff))
+            self.queueCutoff = cutoff
+        if now - self.revQueue.keyTime > self.revQueueRekey:
+            self.revQueue.rekey(now)
+        self._topUpQueue(1, self.revQueue, now)
+        self._topUpQueue(2, self.acqQueue, now)
+
+    def _topUpQueue(self, type, queue, now):
+        "Load the next batch of revision/acquisition cards if QUEUE is empty."
+        if len(queue) or self.queueBacklog[type] == 0:
+            return
+        if type == 1:
+            cards = self._revCards
+            order = "cards.priority desc, cards.interval / (:now - due2)"
+        else:
+            cards = self._acqCards
+            if self.newCardOrder == 0:
+                order = "cards.priority desc, cards.factId, cards.ordinal"
+            else:
+                order = "cards.priority desc, cards.created, cards.ordinal"
+        rows = self.s.all(self._typed % type + cards + " order by %s "
+                          "limit :limit" % order,
+                          now=now, limit=self.queueLimit)
+        added = self._addQueueRows(rows)
+        if len(rows) < self.queueLimit or not added:
+            self.queueBacklog[type] = 0
+        else:
+            self.queueBacklog[type] = max(0, self.s.scalar(
+                self._countTyped + cards) - len(queue))
+
+    def _addQueueRows(self, rows):
+        "Add typedCards ROWS to their queues. Return the number added."
+        queues = (self.failedQueue, self.revQueue,
+                  self.acqQueue, self.futureQueue)
+        new = ([], [], [], [])
+        for row in rows:
+            if self.cardIsQueued(row[2]):
+                continue
+            new[row[0]].append(QueueItem(*row[1:]))
+        for (queue, items) in zip(queues, new):
+            if items:
+                queue.extend(items)
+        return sum([len(items) for items in new])
+
+    def cardIsQueued(self, id):
+        if not self.queueIsBuilt():
+            return False
+        return (id in self.failedQueue or id in self.revQueue or
+                id in self.acqQueue or id in self.futureQueue)
+
+    def removeCardFromQueue(self, id):
+        "Drop card ID from whichever queue it's in."
+        if not self.queueIsBuilt():
+            return
+        for q in (self.failedQueue, self.revQueue,
+                  self.acqQueue, self.futureQueue):
+            q.remove(id)
+
+    def refreshQueueCards(self, ids):
+        "Reload card IDS into the queue after they've been changed in the DB."
+        if not self.queueIsBuilt() or not ids:
+            return
+        self.s.flush()
+        for id in ids:
+            self.removeCardFromQueue(id)
+        for (inIds, args) in self._idChunks(ids):
+            self._addQueueRows(self.s.all(self._queue + """
+ where id in %s and (type in (1, 2) or due <= :cutoff)""" % inIds,
+                                          cutoff=self.queueCutoff, **args))
+
+    def refreshQueueFacts(self, factIds):
+        "Reload the cards of FACTIDS, and forget their cached spacing."
+        if not self.queueIsBuilt() or not factIds:
+            return
+        for id in factIds:
+            self.factSpacing.pop(id, None)
+        cardIds = []
+        for (inIds, args) in self._idChunks(factIds):
+            cardIds.extend(self.s.column0(
+                "select id from cards where factId in %s" % inIds, **args))
+        self.refreshQueueCards(cardIds)
+
+    def _idChunks(self, ids):
+        """Yield (placeholders, args) to look up IDS idChunk at a time. The
+        last chunk is padded with its last id, so every chunk uses the same
+        statement."""
+        ids = list(ids)
+        names = ["id%d" % n for n in range(self.idChunk)]
+        placeholders = "(%s)" % ", ".join([":" + n for n in names])
+        for n in range(0, len(ids), self.idChunk):
+            chunk = ids[n:n+self.idChunk]
+            chunk += chunk[-1:] * (self.idChunk - len(chunk))
+            yield (placeholders, dict(zip(names, chunk)))
 
     def getCard(self):
         "Return the next due card, or None"
         now = time.time()
+        self.fillQueues(now)
         # any expired cards?
-        while self.futureQueue and self.futureQueue[0].due <= now:
-            newItem = heappop(self.futureQueue)
+        while self.futureQueue and self.futureQueue.peek().due <= now:
+            newItem = self.futureQueue.pop()
             self.addExpiredItem(newItem)
+        self.fillQueues(now)
         # failed card due?
-        if (self.failedQueue and self.failedQueue[0].due <= now):
-            item = heappop(self.failedQueue)
+        if (self.failedQueue and self.failedQueue.peek().due <= now):
+            item = self.failedQueue.pop()
         # failed card queue too big?
         elif (self.failedCardMax and
             self.failedCardsDueSoon() >= self.failedCardMax):
             item = self.getOldestModifiedFailedCard()
         # card due for revision
         elif self.revQueue:
-            item = heappop(self.revQueue)
+            item = self.revQueue.pop()
         # card due for acquisition
         elif self.acqQueue:
-            item = heappop(self.acqQueue)
+            item = self.acqQueue.pop()
         else:
             if self.collapsedFailedCards():
                 # final review
@@ -180,8 +370,7 @@ limit 1
             if space > now:
                 # update due time and put it back in future queue
                 item.due = max(item.due, space)
-                item = self.itemFromItem(FutureItem, item)
-                heappush(self.futureQueue, item)
+                self.futureQueue.push(item)
                 return self.getCard()
         card = self.s.query(anki.cards.Card).get(item.id)
         card.genFuzz()
@@ -191,102 +380,159 @@ limit 1
     def getOldestModifiedFailedCard(self, collapse=False):
         # get the oldest modified within collapse.
         if collapse:
-            cutoff = time.time() + self.collapseTime
+            window = self.collapseTime
         else:
-            cutoff = time.time() + max(self.delay0, self.delay1)
-        q = [i for i in self.failedQueue if i.due <= cutoff]
-        item = sorted(q, cmp=self.oldestModifiedCmp)[0]
-        # remove it from the queue and rebuild
-        self.failedQueue.remove(item)
-        heapify(self.failedQueue)
-        return item
+            window = max(self.delay0, self.delay1)
+        return self.failedQueue.popOldestModified(time.time(), window)
 
     def answerCard(self, card, ease):
         "Reschedule CARD based on EASE."
-        oldState = self.cardState(card)
-        lastDelay = max(0, (time.time() - card.due) / 86400.0)
-        # update card details
-        card.lastInterval = card.interval
-        card.interval = self.nextInterval(card, ease)
-        card.lastDue = card.due
-        card.due = self.nextDue(card, ease, oldState)
-        self.updateFactor(card, ease)
-        # update fact
-        card.fact.lastCard = card
-        card.fact.lastCardId = card.id
-        # spacing - first, we get the times of all other cards with the same
-        # fact
-        (smin, ssum, scnt) = self.s.all("""
-select min(interval), sum(interval), count(interval) from cards
-where factId = :fid and id != :id""", fid=card.factId, id=card.id)[0]
-        smin = smin or 0
-        ssum = ssum or 0
-        space = min(smin, card.interval)
-        if not space:
-            newSpace = (time.time() +
-                        card.fact.model.initialSpacing)
-        else:
-            newSpace = max(time.time() + (
-                space * card.fact.model.spacing * 86400.0),
-                           self.delay0+1,
-                           self.delay1+1)
-        # only update spacing if it's greater than before
-        if newSpace > card.fact.spaceUntil:
-            card.fact.spaceUntil = newSpace
-        # update cache
-        self.factSpacing[card.factId] = (card.id, card.fact.spaceUntil)
-        card.fact.setModified(textChanged=False)
-        # stats
-        card.updateStats(ease, oldState) # sets mod
-        anki.stats.updateAllStats(self.s, card, ease, oldState)
-        # history
-        entry = CardHistoryEntry(card, ease, lastDelay)
-        self.s.save(entry)
-        # add back to queue
-        self.addCardToQueue(card)
+        self.answerCards([(card, ease, None)])
+
+    def answerCards(self, answers):
+        """Reschedule a batch of cards. ANSWERS is a list of (card, ease,
+        thinkingTime) in the order they were answered; a thinkingTime of None
+        uses the card's own timer. The result is the same as calling
+        answerCard() on each in turn, but cards, facts, stats and history are
+        written with one statement per table."""
+        if not answers:
+            return
+        # everything else pending is flushed now, so the objects we write
+        # below can be marked clean afterwards
+        self.s.flush()
+        # intervals of the cards sharing a fact with an answered card, kept
+        # up to date as the batch is processed
+        siblings = {}
+        factIds = set([card.factId for (card, ease, t) in answers])
+        for (fid, cid, ivl) in self.s.all("""
+select factId, id, interval from cards where factId in (%s)""" %
+                                          ",".join([str(id) for id in factIds])):
+            siblings.setdefault(fid, {})[cid] = ivl
+        stats = (anki.stats.globalStats(self.s),
+                 anki.stats.dailyStats(self.s))
+        cards = {}
+        facts = {}
+        history = []
+        for (card, ease, thinkingTime) in answers:
+            if thinkingTime is not None:
+                card._thinkingTime = thinkingTime
+            if not hasattr(card, 'fuzz'):
+                card.genFuzz()
+            now = time.time()
+            oldState = self.cardState(card)
+            lastDelay = max(0, (now - card.due) / 86400.0)
+            # update card details
+            card.lastInterval = card.interval
+            card.interval = self.nextInterval(card, ease)
+            card.lastDue = card.due
+            card.due = self.nextDue(card, ease, oldState)
+            self.updateFactor(card, ease)
+            # update fact
+            fact = card.fact
+            fact.lastCard = card
+            fact.lastCardId = card.id
+            # spacing - first, we get the times of all other cards with the
+            # same fact
+            others = [v for (k, v) in siblings[card.factId].items()
+                      if k != card.id]
+            siblings[card.factId][card.id] = card.interval
+            space = min(others and min(others) or 0, card.interval)
+            if not space:
+                newSpace = (now + fact.model.initialSpacing)
+            else:
+                newSpace = max(now + (
+                    space * fact.model.spacing * 86400.0),
+                               self.delay0+1,
+                               self.delay1+1)
+            # only update spacing if it's greater than before
+            if newSpace > fact.spaceUntil:
+                fact.spaceUntil = newSpace
+            # update cache
+            self.factSpacing[card.factId] = (card.id, fact.spaceUntil)
+            fact.setModified(textChanged=False)
+            # stats
+            card.updateStats(ease, oldState) # sets mod
+            for s in stats:
+                anki.stats.updateStats(s, card, ease, oldState)
+            # history
+            history.append({
+                'cardId': card.id,
+                'time': now,
+                'lastInterval': card.lastInterval,
+                'nextInterval': card.interval,
+                'ease': ease,
+                'delay': lastDelay,
+                'lastFactor': card.lastFactor,
+                'nextFactor': card.factor,
+                'reps': card.reps,
+                'thinkingTime': card.thinkingTime(),
+                'yesCount': card.yesCount,
+                'noCount': card.noCount})
+            cards[card.id] = card
+            facts[fact.id] = fact
+            # add back to queue
+            self.addCardToQueue(card)
+        self._writeObjects(anki.cards.cardsTable, cards.values())
+        self._writeObjects(anki.facts.factsTable, facts.values())
+        self._writeObjects(anki.stats.statsTable, stats)
+        self.s.execute(anki.history.reviewHistoryTable.insert(), history)
         self.setModified()
         self.s.flush()
 
+    def _writeObjects(self, table, objs):
+        """Write the columns of the mapped OBJS to TABLE with a single
+        executemany, and mark them as clean so the next flush skips them."""
+        cols = [c.name for c in table.columns if c.name != "id"]
+        rows = []
+        for obj in objs:
+            row = dict([(c, getattr(obj, c)) for c in cols])
+            row['_id'] = obj.id
+            rows.append(row)
+        self.s.execute(table.update(table.c.id == bindparam('_id')), rows)
+        for obj in objs:
+            obj._state.commit_all()
+
     def addCardToQueue(self, card):
-        "Add CARD to the scheduling queue."
+        "Add CARD to the scheduling queue, replacing any existing entry."
+        if not self.queueIsBuilt():
+            return
+        self.removeCardFromQueue(card.id)
         if card.priority == 0:
             return
         if self.cardIsNew(card):
             # acquisition queue
-            if self.newCardOrder == 0: acq = AcqRandomItem
-            else: acq = AcqOrderedItem
-            item = self.itemFromItem(acq, card)
-            heappush(self.acqQueue, item)
+            item = self.itemFromCard(card)
+            self.acqQueue.push(item)
         elif card.successive == 0:
             # failed
-            item = self.itemFromItem(FailedItem, card)
-            heappush(self.failedQueue, item)
+            if card.due > self.queueCutoff:
+                # loaded when the window reaches it
+                return
+            item = self.itemFromCard(card)
+            self.failedQueue.push(item)
         else:
             # future
-            item = self.itemFromItem(FutureItem, card)
+            item = self.itemFromCard(card)
             if card.id != card.fact.lastCardId:
                 item.due = max(card.due, card.fact.spaceUntil)
-            heappush(self.futureQueue, item)
+            if item.due > self.queueCutoff:
+                return
+            self.futureQueue.push(item)
 
-    def itemFromItem(self, itemClass, item):
-        "Create a scheduling item of ITEMCLASS based on ITEM/CARD."
-        return itemClass(item.due, item.id, item.modified, item.priority,
-                         item.reps, item.successive, item.interval,
-                         item.factId, item.ordinal, item.created)
+    def itemFromCard(self, card):
+        "Create a scheduling item based on CARD."
+        return QueueItem(card.due, card.id, card.modified, card.priority,
+                         card.reps, card.successive, card.interval,
+                         card.factId, card.ordinal, card.created)
 
     def addExpiredItem(self, item):
         "Place ITEM on the revision/failed queue."
         if item.successive:
-            item = self.itemFromItem(RevItem, item)
-            heappush(self.revQueue, item)
+            self.revQueue.push(item)
         elif item.reps == 0:
-            if self.newCardOrder == 0: acq = AcqRandomItem
-            else: acq = AcqOrderedItem
-            item = self.itemFromItem(acq, item)
-            heappush(self.acqQueue, item)
+            self.acqQueue.push(item)
         else:
-            item = self.itemFromItem(FailedItem, item)
-            heappush(self.failedQueue, item)
+            self.failedQueue.push(item)
 
     def itemSpacing(self, item):
         "Return the spacing of item, using our cache or the DB."
@@ -300,22 +546,15 @@ where factId = :fid and id != :id""", fid=card.factId, id=card.id)[0]
             return 0
         return self.factSpacing[item.factId][1]
 
-    def failedCardsDueSoon(self, cutoff=None):
-        "Number of failed cards due within delay0/1."
-        count = 0
-        if not cutoff:
-            cutoff = time.time() + max(self.delay0, self.delay1)
-        for n in range(len(self.failedQueue)):
-            if self.failedQueue[n].due <= cutoff:
-                count += 1
-        return count
+    def failedCardsDueSoon(self, window=None):
+        "Number of failed cards due within delay0/1, or WINDOW seconds."
+        if not window:
+            window = max(self.delay0, self.delay1)
+        return self.failedQueue.dueWithin(time.time(), window)
 
     def collapsedFailedCards(self):
         "Number of cards due within collapse time."
-        return self.failedCardsDueSoon(time.time() + self.collapseTime)
-
-    def oldestModifiedCmp(self, a, b):
-        return cmp(a.modified, b.modified)
+        return self.failedCardsDueSoon(self.collapseTime)
 
     # Interval management
     ##########################################################################
@@ -408,6 +647,7 @@ where id in (%s)""" % strids, now=time.time())
 update facts set spaceUntil = 0, lastCardId = null, modified = :now
 where id in (%s)""" % ",".join([str(id) for id in factIds]), now=time.time())
         self.flushMod()
+        self.refreshQueueFacts(factIds)
 
     # Times
     ##########################################################################
@@ -458,18 +698,42 @@ where id in (%s)""" % ",".join([str(id) for id in factIds]), now=time.time())
     def updateAllPriorities(self):
         "Update all card priorities if changed."
         now = time.time()
-        newPriorities = []
-        tagsList = self.tagsList()
+        # the card, fact, model and card model tags each resolve to a
+        # priority, and a card takes whichever of its four comes first in
+        # PRIORITY_ORDER. So each distinct tag string is only parsed once,
+        # and the database finds the cards that have changed.
         tagCache = self.genTagCache()
-        for (cardId, tags, oldPriority) in tagsList:
-            newPriority = self.priorityFromTagString(tags, tagCache)
-            if newPriority != oldPriority:
-                newPriorities.append({"id": cardId, "pri": newPriority})
+        ranks = [{'tags': tags, 'rank': PRIORITY_ORDER.index(
+            self.priorityFromTagString(tags, tagCache))}
+                 for tags in self.s.column0("""
+select tags from cards union select tags from facts union
+select tags from models union select name from cardModels""")]
+        if not ranks:
+            return
+        # left over if an earlier call failed part way
+        self.s.statement("""
+create temporary table if not exists tagPriorities
+(tags text primary key, rank integer)""")
+        self.s.statement("delete from tagPriorities")
+        self.s.statements("insert into tagPriorities values (:tags, :rank)",
+                          ranks)
+        priority = "(case min(t1.rank, t2.rank, t3.rank, t4.rank) %s end)" % (
+            " ".join(["when %d then %d" % x
+                      for x in enumerate(PRIORITY_ORDER)]))
+        newPriorities = [{"id": id, "pri": pri} for (id, pri) in self.s.all("""
+select cards.id, %s as pri from cards, facts, models, cardModels,
+tagPriorities t1, tagPriorities t2, tagPriorities t3, tagPriorities t4
+where cards.factId = facts.id and facts.modelId = models.id
+and cards.cardModelId = cardModels.id
+and t1.tags = cards.tags and t2.tags = facts.tags
+and t3.tags = models.tags and t4.tags = cardModels.name
+and pri != cards.priority""" % priority)]
         # update db
         self.s.execute(text("""
 update cards set priority = :pri, modified = %f where cards.id = :id""" %
                             now),
                           newPriorities)
+        self.refreshQueueCards([p['id'] for p in newPriorities])
 
     def updatePriority(self, card):
         "Update priority on a single card."
@@ -480,6 +744,8 @@ update cards set priority = :pri, modified = %f where cards.id = :id""" %
         if p != card.priority:
             card.priority = p
             self.flushMod()
+            if self.cardIsQueued(card.id):
+                self.refreshQueueCards([card.id])
 
     def priorityFromTagString(self, tagString, tagCache):
         tags = parseTags(tagString.lower())
@@ -536,16 +802,16 @@ update cards set priority = :pri, modified = %f where cards.id = :id""" %
     def pendingFailedCount(self):
         "Number of pending failed cards. Use when queue not rebuilt."
         return self.s.scalar(
-            "select count(id) from typedCards where due <= :now and type = 0",
-            now=time.time()+self.collapseTime)
+            "select count(id) from cards where" + self._failedCards +
+            " and due <= :now", now=time.time()+self.collapseTime)
 
     def pendingSuccessiveCount(self):
         "Number of pending review cards. Use when queue not rebuilt."
-        return self.s.scalar("select count(id) from typedCards where type = 1")
+        return self.s.scalar(self._countTyped + self._revCards)
 
     def pendingNewCount(self):
         "Number of pending new cards. Use when queue not rebuilt."
-        return self.s.scalar("select count(id) from typedCards where type = 2")
+        return self.s.scalar(self._countTyped + self._acqCards)
 
     def spacedCardCount(self):
         return self.s.scalar("""
@@ -601,9 +867,9 @@ facts.spaceUntil > :now""", now=time.time())
         "Return some commonly needed stats."
         stats = anki.stats.getStats(self.s)
         # add scheduling related stats
-        stats['new'] = len(self.acqQueue)
+        stats['new'] = len(self.acqQueue) + (self.queueBacklog[2] or 0)
         stats['failed'] = self.failedCardsDueSoon()
-        stats['successive'] = len(self.revQueue)
+        stats['successive'] = len(self.revQueue) + (self.queueBacklog[1] or 0)
         stats['old'] = stats['failed'] + stats['successive']
         if currentCard:
             q = self.queueForCard(currentCard)
@@ -698,11 +964,19 @@ where factId = :fid and cardModelId = :cmid""",
     def deleteFact(self, factId):
         "Delete a fact. Removes any associated cards. Don't flush."
         # remove any remaining cards
+        if self.queueIsBuilt():
+            for id in self.s.column0("select id from cards where factId = :id",
+                                     id=factId):
+                self.removeCardFromQueue(id)
         self.s.statement("insert into cardsDeleted select id, :time "
                          "from cards where factId = :factId",
                          time=time.time(), factId=factId)
+        self.s.statement("delete from cardTags where cardId in "
+                         "(select id from cards where factId = :id)",
+                         id=factId)
         self.s.statement("delete from cards where factId = :id", id=factId)
         # and then the fact
+        anki.tags.unindexTags(self.s, "facts", [factId])
         self.s.statement("delete from facts where id = :id", id=factId)
         self.s.statement("delete from fields where factId = :id", id=factId)
         self.s.statement("insert into factsDeleted values (:id, :time)",
@@ -717,6 +991,7 @@ where factId = :fid and cardModelId = :cmid""",
         strids = ",".join([str(id) for id in ids])
         self.s.statement("delete from facts where id in (%s)" % strids)
         self.s.statement("delete from fields where factId in (%s)" % strids)
+        anki.tags.unindexTags(self.s, "facts", ids)
         data = [{'id': id, 'time': now} for id in ids]
         self.s.statements("insert into factsDeleted values (:id, :time)", data)
 
@@ -730,6 +1005,8 @@ where factId = :fid and cardModelId = :cmid""",
         "Delete a card given its id. Delete any unused facts. Don't flush."
         factId = self.s.scalar("select factId from cards where id=:id", id=id)
         self.s.statement("delete from cards where id = :id", id=id)
+        anki.tags.unindexTags(self.s, "cards", [id])
+        self.removeCardFromQueue(id)
         self.s.statement("insert into cardsDeleted values (:id, :time)",
                          id=id, time=time.time())
         if factId and not self.factUseCount(factId):
@@ -747,6 +1024,9 @@ where factId = :fid and cardModelId = :cmid""",
                                  % strids)
         # drop from cards
         self.s.statement("delete from cards where id in (%s)" % strids)
+        anki.tags.unindexTags(self.s, "cards", ids)
+        for id in ids:
+            self.removeCardFromQueue(id)
         # note deleted
         data = [{'id': id, 'time': now} for id in ids]
         self.s.statements("insert into cardsDeleted values (:id, :time)", data)
@@ -883,13 +1163,46 @@ where
 cards.factId = facts.id and
 facts.modelId = cardModels.modelId and
 cards.cardModelId = :id""", id=cardModel.id)
+        self.updateCardQA([cid for (cid, fid) in ids])
+
+    def updateCardQA(self, ids):
+        "Rerender the question and answer of cards IDS in bulk."
+        ids = list(ids)
+        # keep the id lists within sqlite's statement size
+        for n in range(0, len(ids), 1000):
+            self._updateCardQA(ids[n:n+1000])
+
+    def _updateCardQA(self, ids):
         if not ids:
             return
-        pend = [{'q': cardModel.renderQASQL('q', fid),
-                 'a': cardModel.renderQASQL('a', fid),
-                 'id': cid}
-                for (cid, fid) in ids]
-        self.s.execute("""
+        cards = self.s.all("""
+select cards.id, cards.factId, cards.cardModelId,
+cards.tags || "," || facts.tags || "," || cardModels.name || "," || models.tags
+from cards, facts, models, cardModels where
+cards.factId = facts.id and facts.modelId = models.id and
+cards.cardModelId = cardModels.id and cards.id in %s""" % ids2str(ids))
+        fields = {}
+        for (fid, name, value) in self.s.all("""
+select fields.factId, fieldModels.name, fields.value
+from fields, fieldModels where
+fields.fieldModelId = fieldModels.id and
+fields.factId in %s""" % ids2str(set([c[1] for c in cards]))):
+            fields.setdefault(fid, {})[name] = value
+        cardModels = {}
+        tagStrings = {}
+        pend = []
+        for (cid, fid, cmid, tags) in cards:
+            if cmid not in cardModels:
+                cardModels[cmid] = self.s.query(anki.models.CardModel).get(cmid)
+            cm = cardModels[cmid]
+            if tags not in tagStrings:
+                tagStrings[tags] = ", ".join(parseTags(tags))
+            tags = tagStrings[tags]
+            pend.append({
+                'q': cm.renderFields(fields.get(fid, {}), tags, "question"),
+                'a': cm.renderFields(fields.get(fid, {}), tags, "answer"),
+                'id': cid})
+        self.s.statements("""
 update cards
 set
 question = :q,
@@ -909,8 +1222,53 @@ cards.factId == facts.id and facts.modelId == models.id
 and cards.cardModelId = cardModels.id""")
 
     def allTags(self):
-        "Return a hash listing tags in model, fact and cards."
-        return list(set(parseTags(",".join([x[1] for x in self.tagsList()]))))
+        "Return a list of the tags in use in models, facts and cards."
+        return [tag for (tag, count) in self.tagCounts()]
+
+    def tagCounts(self):
+        "Return a list of (tag, number of cards) for the tags in use."
+        names = {}
+        counts = {}
+        for (key, tag, count) in self.s.all("""
+select key, tag, count(distinct cardId) from tags, (
+select tagId, cardId from cardTags union all
+select factTags.tagId, cards.id from factTags, cards
+where factTags.factId = cards.factId)
+where tagId = tags.id group by tags.id"""):
+            names[key] = tag
+            counts[key] = count
+        # model tags and card model names aren't indexed, and may overlap
+        # with the above
+        for tag in parseTags(",".join(self.s.column0("""
+select tags from models union select name from cardModels"""))):
+            names.setdefault(tag.lower(), tag)
+            counts[tag.lower()] = len(self.cardIdsWithTags(tag))
+        return [(names[key], counts[key]) for key in counts if counts[key]]
+
+    def cardIdsWithTags(self, tags):
+        "Return the ids of cards with any of TAGS on the card/fact/model."
+        return self.s.column0(self.cardIdsWithTagsQuery(tags))
+
+    def cardIdsWithTagsQuery(self, tags):
+        """Return SQL selecting the ids of cards with any of TAGS, for use as
+        a subquery."""
+        tags = parseTags(tags)
+        keys = set([t.lower() for t in tags])
+        def matches(tags):
+            return keys.intersection([t.lower() for t in parseTags(tags)])
+        tagIds = ids2str(anki.tags.tagIds(self.s, tags, create=False).values())
+        models = [id for (id, tags) in self.s.all(
+            "select id, tags from models") if matches(tags)]
+        cardModels = [id for (id, name) in self.s.all(
+            "select id, name from cardModels") if matches(name)]
+        return """
+select cardId from cardTags where tagId in %s union
+select cards.id from cards, factTags where cards.factId = factTags.factId
+and factTags.tagId in %s union
+select cards.id from cards, facts where cards.factId = facts.id
+and facts.modelId in %s union
+select id from cards where cardModelId in %s""" % (
+            tagIds, tagIds, ids2str(models), ids2str(cardModels))
 
     def cardTags(self, ids):
         return self.s.all("""
@@ -922,56 +1280,81 @@ where id in (%s)""" % ",".join([str(id) for id in ids]))
 select id, tags from facts
 where id in (%s)""" % ",".join([str(id) for id in ids]))
 
-    def addCardTags(self, ids, tags, idfunc=None, table="cards"):
-        if not idfunc:
-            idfunc=self.cardTags
-        tlist = idfunc(ids)
-        newTags = parseTags(tags)
+    def addCardTags(self, ids, tags):
+        self._addTags("cards", ids, tags)
+
+    def addFactTags(self, ids, tags):
+        self._addTags("facts", ids, tags)
+
+    def deleteCardTags(self, ids, tags):
+        self._deleteTags("cards", ids, tags)
+
+    def deleteFactTags(self, ids, tags):
+        self._deleteTags("facts", ids, tags)
+
+    def _addTags(self, table, ids, tags):
+        "Add TAGS to IDS in TABLE, touching only the rows without them."
+        (linkTable, col) = anki.tags.links[table]
+        tags = parseTags(tags)
+        tagIds = anki.tags.tagIds(self.s, tags)
         now = time.time()
-        pending = []
-        for (id, tags) in tlist:
-            oldTags = parseTags(tags)
-            tmpTags = list(set(oldTags + newTags))
-            if tmpTags != oldTags:
-                pending.append(
-                    {'id': id, 'now': now, 'tags': ", ".join(tmpTags)})
-        self.s.statements("""
+        for tag in tags:
+            tagId = tagIds.pop(tag.lower(), None)
+            if tagId is None:
+                # a duplicate
+                continue
+            missing = self.s.column0("""
+select id from %s where id in %s and not exists
+(select 1 from %s where %s = %s.id and tagId = :tagId)""" % (
+                table, ids2str(ids), linkTable, col, table), tagId=tagId)
+            if not missing:
+                continue
+            missing = ids2str(missing)
+            self.s.statement("""
 update %s set
-tags = :tags,
+tags = (case when trim(tags) = '' then :tag else tags || ', ' || :tag end),
 modified = :now
-where id = :id""" % table, pending)
+where id in %s""" % (table, missing), tag=tag, now=now)
+            self.s.statement("insert into %s select id, :tagId from %s "
+                             "where id in %s" % (linkTable, table, missing),
+                             tagId=tagId)
         self.flushMod()
 
-    def addFactTags(self, ids, tags):
-        self.addCardTags(ids, tags, idfunc=self.factTags, table="facts")
-
-    def deleteCardTags(self, ids, tags, idfunc=None, table="cards"):
-        if not idfunc:
-            idfunc=self.cardTags
-        tlist = idfunc(ids)
-        newTags = parseTags(tags)
+    def _deleteTags(self, table, ids, tags):
+        "Remove TAGS from IDS in TABLE, touching only the rows with them."
+        (linkTable, col) = anki.tags.links[table]
+        tagIds = anki.tags.tagIds(self.s, parseTags(tags), create=False)
+        if not tagIds:
+            return
+        strTagIds = ids2str(tagIds.values())
         now = time.time()
-        pending = []
-        for (id, tags) in tlist:
-            oldTags = parseTags(tags)
-            tmpTags = oldTags[:]
-            for tag in newTags:
-                try:
-                    tmpTags.remove(tag)
-                except ValueError:
-                    pass
-            if tmpTags != oldTags:
-                pending.append(
-                    {'id': id, 'now': now, 'tags': ", ".join(tmpTags)})
-        self.s.statements("""
+        pending = [{'id': id, 'now': now,
+                    'tags': u", ".join([t for t in parseTags(old)
+                                        if t.lower() not in tagIds])}
+                   for (id, old) in self.s.all("""
+select id, tags from %s where id in %s and exists
+(select 1 from %s where %s = %s.id and tagId in %s)""" % (
+            table, ids2str(ids), linkTable, col, table, strTagIds))]
+        if pending:
+            self.s.statements("""
 update %s set
 tags = :tags,
 modified = :now
 where id = :id""" % table, pending)
+            self.s.statement("delete from %s where tagId in %s and %s in %s" % (
+                linkTable, strTagIds, col, ids2str([p['id'] for p in pending])))
         self.flushMod()
 
-    def deleteFactTags(self, ids, tags):
-        self.deleteCardTags(ids, tags, idfunc=self.factTags, table="facts")
+    def updateTagIndex(self, cardIds=(), factIds=()):
+        "Relink the tags of CARDIDS and FACTIDS after changing them in SQL."
+        anki.tags.indexTags(self.s, "cards", cardIds)
+        anki.tags.indexTags(self.s, "facts", factIds)
+
+    def rebuildTagIndex(self):
+        "Relink the tags of every card and fact."
+        anki.tags.indexTags(self.s, "cards")
+        anki.tags.indexTags(self.s, "facts")
+        self.version = DECK_VERSION
 
     # File-related
     ##########################################################################
@@ -998,25 +1381,14 @@ where id = :id""" % table, pending)
         return dir
 
     def addMedia(self, path):
-        """Add PATH to the media directory.
-Rename for uniqueness if not the same. Return the new name."""
-        file = os.path.basename(path)
-        location = os.path.join(self.mediaDir(), file)
-        location = location.replace('"', "")
-        if os.path.exists(location):
-            print "uniqueness check NYI"
-        else:
-            # RLC use copy instead of copy2 for wince test
-            shutil.copy(path, location)
-        return os.path.basename(location)
+        """Add PATH to the media directory, named by its checksum. Return the
+new name."""
+        return anki.media.addMedia(self, path)
 
     def renameMediaDir(self, oldPath):
-        "Copy oldPath to our current media dir. "
+        "Copy oldPath to our current media dir, linking the files if possible."
         assert os.path.exists(oldPath)
-        newPath = self.mediaDir(create=True)
-        # copytree doesn't want the dir to exist
-        os.rmdir(newPath)
-        shutil.copytree(oldPath, newPath)
+        anki.media.copyMediaDir(oldPath, self.mediaDir(create=True))
 
     # DB helpers
     ##########################################################################
@@ -1061,6 +1433,10 @@ Rename for uniqueness if not the same. Return the new name."""
     def setModified(self, newTime=None):
         self.modified = newTime or time.time()
 
+    def statementCacheStats(self):
+        "Return hit/miss counts for the compiled SQL cache."
+        return statementCache.stats()
+
     def flushMod(self):
         "Mark modified and flush to DB."
         self.setModified()
@@ -1095,6 +1471,11 @@ Rename for uniqueness if not the same. Return the new name."""
         s("insert into cardsDeleted select * from old.cardsDeleted")
         s("insert into models select * from old.models")
         s("insert into stats select * from old.stats")
+        s("insert into media select * from old.media")
+        s("insert into tags select * from old.tags")
+        s("insert into cardTags select * from old.cardTags")
+        s("insert into factTags select * from old.factTags")
+        s("update decks set version = :version", version=DECK_VERSION)
         # detach old db and commit
         s("detach database old")
         newDeck.s.commit()
@@ -1119,18 +1500,25 @@ mapper(Deck, decksTable, properties={
     })
 
 
-# Items in the scheduler
+# Scheduler queues
 ##########################################################################
 #
-# - heapq doesn't support an explicit sort argument, so we need to define
-#   objects with their own __cmp__()
-# - to minimize memory footprint we inline __init__ instead of subclassing a
-#   parent object
-
-# item in failed queue
-class FailedItem(object):
-    __slots__ = ['due', 'id', 'modified', 'priority', 'reps', 'successive', 'interval',
-                 'factId', 'ordinal', 'created']
+# Each queue is a heap of entries of the form (key..., item), where the key is
+# computed once when the item is pushed, so heap operations compare plain
+# tuples. The heap can also be looked up by card id. Removal is lazy: the id
+# is forgotten immediately, and the stale heap entry is discarded when it
+# reaches the top.
+#
+# This is faster, not smaller: the item, its entry and the index cost a
+# queued card about 280 bytes, against 128 for the old per-queue items
+# (tools/bench_queue.py). The queues only hold queueLimit revision and
+# acquisition cards and the failed and future cards due within
+# queueLookahead, which bounds the difference.
+
+class QueueItem(object):
+    "A card in the scheduler. The same item moves between queues."
+    __slots__ = ['due', 'id', 'modified', 'priority', 'reps', 'successive',
+                 'interval', 'factId', 'ordinal', 'created']
     def __init__(self, due, id, modified, priority, reps, successive, interval,
                  factId, ordinal, created):
         self.due = due
@@ -1143,103 +1531,202 @@ class FailedItem(object):
         self.factId = factId
         self.ordinal = ordinal
         self.created = created
-    def __cmp__(self, other):
-        return cmp(self.due, other.due)
 
-# item in revision queue
-class RevItem(object):
-    __slots__ = ['due', 'id', 'modified', 'priority', 'reps', 'successive', 'interval',
-                 'factId', 'ordinal', 'created']
-    def __init__(self, due, id, modified, priority, reps, successive, interval,
-                 factId, ordinal, created):
-        self.due = due
-        self.id = id
-        self.modified = modified
-        self.priority = priority
-        self.reps = reps
-        self.successive = successive
-        self.interval = interval
-        self.factId = factId
-        self.ordinal = ordinal
-        self.created = created
-    def __cmp__(self, other):
-        # order by priority, then relative delay
-        ret = cmp(other.priority, self.priority)
-        if ret != 0:
-            return ret
-        return cmp(self.interval / float(time.time() - self.due),
-                   other.interval / float(time.time() - other.due))
-
-# item in random acquisition queue
-class AcqRandomItem(object):
-    __slots__ = ['due', 'id', 'modified', 'priority', 'reps', 'successive', 'interval',
-                 'factId', 'ordinal', 'created']
-    def __init__(self, due, id, modified, priority, reps, successive, interval,
-                 factId, ordinal, created):
-        self.due = due
-        self.id = id
-        self.modified = modified
-        self.priority = priority
-        self.reps = reps
-        self.successive = successive
-        self.interval = interval
-        self.factId = factId
-        self.ordinal = ordinal
-        self.created = created
-    def __cmp__(self, other):
-        # order by priority, factId, ordinal
-        ret = cmp(other.priority, self.priority)
-        if ret != 0:
-            return ret
-        ret = cmp(self.factId, other.factId)
-        if ret != 0:
-            return ret
-        return cmp(self.ordinal, other.ordinal)
-
-# item in ordered acquisition queue
-class AcqOrderedItem(object):
-    __slots__ = ['due', 'id', 'modified', 'priority', 'reps', 'successive', 'interval',
-                 'factId', 'ordinal', 'created']
-    def __init__(self, due, id, modified, priority, reps, successive, interval,
-                 factId, ordinal, created):
-        self.due = due
-        self.id = id
-        self.modified = modified
-        self.priority = priority
-        self.reps = reps
-        self.successive = successive
-        self.interval = interval
-        self.factId = factId
-        self.ordinal = ordinal
-        self.created = created
-    def __cmp__(self, other):
-        # order by priority, due, ordinal
-        ret = cmp(other.priority, self.priority)
-        if ret != 0:
-            return ret
-        ret = cmp(self.created, other.created)
-        if ret != 0:
-            return ret
-        return cmp(self.ordinal, other.ordinal)
-
-# item in future queue
-class FutureItem(object):
-    __slots__ = ['due', 'id', 'modified', 'priority', 'reps', 'successive', 'interval',
-                 'factId', 'ordinal', 'created']
-    def __init__(self, due, id, modified, priority, reps, successive, interval,
-                 factId, ordinal, created):
-        self.due = due
-        self.id = id
-        self.modified = modified
-        self.priority = priority
-        self.reps = reps
-        self.successive = successive
-        self.interval = interval
-        self.factId = factId
-        self.ordinal = ordinal
-        self.created = created
-    def __cmp__(self, other):
-        return cmp(self.due, other.due)
+# Queue keys are computed as of a time, NOW.
+
+# failed & future queues: by due time
+def dueKey(item, now):
+    return (item.due, item)
+
+# revision queue: by priority, then delay relative to the interval
+def revKey(item, now):
+    return (-item.priority,
+            item.interval / max(now - item.due, 0.001), item)
+
+# random acquisition queue: by priority, factId, ordinal
+def acqRandomKey(item, now):
+    return (-item.priority, item.factId, item.ordinal, item)
+
+# ordered acquisition queue: by priority, created, ordinal
+def acqOrderedKey(item, now):
+    return (-item.priority, item.created, item.ordinal, item)
+
+class CardQueue(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.keyTime = time.time()
+        self.heap = []
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self.ids
+
+    def items(self):
+        return [e[-1] for e in self.ids.values()]
+
+    def push(self, item):
+        entry = self.key(item, self.keyTime)
+        self.ids[item.id] = entry
+        heappush(self.heap, entry)
+
+    def extend(self, items):
+        "Add ITEMS in bulk."
+        key = self.key
+        now = self.keyTime
+        entries = [key(item, now) for item in items]
+        ids = self.ids
+        for entry in entries:
+            ids[entry[-1].id] = entry
+        self.heap.extend(entries)
+        heapify(self.heap)
+
+    def peek(self):
+        "Return the first item without removing it, or None."
+        heap = self.heap
+        while heap and self.ids.get(heap[0][-1].id) is not heap[0]:
+            heappop(heap)
+        if heap:
+            return heap[0][-1]
+
+    def pop(self):
+        item = self.peek()
+        if item is not None:
+            heappop(self.heap)
+            del self.ids[item.id]
+        return item
+
+    def remove(self, id):
+        "Remove card ID if present. Return the removed item or None."
+        entry = self.ids.pop(id, None)
+        if entry is None:
+            return
+        if len(self.heap) > 2 * len(self.ids) + 100:
+            # too many stale entries; rebuild
+            self.heap = self.ids.values()
+            heapify(self.heap)
+        return entry[-1]
+
+    def rekey(self, now):
+        "Recompute the keys of the queued items as of NOW."
+        self.keyTime = now
+        items = self.items()
+        self.heap = []
+        self.ids = {}
+        self.extend(items)
+
+# The failed queue is a heap by due time. For each window (eg, delay0/1 or
+# the collapse time) it also keeps a heap by due time of the cards not yet
+# within now + window, a heap by modified time of those which are, and how
+# many of those are still queued. As time moves on, cards are promoted from
+# the first heap to the second, so counting the cards due soon is a lookup
+# and picking the oldest modified card is a heappop. Removed cards are left
+# in the heaps and skipped when they surface.
+
+class FailedQueue(object):
+
+    def __init__(self):
+        # [(due, id, item), ...]
+        self.due = []
+        self.ids = {}
+        # window -> [cutoff promoted up to, count, [(due, id, item), ...],
+        #            [(modified, id, item), ...]]
+        self.windows = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return id in self.ids
+
+    def items(self):
+        return self.ids.values()
+
+    def push(self, item):
+        self.remove(item.id)
+        self.ids[item.id] = item
+        heappush(self.due, (item.due, item.id, item))
+        for w in self.windows.values():
+            if item.due <= w[0]:
+                w[1] += 1
+                heappush(w[3], (item.modified, item.id, item))
+            else:
+                heappush(w[2], (item.due, item.id, item))
+
+    def extend(self, items):
+        "Add ITEMS in bulk."
+        for item in items:
+            self.remove(item.id)
+            self.ids[item.id] = item
+        self.due.extend([(item.due, item.id, item) for item in items])
+        heapify(self.due)
+        # windows will be rebuilt on next use
+        self.windows = {}
+
+    def peek(self):
+        "Return the first item without removing it, or None."
+        heap = self.due
+        while heap and self.ids.get(heap[0][1]) is not heap[0][2]:
+            heappop(heap)
+        if heap:
+            return heap[0][2]
+
+    def pop(self):
+        item = self.peek()
+        if item is not None:
+            self.remove(item.id)
+        return item
+
+    def remove(self, id):
+        "Remove card ID if present. Return the removed item or None."
+        item = self.ids.pop(id, None)
+        if item is None:
+            return
+        for w in self.windows.values():
+            if item.due <= w[0]:
+                w[1] -= 1
+        if len(self.due) > 2 * len(self.ids) + 100:
+            # too many stale entries; rebuild
+            self.due = [(i.due, i.id, i) for i in self.ids.values()]
+            heapify(self.due)
+        return item
+
+    def _window(self, now, window):
+        "Return WINDOW's state, with the cards due within NOW + WINDOW."
+        cutoff = now + window
+        w = self.windows.get(window)
+        if (not w or w[0] > cutoff or
+            len(w[2]) + len(w[3]) > 2 * len(self.ids) + 100):
+            # new window, or too many stale entries
+            pending = [(i.due, i.id, i) for i in self.ids.values()]
+            heapify(pending)
+            w = self.windows[window] = [-INF, 0, pending, []]
+        # promote any cards which have come within the window
+        (pending, heap) = (w[2], w[3])
+        while pending and pending[0][0] <= cutoff:
+            (due, id, item) = heappop(pending)
+            if self.ids.get(id) is item:
+                w[1] += 1
+                heappush(heap, (item.modified, id, item))
+        w[0] = cutoff
+        return w
+
+    def dueWithin(self, now, window):
+        "Number of cards due on or before NOW + WINDOW."
+        return self._window(now, window)[1]
+
+    def popOldestModified(self, now, window):
+        """Remove and return the least recently modified card due within
+        NOW + WINDOW, or None."""
+        heap = self._window(now, window)[3]
+        while heap:
+            (modified, id, item) = heappop(heap)
+            if self.ids.get(id) is item:
+                self.remove(id)
+                return item
 
 # Deck storage
 ##########################################################################
@@ -1300,6 +1787,9 @@ class DeckStorage(object):
             deck.needLock = lock
             deck.s = SessionHelper(s, lock=lock)
             DeckStorage._addViews(deck.s, create)
+            DeckStorage._addIndices(deck.s)
+            if not create:
+                DeckStorage._checkTagIndex(deck)
         except OperationalError, e:
             if (str(e.orig).startswith("database table is locked") or
                 str(e.orig).startswith("database is locked")):
@@ -1393,6 +1883,49 @@ cards.factId = facts.id
 and cards.priority != 0""")
     _addViews = staticmethod(_addViews)
 
+    def _addIndices(s):
+        "Add indices for scheduling and syncing, if they don't exist yet."
+        # due revision/acquisition cards, and future cards in a window
+        s.statement("""
+create index if not exists ix_cards_priorityDue on cards
+(priority, due, reps, successive, factId)""")
+        # failed cards
+        s.statement("""
+create index if not exists ix_cards_failed on cards
+(successive, reps, due, priority)""")
+        # spaced cards
+        s.statement("""
+create index if not exists ix_facts_spaceUntil on facts (spaceUntil)""")
+        # unique field checks
+        s.statement("""
+create index if not exists ix_fields_fieldModelIdValue on fields
+(fieldModelId, value)""")
+        # sync summaries: objects changed or deleted since the last sync
+        for (table, col) in (("cards", "id"), ("facts", "id"),
+                             ("models", "id")):
+            s.statement("""
+create index if not exists ix_%s_modified on %s (modified, %s)""" % (
+                table, table, col))
+        for (table, col) in (("cardsDeleted", "cardId"),
+                             ("factsDeleted", "factId"),
+                             ("modelsDeleted", "modelId")):
+            s.statement("""
+create index if not exists ix_%s_deletedTime on %s (deletedTime, %s)""" % (
+                table, table, col))
+        # sync history batches
+        s.statement("""
+create index if not exists ix_reviewHistory_time on reviewHistory
+(time, cardId)""")
+    _addIndices = staticmethod(_addIndices)
+
+    def _checkTagIndex(deck):
+        """Build the tag index of a deck from before it existed, or copied by
+        a version which doesn't keep it. Other decks aren't checked, so
+        opening them stays cheap."""
+        if deck.version < DECK_VERSION:
+            deck.rebuildTagIndex()
+    _checkTagIndex = staticmethod(_checkTagIndex)
+
     def backup(modified, path):
         # need a non-unicode path
         path = path.encode(sys.getfilesystemencoding())
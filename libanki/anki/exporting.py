@@ -14,11 +14,16 @@ from operator import itemgetter
 from anki import DeckStorage
 from anki.cards import Card
 from anki.sync import SyncClient, SyncServer
+from anki.transfer import exportDeck
 from anki.lang import _
 from anki.utils import findTag, parseTags, stripHTML
 from anki.db import *
 
 class Exporter(object):
+
+    # bytes of output to gather before writing
+    bufferSize = 65536
+
     def __init__(self, deck):
         self.deck = deck
         self.limitTags = []
@@ -36,11 +41,36 @@ class Exporter(object):
 
     def cardIds(self):
         "Return all cards, limited by tags."
-        tlist = self.deck.tagsList()
-        cards = [id for (id, tags, pri) in tlist if self.hasTags(tags)]
+        cards = self.deck.s.column0(self.cardIdQuery())
         self.count = len(cards)
         return cards
 
+    def cardIdQuery(self):
+        "Return SQL selecting the ids of all cards, limited by tags."
+        if self.limitTags:
+            return self.deck.cardIdsWithTagsQuery(u",".join(self.limitTags))
+        return "select id from cards"
+
+    def writeLines(self, file, lines):
+        """Write LINES to FILE as UTF-8, a buffer at a time, and return the
+        number written. Lines are separated, not terminated, by newlines."""
+        buf = []
+        size = 0
+        count = 0
+        for line in lines:
+            if count:
+                line = u"\n" + line
+            line = line.encode("utf-8")
+            buf.append(line)
+            size += len(line)
+            count += 1
+            if size >= self.bufferSize:
+                file.write("".join(buf))
+                buf = []
+                size = 0
+        file.write("".join(buf))
+        return count
+
     def hasTags(self, tags):
         tags = parseTags(tags)
         if not self.limitTags:
@@ -56,24 +86,21 @@ class AnkiExporter(Exporter):
     key = _("Anki decks (*.anki)")
     ext = ".anki"
 
+    # copy the deck in SQL, rather than through the sync code
+    bulkSQL = True
+
     def __init__(self, deck):
         Exporter.__init__(self, deck)
         self.includeSchedulingInfo = False
 
     def exportInto(self, path):
         self.newDeck = DeckStorage.Deck(path)
-        client = SyncClient(self.deck)
-        server = SyncServer(self.newDeck)
-        client.localTime = self.deck.modified
-        client.remoteTime = 0
-        self.deck.s.flush()
-        # set up a custom change list and sync
-        lsum = self.localSummary()
-        rsum = server.summary(0)
-        payload = client.genPayload(lsum, rsum)
-        res = server.applyPayload(payload)
-        client.applyPayloadReply(res)
+        if self.bulkSQL:
+            self.copyBySQL()
+        else:
+            self.copyBySync()
         if not self.includeSchedulingInfo:
+            self.newDeck.s.statement("delete from reviewHistory")
             self.newDeck.s.statement("""
 update cards set
 interval = 0,
@@ -110,6 +137,31 @@ modified = :now""", now=time.time())
         self.newDeck.s.commit()
         self.newDeck.close()
 
+    def copyBySQL(self):
+        "Copy the cards into the new deck with insert ... select."
+        if self.limitTags:
+            cardIds = self.cardIds()
+        else:
+            cardIds = None
+        self.deck.s.flush()
+        # the ORM's copy of the new deck is out of date afterwards
+        self.newDeck.s.clear()
+        exportDeck(self.newDeck, self.deck.path, cardIds)
+
+    def copyBySync(self):
+        "Copy the cards into the new deck as if syncing with it."
+        client = SyncClient(self.deck)
+        server = SyncServer(self.newDeck)
+        client.localTime = self.deck.modified
+        client.remoteTime = 0
+        self.deck.s.flush()
+        # set up a custom change list and sync
+        lsum = self.localSummary()
+        rsum = server.summary(0)
+        payload = client.genPayload(lsum, rsum)
+        res = server.applyPayload(payload)
+        client.applyPayloadReply(res)
+
     def localSummary(self):
         cardIds = self.cardIds()
         cards = self.deck.s.all("""
@@ -145,26 +197,25 @@ class TextCardExporter(Exporter):
         self.includeTags = False
 
     def doExport(self, file):
-        strids = ",".join([str(id) for id in self.cardIds()])
-        cards = self.deck.s.all("""
-select cards.question, cards.answer, cards.id from cards
-where cards.id in (%s)""" % strids)
         if self.includeTags:
-            self.cardTags = dict(self.deck.s.all("""
-select cards.id, cards.tags || "," || facts.tags from cards, facts
-where cards.factId = facts.id
-and cards.id in (%s)""" % strids))
-        out = u"\n".join(["%s\t%s%s" % (self.escapeText(c[0]),
-                                        self.escapeText(c[1]),
-                                        self.tags(c[2]))
-                          for c in cards])
-        if out:
-            out += "\n"
-        file.write(out.encode("utf-8"))
-
-    def tags(self, id):
+            rows = self.deck.s.iterate("""
+select cards.question, cards.answer, cards.tags || "," || facts.tags
+from cards, facts where cards.factId = facts.id
+and cards.id in (%s)""" % self.cardIdQuery())
+        else:
+            rows = self.deck.s.iterate("""
+select question, answer, '' from cards
+where id in (%s)""" % self.cardIdQuery())
+        self.count = self.writeLines(file, (
+            u"%s\t%s%s" % (self.escapeText(row[0]), self.escapeText(row[1]),
+                            self.tags(row[2]))
+            for row in rows))
+        if self.count:
+            file.write("\n")
+
+    def tags(self, tags):
         if self.includeTags:
-            return "\t" + ", ".join(parseTags(self.cardTags[id]))
+            return "\t" + ", ".join(parseTags(tags))
         return ""
 
 class TextFactExporter(Exporter):
@@ -177,30 +228,20 @@ class TextFactExporter(Exporter):
         self.includeTags = False
 
     def doExport(self, file):
-        cardIds = self.cardIds()
-        facts = self.deck.s.all("""
-select factId, value from fields
-where
-factId in
-(select distinct facts.id from facts, cards
-where facts.id = cards.factId
-and cards.id in (%s))
-order by factId, ordinal""" % ",".join([str(s) for s in cardIds]))
-        txt = ""
-        if self.includeTags:
-            self.factTags = dict(self.deck.s.all(
-                "select id, tags from facts where id in (%s)" %
-                ",".join([str(fact[0]) for fact in facts])))
-        out = ["\t".join([self.escapeText(x[1]) for x in ret[1]]) +
-               self.tags(ret[0])
-               for ret in (itertools.groupby(facts, itemgetter(0)))]
-        self.count = len(out)
-        out = "\n".join(out)
-        file.write(out.encode("utf-8"))
-
-    def tags(self, id):
+        rows = self.deck.s.iterate("""
+select fields.factId, fields.value, facts.tags from fields, facts
+where fields.factId = facts.id
+and facts.id in (select factId from cards where id in (%s))
+order by fields.factId, fields.ordinal""" % self.cardIdQuery())
+        self.count = self.writeLines(file, (
+            "\t".join([self.escapeText(x[1]) for x in group]) +
+            self.tags(group[0][2])
+            for group in (list(g) for (id, g) in
+                          itertools.groupby(rows, itemgetter(0)))))
+
+    def tags(self, tags):
         if self.includeTags:
-            return "\t" + self.factTags[id]
+            return "\t" + tags
         return ""
 
 # Export modules
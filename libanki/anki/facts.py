@@ -71,28 +71,37 @@ class Fact(object):
             for fm in model.fieldModels:
                 self.fields.append(Field(fm))
 
+    def fieldIndex(self):
+        """Return (names, dict of name -> Field). Built on first use, and
+        rebuilt when fields are added/removed or the model is modified."""
+        key = (id(self.fields), len(self.fields),
+               self.model and self.model.modified)
+        if getattr(self, '_fieldKey', None) != key:
+            names = [field.name for field in self.fields]
+            self._fieldIndex = (names, dict(zip(names, self.fields)))
+            self._fieldKey = key
+        return self._fieldIndex
+
     def keys(self):
-        return [field.name for field in self.fields]
+        return self.fieldIndex()[0][:]
 
     def values(self):
         return [field.value for field in self.fields]
 
+    def items(self):
+        return [(name, field.value) for (name, field) in
+                zip(self.fieldIndex()[0], self.fields)]
+
     def __getitem__(self, key):
-        try:
-            return [f.value for f in self.fields if f.name == key][0]
-        except IndexError:
-            raise KeyError
+        return self.fieldIndex()[1][key].value
 
     def __setitem__(self, key, value):
-        try:
-            [f for f in self.fields if f.name == key][0].value = value
-        except IndexError:
-            raise KeyError
+        self.fieldIndex()[1][key].value = value
 
     def get(self, key, default):
         try:
             return self[key]
-        except IndexError:
+        except KeyError:
             return default
 
     def css(self):
@@ -118,11 +127,11 @@ class Fact(object):
     def fieldUnique(self, field, s):
         if not field.fieldModel.unique:
             return True
-        req = ("select value from fields "
-               "where fieldModelId = :fmid and value = :val")
-        if field.id:
-            req += " and id != %s" % field.id
-        return not s.scalar(req, val=field.value, fmid=field.fieldModel.id)
+        # uses ix_fields_fieldModelIdValue
+        return not s.scalar(
+            "select 1 from fields where fieldModelId = :fmid "
+            "and value = :val and id != :id limit 1",
+            val=field.value, fmid=field.fieldModel.id, id=field.id or 0)
 
     def onSubmit(self):
         FeatureManager.run(self.model.features, "onSubmit", self)
@@ -135,9 +144,12 @@ class Fact(object):
         "Mark modified and update cards."
         self.modified = time.time()
         if textChanged:
+            fields = dict(self.items())
             for card in self.cards:
-                card.question = card.cardModel.renderQA(card, self, "question")
-                card.answer = card.cardModel.renderQA(card, self, "answer")
+                cm = card.cardModel
+                tags = cm.cardTags(card)
+                card.question = cm.renderFields(fields, tags, "question")
+                card.answer = cm.renderFields(fields, tags, "answer")
                 card.setModified()
 
 # Fact deletions
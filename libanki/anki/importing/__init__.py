@@ -10,17 +10,110 @@ Importing support
 To import, a mapping is created of the form: [FieldModel, ...]. The mapping
 may be extended by calling code if a file has more fields. To ignore a
 particular FieldModel, replace it with None. The same field model should not
-occur more than once."""
+occur more than once.
+
+Large files can be imported in batches by setting batchSize on the importer.
+Cards are then read one at a time from iterCards(), checked against the
+facts added so far, and added batchSize at a time in one transaction. If the
+import fails part way, the deck is rolled back, so batches are only used when
+the deck has no unsaved changes.
+
+Unique fields are checked with an index of their values, by default a set of
+digests held in memory. For decks too large for that, set uniqueIndex on the
+importer to TableIndex, which looks values up in the database instead."""
 
 __docformat__ = 'restructuredtext'
 
-import time
+import time, struct
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
 from anki.cards import cardsTable
 from anki.facts import factsTable, fieldsTable
 from anki.lang import _
-from anki.utils import genID
+from anki.utils import genIDs, parseTags
 from anki.errors import *
 
+# Uniqueness indexes
+##########################################################################
+# An index holds the values of one unique field: those in the deck, and those
+# added so far by the import. Importer.uniqueIndex picks the kind used.
+
+class UniqueIndex(object):
+    "The values of FIELDMODEL in DECK, held in a dict."
+
+    def __init__(self, deck, fieldModel):
+        self.deck = deck
+        self.fieldModel = fieldModel
+        self.values = {}
+        for value in self.deckValues():
+            self.add(value)
+
+    def deckValues(self):
+        "Yield the field's values in the deck, without loading them at once."
+        for row in self.deck.s.iterate(
+            "select value from fields where fieldModelId = :fmid",
+            fmid=self.fieldModel.id):
+            yield row[0]
+
+    def contains(self, value):
+        return value in self.values
+
+    def add(self, value):
+        self.values[value] = 1
+
+    def close(self):
+        self.values = {}
+
+class DigestIndex(UniqueIndex):
+    """The values held as 64 bit digests, which take a fixed, small amount of
+    memory however long the values are. Two different values match by chance
+    about once in 2^64 / (values in the deck) lookups."""
+
+    def contains(self, value):
+        return digest(value) in self.values
+
+    def add(self, value):
+        self.values[digest(value)] = 1
+
+class TableIndex(UniqueIndex):
+    """The values left in the database, for decks too big to index in
+    memory. Values are looked up in the fields table, and those added by the
+    import are kept in a temporary table until they've been written."""
+
+    def __init__(self, deck, fieldModel):
+        self.deck = deck
+        self.fieldModel = fieldModel
+        self.conn = deck.s.connection()
+        self.conn.execute("""
+create temporary table if not exists importValues
+(fieldModelId integer not null, value text not null,
+primary key (fieldModelId, value))""")
+        self.close()
+
+    def contains(self, value):
+        args = (self.fieldModel.id, value)
+        return bool(self.conn.execute("""
+select 1 from fields where fieldModelId = ? and value = ?
+union all
+select 1 from importValues where fieldModelId = ? and value = ?
+limit 1""", args + args).scalar())
+
+    def add(self, value):
+        self.conn.execute("insert or ignore into importValues values (?, ?)",
+                          (self.fieldModel.id, value))
+
+    def close(self):
+        self.conn.execute("delete from importValues where fieldModelId = ?",
+                          (self.fieldModel.id,))
+
+def digest(value):
+    "A 64 bit digest of the string VALUE."
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return struct.unpack("<q", sha1(value).digest()[:8])[0]
+
 # Base importer
 ##########################################################################
 
@@ -35,6 +128,8 @@ class Importer(object):
     needMapper = True
     tagDuplicates = False
     multipleCardsAllowed = True
+    # the values of unique fields are checked against one of these
+    uniqueIndex = DigestIndex
 
     def __init__(self, deck, file):
         self.file = file
@@ -44,9 +139,20 @@ class Importer(object):
         self.deck = deck
         self.total = 0
         self.tagsToAdd = u""
+        # if set, stream the cards in batches of this many
+        self.batchSize = 0
+        # if set, called after each batch with (processed, skipped, rate)
+        self.progress = None
+        # lines the importer couldn't read
+        self.ignored = 0
 
     def doImport(self):
         "Import."
+        if self.batchSize and not self.deck.modifiedSinceSave():
+            self.importStream(self.iterCards())
+            if self.total:
+                self.deck.setModified()
+            return
         c = self.foreignCards()
         self.importCards(c)
         if c:
@@ -60,6 +166,11 @@ class Importer(object):
         "Return a list of foreign cards for importing."
         assert 0
 
+    def iterCards(self):
+        """Yield the foreign cards for importing. Importers which can read a
+        card at a time override this."""
+        return iter(self.foreignCards())
+
     def resetMapping(self):
         "Reset mapping to default."
         numFields = self.fields()
@@ -94,6 +205,71 @@ class Importer(object):
 
     def importCards(self, cards):
         "Convert each card into a fact, apply attributes and add to deck."
+        self.checkModel()
+        # strip invalid cards
+        cards = self.stripInvalid(cards)
+        cards = self.stripOrTagDupes(cards)
+        if cards:
+            self.addCards(cards)
+
+    def importStream(self, cards):
+        """Like importCards(), but for an iterator of CARDS. They're checked
+        as they're read, and added batchSize at a time. The deck must have no
+        unsaved changes, as they'd be rolled back with a failed import."""
+        self.checkModel()
+        self.initUniqueCache()
+        self.initImportIds()
+        self.processed = 0
+        self.skipped = 0
+        start = time.time()
+        added = 0
+        try:
+            for batch in self.buildBatches(cards):
+                self.insertBatch(batch)
+                added += len(batch['factIds'])
+                self.reportProgress(batch['processed'], batch['skipped'],
+                                    start)
+        except:
+            # don't leave the batches already written to be saved
+            self.deck.rollback()
+            raise
+        finally:
+            self.closeUniqueCache()
+        self.reportProgress(self.processed, self.skipped, start)
+        self.total = added
+
+    def buildBatches(self, cards):
+        "Check CARDS, and yield them in batches prepared by buildBatch()."
+        batch = []
+        for card in cards:
+            self.processed += 1
+            if self.cardIsValid(card) and self.cardIsUnique(card):
+                batch.append(card)
+            else:
+                self.skipped += 1
+            if len(batch) >= self.batchSize:
+                yield self.countedBatch(batch)
+                batch = []
+        if batch:
+            yield self.countedBatch(batch)
+
+    def countedBatch(self, cards):
+        "Build a batch, noting how far through the input it got."
+        batch = self.buildBatch(cards)
+        batch['processed'] = self.processed
+        batch['skipped'] = self.skipped
+        return batch
+
+    def reportProgress(self, processed, skipped, start):
+        "Call the progress callback, counting lines which couldn't be read."
+        if not self.progress:
+            return
+        processed += self.ignored
+        skipped += self.ignored
+        self.progress(processed, skipped,
+                      processed / max(time.time() - start, 0.001))
+
+    def checkModel(self):
         # ensure all unique and required fields are mapped
         for fm in self.model.fieldModels:
             if fm.required or fm.unique:
@@ -110,54 +286,117 @@ class Importer(object):
                 info=_("""
 The current importer only supports a single active card model. Please disable
 all but one card model."""))
-        # strip invalid cards
-        cards = self.stripInvalid(cards)
-        cards = self.stripOrTagDupes(cards)
-        if cards:
-            self.addCards(cards)
 
     def addCards(self, cards):
         "Add facts in bulk from foreign cards."
-        # add facts
-        factIds = [genID() for n in range(len(cards))]
-        self.deck.s.execute(factsTable.insert(),
-            [{'modelId': self.model.id,
-              'tags': self.tagsToAdd,
-              'id': factIds[n]} for n in range(len(cards))])
-        self.deck.s.execute("""
-delete from factsDeleted
-where factId in (%s)""" % ",".join([str(s) for s in factIds]))
-        # add all the fields
+        self.insertBatch(self.buildBatch(cards))
+
+    def buildBatch(self, cards):
+        """Prepare the rows which add CARDS. Ids are allocated in blocks and
+        the cards are rendered from the foreign fields, without the deck."""
+        inserts = []
+        # facts
+        factIds = genIDs(len(cards))
+        modelId = self.model.id
+        inserts.append(self.insertStatement(factsTable, [{
+            'modelId': modelId,
+            'tags': self.tagsToAdd,
+            'id': id} for id in factIds]))
+        # all the fields
+        fields = [{} for m in range(len(cards))]
         for fm in self.model.fieldModels:
             try:
                 index = self.mapping.index(fm)
             except ValueError:
                 index = None
+            ids = genIDs(len(cards))
+            (fmId, ordinal) = (fm.id, fm.ordinal)
             data = [{'factId': factIds[m],
-                     'fieldModelId': fm.id,
-                     'ordinal': fm.ordinal,
-                     'id': genID(),
+                     'fieldModelId': fmId,
+                     'ordinal': ordinal,
+                     'id': ids[m],
                      'value': (index is not None and
                                cards[m].fields[index] or u"")}
                     for m in range(len(cards))]
-            self.deck.s.execute(fieldsTable.insert(),
-                                data)
+            inserts.append(self.insertStatement(fieldsTable, data))
+            for m in range(len(cards)):
+                fields[m][fm.name] = data[m]['value']
         # and cards
         now = time.time()
+        cardIds = []
         for cm in self.model.cardModels:
             self._now = now
             if cm.active:
+                tags = "," + self.tagsToAdd + "," + cm.name + "," + (
+                    self.model.tags)
+                tags = [", ".join(parseTags(cards[m].tags + tags))
+                        for m in range(len(cards))]
+                ids = genIDs(len(cards))
+                (cmId, ordinal) = (cm.id, cm.ordinal)
                 data = [self.addMeta({
-                    'id': genID(),
+                    'id': ids[m],
                     'factId': factIds[m],
-                    'cardModelId': cm.id,
-                    'ordinal': cm.ordinal,
-                    'question': cm.renderQASQL('q', factIds[m]),
-                    'answer': cm.renderQASQL('a', factIds[m]),
+                    'cardModelId': cmId,
+                    'ordinal': ordinal,
+                    'question': cm.renderFields(fields[m], tags[m], "question"),
+                    'answer': cm.renderFields(fields[m], tags[m], "answer"),
                          }, cards[m]) for m in range(len(cards))]
-                self.deck.s.execute(cardsTable.insert(),
-                                    data)
-        self.total = len(factIds)
+                inserts.append(self.insertStatement(cardsTable, data))
+                cardIds.extend(ids)
+        return {'factIds': factIds, 'cardIds': cardIds, 'inserts': inserts}
+
+    def insertBatch(self, batch):
+        "Write a batch prepared by buildBatch() to the deck."
+        self.deck.s.flush()
+        conn = self.deck.s.connection()
+        for (sql, rows) in batch['inserts']:
+            conn.execute(sql, rows)
+        self.purgeDeleted(batch['factIds'])
+        self.deck.updateTagIndex(batch['cardIds'], batch['factIds'])
+        self.total = len(batch['factIds'])
+
+    def insertStatement(self, table, rows):
+        """Return (sql, tuples) inserting ROWS, a list of dicts, into TABLE.
+        Plain tuples are used as SQLAlchemy's per-row handling of defaults is
+        slow. Columns missing from a row are given their default, evaluated
+        once."""
+        keys = set()
+        for row in rows:
+            keys.update(row.keys())
+        cols = []
+        for c in table.columns:
+            if c.name in keys or c.default is not None:
+                default = c.default and c.default.arg
+                if callable(default):
+                    default = default(None)
+                cols.append((c.name, default))
+        sql = "insert into %s (%s) values (%s)" % (
+            table.name, ", ".join([c[0] for c in cols]),
+            ", ".join(["?"] * len(cols)))
+        return (sql, [tuple([row.get(name, default)
+                             for (name, default) in cols])
+                      for row in rows])
+
+    def initImportIds(self):
+        """Create the temporary table used by purgeDeleted() if it's missing.
+        Creating a table commits the open transaction, so importStream() does
+        this before writing anything."""
+        s = self.deck.s
+        if not s.scalar("select 1 from sqlite_temp_master "
+                        "where name = 'importIds'"):
+            s.statement("create temporary table importIds "
+                        "(id integer primary key)")
+
+    def purgeDeleted(self, factIds):
+        """Remove FACTIDS from factsDeleted. The ids are joined from a
+        temporary table, as a literal list can exceed SQLite's limits."""
+        s = self.deck.s
+        self.initImportIds()
+        s.connection().execute("insert into importIds values (?)",
+                               [(id,) for id in factIds])
+        s.statement("delete from factsDeleted where factId in "
+                    "(select id from importIds)")
+        s.statement("delete from importIds")
 
     def addMeta(self, data, card):
         "Add any scheduling metadata to cards"
@@ -185,32 +424,41 @@ where factId in (%s)""" % ",".join([str(s) for s in factIds]))
         return True
 
     def stripOrTagDupes(self, cards):
-        # build a cache of items
+        self.initUniqueCache()
+        try:
+            return [c for c in cards if self.cardIsUnique(c)]
+        finally:
+            self.closeUniqueCache()
+
+    def initUniqueCache(self):
+        "Build an index of the values of each unique field."
         self.uniqueCache = {}
-        for field in self.mapping:
+        self.uniqueFields = []
+        for (n, field) in enumerate(self.mapping):
             if field and field.unique:
-                self.uniqueCache[field.id] = self.getUniqueCache(field)
-        return [c for c in cards if self.cardIsUnique(c)]
+                if field.id not in self.uniqueCache:
+                    self.uniqueCache[field.id] = self.uniqueIndex(
+                        self.deck, field)
+                self.uniqueFields.append(
+                    (n, field.name, self.uniqueCache[field.id]))
 
-    def getUniqueCache(self, field):
-        "Return a dict with all fields, to test for uniqueness."
-        return dict(self.deck.s.all(
-            "select value, 1 from fields where fieldModelId = :fmid",
-            fmid=field.id))
+    def closeUniqueCache(self):
+        for index in self.uniqueCache.values():
+            index.close()
+        self.uniqueCache = {}
 
     def cardIsUnique(self, card):
         fields = []
-        for n in range(len(self.mapping)):
-            if self.mapping[n] and self.mapping[n].unique:
-                if card.fields[n] in self.uniqueCache[self.mapping[n].id]:
-                    if not self.tagDuplicates:
-                        self.log.append("Fact has duplicate '%s': %s" %
-                                        (self.mapping[n].name,
-                                         ", ".join(card.fields)))
-                        return False
-                    fields.append(self.mapping[n].name)
-                else:
-                    self.uniqueCache[self.mapping[n].id][card.fields[n]] = 1
+        for (n, name, index) in self.uniqueFields:
+            value = card.fields[n]
+            if index.contains(value):
+                if not self.tagDuplicates:
+                    self.log.append("Fact has duplicate '%s': %s" %
+                                    (name, ", ".join(card.fields)))
+                    return False
+                fields.append(name)
+            else:
+                index.add(value)
         if fields:
             card.tags += u"Import: duplicate, Duplicate: " + (
                 "+".join(fields))
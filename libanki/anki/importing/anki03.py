@@ -277,6 +277,7 @@ class Anki03Importer(Importer):
         s.save(stats)
         # ignore daily stats & history, they make no sense on new version
         s.flush()
+        deck.rebuildTagIndex()
         deck.updateAllPriorities()
         # save without updating mod time
         deck.modified = oldDeck.modified
@@ -12,13 +12,42 @@ __docformat__ = 'restructuredtext'
 from anki import DeckStorage
 from anki.importing import Importer
 from anki.sync import SyncClient, SyncServer
+from anki.transfer import importDeck
 
 class Anki10Importer(Importer):
 
     needMapper = False
+    # copy the deck in SQL, rather than through the sync code, when the deck
+    # being imported into has no unsaved changes
+    bulkSQL = True
 
     def doImport(self):
         "Import."
+        if self.bulkSQL and not self.deck.modifiedSinceSave():
+            fids = self.importBySQL()
+        else:
+            fids = self.importBySync()
+        # add tags
+        self.deck.addFactTags(fids, self.tagsToAdd)
+        self.total = len(fids)
+        self.deck.flushMod()
+
+    def importBySQL(self):
+        """Copy the new objects with insert ... select, and return the ids of
+        the added facts. The deck is saved."""
+        # bring the file up to date
+        DeckStorage.Deck(self.file, rebuild=False, backup=False).close()
+        (fids, cids) = importDeck(self.deck, self.file)
+        # reload the models, and add the cards to the queue
+        self.deck.s.refresh(self.deck)
+        self.deck.refreshQueueCards(cids)
+        # attaching committed, and released the deck's lock
+        self.deck.s.commit()
+        return fids
+
+    def importBySync(self):
+        """Add the new objects by syncing with the file, and return the ids
+        of the added facts."""
         src = DeckStorage.Deck(self.file)
         client = SyncClient(self.deck)
         server = SyncServer(src)
@@ -42,9 +71,5 @@ class Anki10Importer(Importer):
         payload['deleted-models'] = []
         res = server.applyPayload(payload)
         client.applyPayloadReply(res)
-        # add tags
-        fids = [f[0] for f in res['added-facts']['facts']]
-        self.deck.addFactTags(fids, self.tagsToAdd)
-        self.total = len(res['added-facts']['facts'])
         src.s.rollback()
-        self.deck.flushMod()
+        return [f[0] for f in res['added-facts']['facts']]
@@ -23,13 +23,15 @@ class TextImporter(Importer):
         self.lines = None
 
     def foreignCards(self):
+        return list(self.iterCards())
+
+    def iterCards(self):
         self.parseTopLine()
         # process all lines
-        log = []
-        cards = []
+        self.log = []
+        self.ignored = 0
         lineNum = 0
-        ignored = 0
-        for line in self.lines:
+        for line in self.fileLines():
             lineNum += 1
             if not line.strip():
                 # ignore blank lines
@@ -37,36 +39,30 @@ class TextImporter(Importer):
             try:
                 fields = self.parseLine(line)
             except ValueError:
-                log.append(_("Line %(line)d doesn't match pattern '%(pat)s'")
-                           % {
+                self.log.append(
+                    _("Line %(line)d doesn't match pattern '%(pat)s'") % {
                     'line': lineNum,
-                    'pat': pattern,
+                    'pat': self.pattern,
                     })
-                ignored += 1
+                self.ignored += 1
                 continue
             if len(fields) != self.numFields:
-                log.append(_(
+                self.log.append(_(
                     "Line %(line)d had %(num1)d fields,"
                     " expected %(num2)d") % {
                     "line": lineNum,
                     "num1": len(fields),
                     "num2": self.numFields,
                     })
-                ignored += 1
+                self.ignored += 1
                 continue
-            card = self.cardFromFields(fields)
-            cards.append(card)
-        self.log = log
-        self.ignored = ignored
-        return cards
+            yield self.cardFromFields(fields)
 
     def parseTopLine(self):
         "Parse the top line and determine the pattern and number of fields."
-        # load & look for the right pattern
-        self.cacheFile()
         # look for the first non-blank line
         l = None
-        for line in self.lines:
+        for line in self.fileLines():
             ret = line.strip()
             if ret:
                 l = line
@@ -91,25 +87,42 @@ class TextImporter(Importer):
         self.pattern = pattern
         self.setNumFields(line)
 
+    def fileLines(self):
+        """Return the lines of the file. When importing in batches, they're
+        read as they're used rather than kept in self.lines."""
+        if self.batchSize and not self.lines:
+            return self.iterFile()
+        self.cacheFile()
+        return self.lines
+
     def cacheFile(self):
         "Read file into self.lines if not already there."
         if not self.lines:
             self.lines = self.readFile()
 
     def readFile(self):
+        return list(self.iterFile())
+
+    def iterFile(self):
+        "Yield the lines of the file, without comments."
         f = codecs.open(self.file, encoding="utf-8")
         try:
-            data = f.readlines()
-        except UnicodeDecodeError, e:
-            raise ImportFormatError(type="encodingError",
-                                    info=_("The file was not in UTF8 format."))
-        if not data:
-            return []
-        if data[0].startswith(unicode(codecs.BOM_UTF8, "utf8")):
-            data[0] = data[0][1:]
-        # remove comment char
-        lines = [l for l in data if not l.lstrip().startswith("#")]
-        return lines
+            first = True
+            try:
+                for line in f:
+                    if first:
+                        if line.startswith(unicode(codecs.BOM_UTF8, "utf8")):
+                            line = line[1:]
+                        first = False
+                    # remove comment char
+                    if not line.lstrip().startswith("#"):
+                        yield line
+            except UnicodeDecodeError, e:
+                raise ImportFormatError(
+                    type="encodingError",
+                    info=_("The file was not in UTF8 format."))
+        finally:
+            f.close()
 
     def fields(self):
         "Number of fields."
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+Media - files referenced by facts
+==================================
+
+Media files are stored in the deck's media directory under the SHA1 of their
+content, plus the original extension, so adding the same file twice stores it
+once. The media table records each file's checksum and size, so that syncing
+can tell which files a peer lacks without reading them, and how many fields
+refer to it, as of the last rebuildMedia().
+
+Files are never changed once stored, so copies of the media directory can be
+hard links to the same files.
+"""
+__docformat__ = 'restructuredtext'
+
+import os, re, shutil, time
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+from anki.db import *
+
+mediaTable = Table(
+    'media', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('filename', UnicodeText, nullable=False, unique=True),
+    Column('size', Integer, nullable=False),
+    Column('created', Float, nullable=False, default=time.time),
+    # SHA1 of the content, in hex
+    Column('checksum', UnicodeText, nullable=False, index=True),
+    # fields referring to the file
+    Column('refCount', Integer, nullable=False, default=0))
+
+# references in field values
+mediaRegexps = (
+    re.compile(r"(?i)<img[^>]+src=[\"']?([^\"'>]+)"),
+    re.compile(r"\[sound:(.+?)\]"))
+
+def checksum(path):
+    "Return the SHA1 of the file PATH, in hex."
+    h = sha1()
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return unicode(h.hexdigest())
+
+def dataChecksum(data):
+    "Return the SHA1 of the string DATA, in hex."
+    return unicode(sha1(data).hexdigest())
+
+def addMedia(deck, path):
+    """Copy PATH into DECK's media directory, named by its checksum, and
+    return the new name. If the same content is already stored, it's used."""
+    dir = deck.mediaDir(create=True)
+    sum = checksum(path)
+    name = sum + os.path.splitext(path)[1].lower()
+    location = os.path.join(dir, name)
+    if not os.path.exists(location):
+        # not a link: the original may be changed later
+        shutil.copy(path, location)
+    registerMedia(deck, name, sum, os.path.getsize(location))
+    return name
+
+def addMediaData(deck, name, sum, data):
+    """Store the string DATA as NAME in DECK's media directory. It's written
+    to a temporary file first, so a partial file never has the name."""
+    dir = deck.mediaDir(create=True)
+    tmp = os.path.join(dir, ".%s.tmp" % name)
+    f = open(tmp, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp, os.path.join(dir, name))
+    registerMedia(deck, name, sum, len(data))
+
+def linkMediaFile(deck, name, sum):
+    """Add NAME to DECK as a link to the stored file with checksum SUM.
+    Return False if there's no such file."""
+    other = deck.s.scalar("select filename from media where checksum = :sum",
+                          sum=sum)
+    if other is None:
+        return False
+    dir = deck.mediaDir()
+    linkFile(os.path.join(dir, other), os.path.join(dir, name))
+    registerMedia(deck, name, sum, os.path.getsize(os.path.join(dir, name)))
+    return True
+
+def registerMedia(deck, name, sum, size):
+    "Record NAME in the media table, if it isn't already."
+    if deck.s.scalar("select 1 from media where filename = :name",
+                     name=name):
+        return
+    deck.s.statement("""
+insert into media (filename, size, created, checksum, refCount)
+values (:name, :size, :created, :sum, 0)""", name=name, size=size,
+                     created=time.time(), sum=sum)
+
+def linkFile(src, dst):
+    "Hard link SRC to DST, or copy it where links aren't supported."
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        shutil.copy2(src, dst)
+
+def copyMediaDir(src, dst):
+    "Copy the files in the media directory SRC to DST, as links if possible."
+    for name in os.listdir(src):
+        path = os.path.join(src, name)
+        if os.path.isfile(path) and not os.path.exists(
+            os.path.join(dst, name)):
+            linkFile(path, os.path.join(dst, name))
+
+def scanMedia(deck):
+    """Bring the media table up to date with the media directory: files
+    which were added outside addMedia() are checksummed and recorded, and
+    the records of missing files are removed. Known files aren't read."""
+    dir = deck.mediaDir()
+    if not dir:
+        files = set()
+    else:
+        files = set([f for f in os.listdir(dir) if not f.startswith(".")
+                     and os.path.isfile(os.path.join(dir, f))])
+    known = set(deck.s.column0("select filename from media"))
+    gone = known - files
+    if gone:
+        deck.s.statements("delete from media where filename = :name",
+                          [{'name': name} for name in gone])
+    for name in files - known:
+        path = os.path.join(dir, name)
+        registerMedia(deck, name, checksum(path), os.path.getsize(path))
+
+def mediaRefs(text):
+    "Return the media filenames referred to in TEXT."
+    refs = []
+    for regexp in mediaRegexps:
+        refs.extend(regexp.findall(text))
+    return refs
+
+def rebuildMedia(deck):
+    """Scan the media directory and count the references to each file in
+    the deck's fields. Return the names of files which aren't referred to."""
+    scanMedia(deck)
+    counts = {}
+    for value in deck.s.column0("select value from fields"):
+        if value:
+            for name in mediaRefs(value):
+                counts[name] = counts.get(name, 0) + 1
+    deck.s.statement("update media set refCount = 0")
+    refs = [{'name': name, 'count': count}
+            for (name, count) in counts.items()]
+    if refs:
+        deck.s.statements("""
+update media set refCount = :count where filename = :name""", refs)
+    return deck.s.column0(
+        "select filename from media where refCount = 0 order by filename")
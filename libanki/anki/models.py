@@ -13,7 +13,7 @@ Model - define the way in which facts are added and shown
 
 """
 
-import time
+import time, re
 from sqlalchemy.ext.orderinglist import ordering_list
 from anki.db import *
 from anki.utils import genID
@@ -72,6 +72,50 @@ class FieldModel(object):
 
 mapper(FieldModel, fieldModelsTable)
 
+# Card templates
+##########################################################################
+
+class Template(object):
+    "A question/answer format, parsed once for the keys it uses."
+
+    def __init__(self, format):
+        self.format = format
+        self.keys = []
+        for key in set(re.findall(r"%\(([^)]*)\)", format)):
+            if key.startswith("text:"):
+                self.keys.append((key, key[5:], False))
+            else:
+                self.keys.append((key, key, True))
+
+    def render(self, fields, tags, html=False):
+        """Fill in the format from FIELDS, a dict of name -> value, and the
+        tag string TAGS. Field values are wrapped in a span if HTML."""
+        d = {}
+        for (key, name, wrap) in self.keys:
+            if name == "tags":
+                v = tags
+            elif name in fields:
+                v = fields[name]
+            else:
+                continue
+            if html and wrap and v:
+                v = '<span class="%s">%s</span>' % (
+                    name.replace(" ", ""), v.replace("\n", "<br>"))
+            d[key] = v
+        return self.format % d
+
+_templates = {}
+
+def compileTemplate(format):
+    "Return the Template for FORMAT, parsing it only the first time."
+    try:
+        return _templates[format]
+    except KeyError:
+        if len(_templates) > 500:
+            _templates.clear()
+        t = _templates[format] = Template(format)
+        return t
+
 # Card models
 ##########################################################################
 
@@ -121,36 +165,30 @@ class CardModel(object):
 
     def renderQA(self, card, fact, type, format="text"):
         "Render fact into card based on card model."
+        return self.renderFields(dict(fact.items()), self.cardTags(card),
+                                 type, format)
+
+    def cardTags(self, card):
+        "Return the tags of CARD's card, fact, card model and model."
+        return ", ".join(parseTags(card.tags + "," +
+                                   card.fact.tags + "," +
+                                   card.cardModel.name + "," +
+                                   card.fact.model.tags))
+
+    def renderFields(self, fields, tags, type, format="text"):
+        """Render FIELDS, a dict of name -> value, and the tag string TAGS
+        into a question or answer. The result is the same as renderQA()."""
         if type == "question": field = self.qformat
         elif type == "answer": field = self.aformat
-        htmlFields = {}
-        htmlFields.update(fact)
-        alltags = parseTags(card.tags + "," +
-                            card.fact.tags + "," +
-                            card.cardModel.name + "," +
-                            card.fact.model.tags)
-        htmlFields['tags'] = ", ".join(alltags)
-        textFields = {}
-        textFields.update(htmlFields)
-        # add per-field formatting
-        for (k, v) in htmlFields.items():
-            # generate pure text entries
-            htmlFields["text:"+k] = v
-            textFields["text:"+k] = v
-            if v:
-                # convert newlines to html & add spans to fields
-                v = v.replace("\n", "<br>")
-                htmlFields[k] = '<span class="%s">%s</span>' % (k.replace(" ",""), v)
+        template = compileTemplate(field)
         try:
-            html = field % htmlFields
-            text = field % textFields
+            html = template.render(fields, tags, html=(format != "text"))
         except (KeyError, TypeError, ValueError):
             return _("[invalid format; see model properties]")
         if not html:
             html = _("[empty]")
-            text = _("[empty]")
         if format == "text":
-            return text
+            return html
         # add outer div & alignment (with tables due to qt's html handling)
         html = '<div class="%s">%s</div>' % (type, html)
         attr = type + 'Align'
@@ -18,22 +18,297 @@ applyPayload(payload): apply any sent changes and return any changed remote
                        objects
 createDeck(name): create a deck on the server
 
+For large decks, the client can instead exchange changes in batches (see
+SyncTools.chunkSize), using:
+
+applyChunk(chunk): apply and flush one batch of changes
+getChunk(request): return one batch of changed objects
+finishChunks(): refresh the deck after the last batch
+
+From protocol 4, media files are synced after the deck:
+
+mediaSummary(): a list of the server's media files and their checksums
+getMedia(names): return a batch of media files
+addMedia(files): store a batch of media files
+
+The batches can also be pipelined (see SyncTools.pipelined), with the calls
+to the server made on other threads while the deck is read and written.
+
 """
 __docformat__ = 'restructuredtext'
 
-import zlib, re, urllib, urllib2, socket, simplejson, time
+import zlib, re, socket, simplejson, time, struct, os, sys
+import httplib, urlparse, threading, random, Queue
 from datetime import date
-import anki, anki.deck, anki.cards
+import anki, anki.deck, anki.cards, anki.media
+from anki.db import *
 from anki.errors import *
 from anki.models import Model, FieldModel, CardModel
 from anki.facts import Fact, Field
 from anki.cards import Card
-from anki.stats import Stats, globalStats
+from anki.stats import Stats, globalStats, statsTable
 from anki.history import CardHistoryEntry
 
 if simplejson.__version__ < "1.7.3":
     raise "SimpleJSON must be 1.7.3 or later."
 
+# Binary rows
+##########################################################################
+# From protocol 3, card, fact and field rows are sent packed by column: ints
+# and floats as little-endian arrays, strings as an array of lengths followed
+# by the UTF-8 data. Columns containing NULLs are preceded by a null mask.
+
+# column types of getCards(), getFacts()['facts'] and ['fields']
+cardTypes = "qqqddsiiddddddiiddiiiiiiiiiiiissd"
+factTypes = "qqddsdq"
+fieldTypes = "qqqis"
+
+BINARY_MAGIC = "AnkiRows"
+
+class PackedRows(object):
+    "Rows packed by packRows(), sent outside the JSON part of a payload."
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        "The number of rows."
+        return struct.unpack_from("<I", self.data)[0]
+
+class Blob(object):
+    "A byte string, such as a media file, sent outside the JSON part."
+
+    def __init__(self, data):
+        self.data = data
+
+def packRows(rows, types):
+    "Pack ROWS, whose columns are of the struct types TYPES or 's'."
+    n = len(rows)
+    out = [struct.pack("<IB", n, len(types)), types]
+    if not n:
+        return "".join(out)
+    for (type, col) in zip(types, zip(*rows)):
+        if None in col:
+            out.append("\x01")
+            out.append(struct.pack("<%dB" % n, *[v is None for v in col]))
+            col = list(col)
+            for i in range(n):
+                if col[i] is None:
+                    col[i] = type == "s" and u"" or 0
+        else:
+            out.append("\x00")
+        if type == "s":
+            col = [v.encode("utf-8") for v in col]
+            out.append(struct.pack("<%dI" % n, *[len(v) for v in col]))
+            out.append("".join(col))
+        else:
+            out.append(struct.pack("<%d%s" % (n, type), *col))
+    return "".join(out)
+
+def unpackRows(data):
+    "Return the list of row tuples packed in DATA."
+    (n, ncols) = struct.unpack_from("<IB", data)
+    pos = 5
+    types = data[pos:pos+ncols]
+    pos += ncols
+    if not n:
+        return []
+    cols = []
+    for type in types:
+        nulls = data[pos] == "\x01"
+        pos += 1
+        if nulls:
+            nulls = struct.unpack_from("<%dB" % n, data, pos)
+            pos += n
+        if type == "s":
+            lengths = struct.unpack_from("<%dI" % n, data, pos)
+            pos += 4 * n
+            col = []
+            for l in lengths:
+                col.append(data[pos:pos+l].decode("utf-8"))
+                pos += l
+        else:
+            col = struct.unpack_from("<%d%s" % (n, type), data, pos)
+            pos += struct.calcsize("<%d%s" % (n, type))
+        if nulls:
+            col = list(col)
+            for i in range(n):
+                if nulls[i]:
+                    col[i] = None
+        cols.append(col)
+    return zip(*cols)
+
+def dumpBinary(data):
+    """Serialize DATA as JSON, with any PackedRows and Blobs appended after
+    it as length-prefixed blobs."""
+    blobs = []
+    def default(obj):
+        if isinstance(obj, PackedRows):
+            key = "__rows__"
+        elif isinstance(obj, Blob):
+            key = "__blob__"
+        else:
+            raise TypeError(repr(obj))
+        blobs.append(obj.data)
+        return {key: len(blobs) - 1}
+    env = simplejson.dumps(data, default=default)
+    out = [BINARY_MAGIC, struct.pack("<I", len(env)), env]
+    for blob in blobs:
+        out.append(struct.pack("<I", len(blob)))
+        out.append(blob)
+    return "".join(out)
+
+def loadBinary(data):
+    "Reverse dumpBinary()."
+    pos = len(BINARY_MAGIC)
+    (size,) = struct.unpack_from("<I", data, pos)
+    pos += 4
+    env = data[pos:pos+size]
+    pos += size
+    blobs = []
+    while pos < len(data):
+        (size,) = struct.unpack_from("<I", data, pos)
+        pos += 4
+        blobs.append(data[pos:pos+size])
+        pos += size
+    def hook(obj):
+        if len(obj) == 1:
+            if "__rows__" in obj:
+                return PackedRows(blobs[obj["__rows__"]])
+            if "__blob__" in obj:
+                return Blob(blobs[obj["__blob__"]])
+        return obj
+    return simplejson.loads(env, object_hook=hook)
+
+# Diffing
+##########################################################################
+
+def mergeSorted(a, b):
+    """Walk A and B, lists of (id, value) with unique ids, in id order,
+    yielding (id, aValue, bValue), where a missing value is None. The lists
+    are sorted in place, which is cheap if they're already in order."""
+    a.sort()
+    b.sort()
+    (i, j) = (0, 0)
+    (na, nb) = (len(a), len(b))
+    while i < na and j < nb:
+        x = a[i]
+        y = b[j]
+        if x[0] == y[0]:
+            yield (x[0], x[1], y[1])
+            i += 1
+            j += 1
+        elif x[0] < y[0]:
+            yield (x[0], x[1], None)
+            i += 1
+        else:
+            yield (y[0], None, y[1])
+            j += 1
+    for x in a[i:]:
+        yield (x[0], x[1], None)
+    for y in b[j:]:
+        yield (y[0], None, y[1])
+
+# Pipelines
+##########################################################################
+# A deck can only be used by the thread which opened it, so a pipelined sync
+# reads and writes the deck on the calling thread, and hands server calls to
+# these. Without THREADED, they do the work on the calling thread instead.
+
+class SyncSender(threading.Thread):
+    """Call FN on each item put(), in order, on another thread. An error is
+    raised by the next put() or finish()."""
+
+    def __init__(self, fn, threaded=True, depth=2):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.fn = fn
+        self.threaded = threaded
+        self.items = Queue.Queue(depth)
+        self.error = None
+        if threaded:
+            self.start()
+
+    def put(self, item):
+        self.check()
+        if self.threaded:
+            self.items.put(item)
+        else:
+            self.fn(item)
+
+    def finish(self):
+        "Wait until every item has been handled."
+        self.stop()
+        self.check()
+
+    def stop(self):
+        if self.threaded and self.isAlive():
+            self.items.put(None)
+            self.join()
+
+    def check(self):
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def run(self):
+        while True:
+            item = self.items.get()
+            if item is None:
+                break
+            # after an error, drain the queue so put() doesn't block
+            if self.error:
+                continue
+            try:
+                self.fn(item)
+            except:
+                self.error = sys.exc_info()
+
+class SyncFetcher(threading.Thread):
+    """Iterate over GEN on another thread, keeping up to DEPTH items ahead
+    of the reader. An error in GEN is raised by the reader."""
+
+    def __init__(self, gen, threaded=True, depth=2):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.gen = gen
+        self.threaded = threaded
+        self.items = Queue.Queue(depth)
+        self.stopped = False
+        if threaded:
+            self.start()
+
+    def __iter__(self):
+        if not self.threaded:
+            for item in self.gen:
+                yield item
+            return
+        while True:
+            (more, item) = self.items.get()
+            if not more:
+                if item:
+                    raise item[0], item[1], item[2]
+                return
+            yield item
+
+    def stop(self):
+        "Stop fetching, discarding anything not read."
+        self.stopped = True
+        while self.threaded and self.isAlive():
+            try:
+                self.items.get(timeout=0.05)
+            except Queue.Empty:
+                pass
+
+    def run(self):
+        try:
+            for item in self.gen:
+                self.items.put((True, item))
+                if self.stopped:
+                    return
+            self.items.put((False, None))
+        except:
+            self.items.put((False, sys.exc_info()))
+
 # Protocol 3 code
 ##########################################################################
 
@@ -42,6 +317,22 @@ class SyncTools(object):
     def __init__(self, deck=None):
         self.deck = deck
         self.diffs = {}
+        # if set, sync in batches of this many objects
+        self.chunkSize = 0
+        # send card/fact rows packed (protocol 3)
+        self.binary = False
+        # if set, sync in batches with the server calls made on other
+        # threads; batches are of chunkSize objects, or 1000 if unset
+        self.pipelined = False
+        # phase -> {'wall'/'local'/'server': seconds}, from a pipelined sync
+        self.timings = {}
+        # sync media files after the deck, if the other side can
+        self.mediaSync = True
+        # media files are sent and fetched in batches of about this many bytes
+        self.mediaChunkBytes = 1024 * 1024
+
+    # whether calls can be made from other threads (see syncPipelined)
+    concurrent = False
 
     def setServer(self, server):
         self.server = server
@@ -54,10 +345,17 @@ class SyncTools(object):
 
     def unstuff(self, data):
         "Uncompress and convert to unicode."
-        return simplejson.loads(zlib.decompress(data))
+        data = zlib.decompress(data)
+        if data.startswith(BINARY_MAGIC):
+            # the other side packs rows, so we can reply in kind
+            self.binary = True
+            return loadBinary(data)
+        return simplejson.loads(data)
 
     def stuff(self, data):
         "Convert into UTF-8 and compress."
+        if self.binary:
+            return zlib.compress(dumpBinary(data))
         return zlib.compress(simplejson.dumps(data))
 
     def dictFromObj(self, obj):
@@ -74,6 +372,15 @@ class SyncTools(object):
         "Convert an SQLAlchemy response into a list of real tuples."
         return [tuple(x) for x in result]
 
+    def allTuples(self, sql, args=()):
+        "Run SQL on the DB-API cursor, returning plain tuples."
+        cur = self.deck.s.connection().connection.cursor()
+        try:
+            cur.execute(sql, args)
+            return cur.fetchall()
+        finally:
+            cur.close()
+
     # Summaries
     ##########################################################################
 
@@ -84,21 +391,24 @@ class SyncTools(object):
         return {
             # cards
             "cards": self.realTuples(self.deck.s.all(
-            "select id, modified from cards where modified > :mod",
+            "select id, modified from cards where modified > :mod "
+            "order by id",
             mod=lastSync)),
             "delcards": self.realTuples(self.deck.s.all(
               "select cardId, deletedTime from cardsDeleted "
               "where deletedTime > :mod", mod=lastSync)),
             # facts
             "facts": self.realTuples(self.deck.s.all(
-            "select id, modified from facts where modified > :mod",
+            "select id, modified from facts where modified > :mod "
+            "order by id",
             mod=lastSync)),
             "delfacts": self.realTuples(self.deck.s.all(
               "select factId, deletedTime from factsDeleted "
               "where deletedTime > :mod", mod=lastSync)),
             # models
             "models": self.realTuples(self.deck.s.all(
-            "select id, modified from models where modified > :mod",
+            "select id, modified from models where modified > :mod "
+            "order by id",
             mod=lastSync)),
             "delmodels": self.realTuples(self.deck.s.all(
               "select modelId, deletedTime from modelsDeleted "
@@ -109,37 +419,24 @@ class SyncTools(object):
     ##########################################################################
 
     def diffSummary(self, localSummary, remoteSummary, key):
-        # list of ids on both ends
-        lexists = localSummary[key]
-        ldeleted = localSummary["del"+key]
-        rexists = remoteSummary[key]
-        rdeleted = remoteSummary["del"+key]
-        ldeletedIds = dict(ldeleted)
-        rdeletedIds = dict(rdeleted)
+        # ids existing on either end are merged in id order. Deletions since
+        # the last sync are few, so they're looked up in a hash.
+        ldeletedIds = dict(localSummary["del"+key])
+        rdeletedIds = dict(remoteSummary["del"+key])
         # to store the results
         locallyEdited = []
         locallyDeleted = []
         remotelyEdited = []
         remotelyDeleted = []
-        # build a hash of all ids, with value (localMod, remoteMod).
-        # deleted/nonexisting cards are marked with a modtime of None.
-        ids = {}
-        for (id, mod) in rexists:
-            ids[id] = [None, mod]
-        for (id, mod) in rdeleted:
-            ids[id] = [None, None]
-        for (id, mod) in lexists:
-            if id in ids:
-                ids[id][0] = mod
-            else:
-                ids[id] = [mod, None]
-        for (id, mod) in ldeleted:
-            if id in ids:
-                ids[id][0] = None
-            else:
-                ids[id] = [None, None]
-        # loop through the hash, determining differences
-        for (id, (localMod, remoteMod)) in ids.items():
+        for (id, localMod, remoteMod) in mergeSorted(localSummary[key],
+                                                     remoteSummary[key]):
+            # deleted objects are treated as nonexisting
+            ldeleted = ldeletedIds.pop(id, None)
+            rdeleted = rdeletedIds.pop(id, None)
+            if ldeleted is not None:
+                localMod = None
+            if rdeleted is not None:
+                remoteMod = None
             if localMod and remoteMod:
                 # changed/existing on both sides
                 if localMod < remoteMod:
@@ -148,23 +445,28 @@ class SyncTools(object):
                     locallyEdited.append(id)
             elif localMod and not remoteMod:
                 # if it's missing on server or newer here, sync
-                if (id not in rdeletedIds or
-                    rdeletedIds[id] < localMod):
+                if rdeleted is None or rdeleted < localMod:
                     locallyEdited.append(id)
                 else:
                     remotelyDeleted.append(id)
             elif remoteMod and not localMod:
                 # if it's missing locally or newer there, sync
-                if (id not in ldeletedIds or
-                    ldeletedIds[id] < remoteMod):
+                if ldeleted is None or ldeleted < remoteMod:
                     remotelyEdited.append(id)
                 else:
                     locallyDeleted.append(id)
             else:
-                if id in ldeletedIds and id not in rdeletedIds:
+                if ldeleted is not None and rdeleted is None:
                    locallyDeleted.append(id)
-                elif id in rdeletedIds and id not in ldeletedIds:
+                elif rdeleted is not None and ldeleted is None:
                    remotelyDeleted.append(id)
+        # and ids which only exist as deletions
+        for id in ldeletedIds:
+            if id not in rdeletedIds:
+                locallyDeleted.append(id)
+        for id in rdeletedIds:
+            if id not in ldeletedIds:
+                remotelyDeleted.append(id)
         return (locallyEdited, locallyDeleted,
                 remotelyEdited, remotelyDeleted)
 
@@ -175,16 +477,91 @@ class SyncTools(object):
         "Sync two decks locally."
         self.localTime = self.modified()
         self.remoteTime = self.server.modified()
+        self.binary = self.server.binary
         l = self._lastSync(); r = self.server._lastSync()
+        self.checkpoint = self.loadCheckpoint()
         if l != r:
-            self.lastSync = 0
+            if (self.checkpoint and
+                self.checkpoint['serverModified'] == r == self.remoteTime):
+                # an interrupted sync with this server, which the server
+                # finished and nobody has synced with since. it can restart
+                # from where it began
+                self.lastSync = self.checkpoint['lastSync']
+            else:
+                self.checkpoint = None
+                self.lastSync = 0
         else:
             self.lastSync = l
-        lsum = self.summary(self.lastSync)
-        rsum = self.server.summary(self.lastSync)
-        payload = self.genPayload(lsum, rsum)
-        res = self.server.applyPayload(payload)
-        self.applyPayloadReply(res)
+        if (not self.checkpoint or
+            self.checkpoint['lastSync'] != self.lastSync):
+            self.saveCheckpoint(u"")
+        # where the last attempt got to
+        self.resumed = self.checkpoint
+        if self.pipelined:
+            self.syncPipelined()
+        else:
+            lsum = self.summary(self.lastSync)
+            rsum = self.server.summary(self.lastSync)
+            if self.chunkSize:
+                self.syncChunks(lsum, rsum)
+            else:
+                payload = self.genPayload(lsum, rsum)
+                res = self.server.applyPayload(payload)
+                self.applyPayloadReply(res)
+        self.clearCheckpoint()
+        if self.mediaSync and self.server.mediaSync:
+            self.syncMedia()
+
+    # Checkpoints
+    ##########################################################################
+    # While syncing, the client records what the server has acknowledged.
+    # Objects which reached the server compare equal in the next summary and
+    # aren't sent again, so a checkpoint only needs the lastSync to restart
+    # from, and the (time, cardId) of the last history entry it got through,
+    # as history is sent in that order. Once the server has
+    # finished, its new modified time is recorded too: the sync may only be
+    # resumed while the server is still in that state.
+
+    def peerName(self):
+        "Identify the server, so a sync is only resumed with the same one."
+        return u""
+
+    def loadCheckpoint(self):
+        row = self.deck.s.first("""
+select lastSync, phase, historyTime, historyCardId, serverModified
+from syncState where peer = :peer""", peer=self.server.peerName())
+        if not row:
+            return None
+        return {'lastSync': row[0], 'phase': row[1],
+                'position': (row[2], row[3]), 'serverModified': row[4]}
+
+    def saveCheckpoint(self, phase, position=(0, 0), serverModified=0):
+        """Record that the server has acknowledged PHASE, and commit.
+        POSITION is the (time, cardId) of the last history entry sent in it.
+        SERVERMODIFIED is the server's modified time if it has finished."""
+        self.checkpoint = {'lastSync': self.lastSync, 'phase': phase,
+                           'position': position,
+                           'serverModified': serverModified}
+        self.deck.s.statement("delete from syncState")
+        self.deck.s.statement("""
+insert into syncState (peer, lastSync, phase, historyTime, historyCardId,
+serverModified, modified)
+values (:peer, :lastSync, :phase, :historyTime, :historyCardId,
+:serverModified, :modified)""",
+                              peer=self.server.peerName(),
+                              lastSync=self.lastSync, phase=phase,
+                              historyTime=position[0],
+                              historyCardId=position[1],
+                              serverModified=serverModified,
+                              modified=time.time())
+        self.deck.s.commit()
+
+    def clearCheckpoint(self):
+        self.checkpoint = None
+        self.deck.s.statement("delete from syncState")
+
+    # Payloads
+    ##########################################################################
 
     def genPayload(self, lsum, rsum):
         payload = {}
@@ -242,6 +619,376 @@ class SyncTools(object):
         self.deck.s.refresh(self.deck)
         self.deck.currentModel
 
+    # Chunked syncing
+    ##########################################################################
+    # Rather than one payload holding every change, objects are sent and
+    # fetched chunkSize at a time, and each batch is applied and flushed as it
+    # arrives. The client drives the exchange.
+
+    def chunks(self, ids):
+        "Split IDS into lists of at most chunkSize ids."
+        for n in range(0, len(ids), self.chunkSize):
+            yield ids[n:n+self.chunkSize]
+
+    def syncChunks(self, lsum, rsum):
+        # models, then facts, then cards
+        for key in ("models", "facts", "cards"):
+            diff = self.diffSummary(lsum, rsum, key)
+            for ids in self.chunks(diff[0]):
+                self.server.applyChunk({
+                    'key': key, 'added': self.getObjsFromKey(ids, key)})
+            for ids in self.chunks(diff[1]):
+                self.server.applyChunk({'key': key, 'deleted': ids})
+            for ids in self.chunks(diff[2]):
+                self.updateObjsFromKey(self.server.getChunk({
+                    'key': key, 'ids': ids}), key)
+                self.deck.s.flush()
+            self.deleteObjsFromKey(diff[3], key)
+            self.saveCheckpoint(key)
+        # history, then deck & stats, as both use the old lastSync. history
+        # resumes after the entry the last attempt got through
+        if self.localTime > self.remoteTime:
+            after = self.historyPosition(u"sendHistory")
+            while True:
+                rows = self.historyRows(after, self.chunkSize)
+                if not rows:
+                    break
+                self.server.applyChunk({'history': self.packHistory(rows)})
+                after = self.historyKey(rows)
+                self.saveCheckpoint(u"sendHistory", after)
+            self.server.applyChunk({'deck': self.bundleDeck(),
+                                    'stats': self.bundleStats()})
+            # the server takes our modified time
+            self.saveCheckpoint(u"sendHistory", after, self.deck.modified)
+            self.deck.lastSync = self.deck.modified
+        else:
+            after = self.historyPosition(u"getHistory")
+            while True:
+                history = self.server.getChunk({
+                    'key': 'history', 'after': after,
+                    'limit': self.chunkSize})
+                rows = self.unpackHistory(history)
+                if not rows:
+                    break
+                self.insertHistory(rows)
+                after = self.historyKey(rows)
+                self.saveCheckpoint(u"getHistory", after)
+            reply = self.server.getChunk({'key': 'deck'})
+            self.saveCheckpoint(u"getHistory", after,
+                                reply['deck']['modified'])
+            self.updateDeck(reply['deck'])
+            self.updateStats(reply['stats'])
+        self.server.finishChunks()
+        self.postSyncRefresh()
+
+    def historyPosition(self, phase):
+        """Return the (time, cardId) of the last history entry acknowledged
+        in PHASE by the last attempt."""
+        if self.resumed and self.resumed['phase'] == phase:
+            return self.resumed['position']
+        return (0, 0)
+
+    def applyChunk(self, chunk):
+        "Apply one batch of changes sent by syncChunks(), and flush it."
+        if 'key' in chunk:
+            if 'added' in chunk:
+                self.updateObjsFromKey(chunk['added'], chunk['key'])
+            if 'deleted' in chunk:
+                self.deleteObjsFromKey(chunk['deleted'], chunk['key'])
+        if 'history' in chunk:
+            self.updateHistory(chunk['history'])
+        if 'deck' in chunk:
+            self.updateDeck(chunk['deck'])
+            self.updateStats(chunk['stats'])
+        # the client will record the batch as acknowledged
+        self.deck.s.commit()
+
+    def getChunk(self, request):
+        "Return one batch of objects requested by syncChunks()."
+        key = request['key']
+        if key == "history":
+            return self.bundleHistory(request['after'], request['limit'])
+        if key == "deck":
+            reply = {'deck': self.bundleDeck(),
+                     'stats': self.bundleStats()}
+            self.deck.lastSync = self.deck.modified
+            self.deck.s.commit()
+            return reply
+        return self.getObjsFromKey(request['ids'], key)
+
+    def finishChunks(self):
+        self.postSyncRefresh()
+
+    # Pipelined syncing
+    ##########################################################################
+    # The exchange of syncChunks(), with the server calls made on a sender and
+    # a fetcher thread, while this thread reads and writes the deck. So one
+    # batch is read from the deck while the one before it is serialized and
+    # sent, and the objects we need are downloaded ahead of being applied.
+    # Batches are still sent and fetched in order. The server's summary is
+    # built while we build ours. If the server can't be called from other
+    # threads (a local SyncServer), each step runs in turn on this thread.
+
+    def syncPipelined(self):
+        self.timings = {}
+        self.timingLock = threading.Lock()
+        self.acks = Queue.Queue()
+        if not self.chunkSize:
+            self.chunkSize = 1000
+        threaded = self.server.concurrent
+        start = time.time()
+        remote = SyncFetcher(self.fetchSummary(), threaded)
+        lsum = self.timed("summary", "local", self.summary, self.lastSync)
+        rsum = list(remote)[0]
+        keys = ("models", "facts", "cards")
+        diffs = dict([(key, self.diffSummary(lsum, rsum, key))
+                      for key in keys])
+        self.addTiming("summary", "wall", time.time() - start)
+        sending = self.localTime > self.remoteTime
+        if sending:
+            after = None
+        else:
+            after = self.historyPosition(u"getHistory")
+        sender = SyncSender(self.sendChunk, threaded)
+        fetcher = SyncFetcher(self.fetchChunks(diffs, after),
+                              threaded)
+        fetched = iter(fetcher)
+        try:
+            for key in keys:
+                start = time.time()
+                diff = diffs[key]
+                for ids in self.chunks(diff[0]):
+                    sender.put((key, {'key': key, 'added': self.timed(
+                        key, "local", self.getObjsFromKey, ids, key)}, None))
+                for ids in self.chunks(diff[1]):
+                    sender.put((key, {'key': key, 'deleted': ids}, None))
+                sender.put((key, None, (key,)))
+                for ids in self.chunks(diff[2]):
+                    self.timed(key, "local", self.updateObjsFromKey,
+                               fetched.next(), key)
+                    self.deck.s.flush()
+                self.timed(key, "local", self.deleteObjsFromKey, diff[3], key)
+                self.saveAcks()
+                self.addTiming(key, "wall", time.time() - start)
+            # history, then deck & stats
+            start = time.time()
+            if sending:
+                after = self.historyPosition(u"sendHistory")
+                while True:
+                    rows = self.timed("history", "local",
+                                      self.historyRows, after,
+                                      self.chunkSize)
+                    if not rows:
+                        break
+                    after = self.historyKey(rows)
+                    sender.put(("history", {'history': self.timed(
+                        "history", "local", self.packHistory, rows)},
+                                (u"sendHistory", after)))
+                    self.saveAcks()
+                # the server takes our modified time
+                sender.put(("deck", {
+                    'deck': self.bundleDeck(),
+                    'stats': self.timed("deck", "local", self.bundleStats)},
+                            (u"sendHistory", after, self.deck.modified)))
+                self.deck.lastSync = self.deck.modified
+                sender.finish()
+                self.saveAcks()
+            else:
+                # the server's lastSync must only change after our batches
+                sender.finish()
+                self.saveAcks()
+                for rows in fetched:
+                    self.timed("history", "local", self.insertHistory, rows)
+                    after = self.historyKey(rows)
+                    self.saveCheckpoint(u"getHistory", after)
+            self.addTiming("history", "wall", time.time() - start)
+        finally:
+            sender.stop()
+            fetcher.stop()
+        start = time.time()
+        if not sending:
+            reply = self.timed("deck", "server", self.server.getChunk,
+                               {'key': 'deck'})
+            self.saveCheckpoint(u"getHistory", after,
+                                reply['deck']['modified'])
+            self.updateDeck(reply['deck'])
+            self.timed("deck", "local", self.updateStats, reply['stats'])
+        self.timed("deck", "server", self.server.finishChunks)
+        self.timed("deck", "local", self.postSyncRefresh)
+        self.addTiming("deck", "wall", time.time() - start)
+
+    def fetchSummary(self):
+        yield self.timed("summary", "server", self.server.summary,
+                         self.lastSync)
+
+    def fetchChunks(self, diffs, after):
+        """Yield the batches syncPipelined() needs from the server, in order.
+        History is fetched from the entry AFTER if it's not None, and yielded
+        as rows."""
+        for key in ("models", "facts", "cards"):
+            for ids in self.chunks(diffs[key][2]):
+                yield self.timed(key, "server", self.server.getChunk, {
+                    'key': key, 'ids': ids})
+        if after is None:
+            return
+        while True:
+            rows = self.unpackHistory(self.timed(
+                "history", "server", self.server.getChunk, {
+                'key': 'history', 'after': after, 'limit': self.chunkSize}))
+            if not rows:
+                return
+            yield rows
+            after = self.historyKey(rows)
+
+    def sendChunk(self, item):
+        "Send a batch, and queue its checkpoint arguments if any."
+        (phase, chunk, ack) = item
+        if chunk is not None:
+            self.timed(phase, "server", self.server.applyChunk, chunk)
+        if ack:
+            self.acks.put(ack)
+
+    def saveAcks(self):
+        "Checkpoint the batches the sender has had acknowledged."
+        while True:
+            try:
+                ack = self.acks.get_nowait()
+            except Queue.Empty:
+                return
+            self.saveCheckpoint(*ack)
+
+    def timed(self, phase, kind, fn, *args):
+        "Call FN, adding the time taken to the KIND time of PHASE."
+        start = time.time()
+        try:
+            return fn(*args)
+        finally:
+            self.addTiming(phase, kind, time.time() - start)
+
+    def addTiming(self, phase, kind, taken):
+        self.timingLock.acquire()
+        try:
+            t = self.timings.setdefault(phase, {})
+            t[kind] = t.get(kind, 0) + taken
+        finally:
+            self.timingLock.release()
+
+    def timingReport(self):
+        """Return the time each phase of the last pipelined sync took: on this
+        thread, reading and writing the deck, and calling the server."""
+        lines = []
+        for phase in ("summary", "models", "facts", "cards", "history",
+                      "deck"):
+            t = self.timings.get(phase)
+            if t:
+                lines.append("%-8s wall %6.2fs  local %6.2fs  server %6.2fs"
+                             % (phase, t.get('wall', 0), t.get('local', 0),
+                                t.get('server', 0)))
+        return "\n".join(lines)
+
+    # Media
+    ##########################################################################
+    # Files are compared by name and checksum. A file the other side lacks
+    # is only sent if it doesn't have the same content under another name;
+    # if it does, it links it. Files are read as their batch is sent, so
+    # only one batch is held in memory. Deletions aren't synced.
+
+    def syncMedia(self):
+        remote = self.server.mediaSummary()
+        local = self.mediaSummary()
+        # files the server lacks
+        (send, links) = self.missingMedia(local, remote)
+        for files in self.mediaChunks(send):
+            self.server.addMedia(self.getMedia([f[0] for f in files]))
+        if links:
+            self.server.addMedia(links)
+        # and those we lack
+        (fetch, links) = self.missingMedia(remote, local)
+        for files in self.mediaChunks(fetch):
+            self.addMedia(self.server.getMedia([f[0] for f in files]))
+        if links:
+            self.addMedia(links)
+        self.deck.s.commit()
+
+    def missingMedia(self, ours, theirs):
+        """Compare two lists of (name, checksum, size), returning the files
+        in OURS whose content THEIRS lacks, and [name, checksum, None] for
+        the rest of the files it lacks, which can be linked once it has the
+        content."""
+        names = set([f[0] for f in theirs])
+        sums = set([f[1] for f in theirs])
+        send = []
+        links = []
+        for f in ours:
+            if f[0] in names:
+                continue
+            if f[1] in sums:
+                links.append([f[0], f[1], None])
+            else:
+                sums.add(f[1])
+                send.append(f)
+        return (send, links)
+
+    def mediaChunks(self, files):
+        "Split FILES, a list of (name, checksum, size), by mediaChunkBytes."
+        batch = []
+        size = 0
+        for f in files:
+            if batch and size + f[2] > self.mediaChunkBytes:
+                yield batch
+                batch = []
+                size = 0
+            batch.append(f)
+            size += f[2]
+        if batch:
+            yield batch
+
+    def mediaSummary(self):
+        "Return (name, checksum, size) for each media file."
+        anki.media.scanMedia(self.deck)
+        return self.realTuples(self.deck.s.all(
+            "select filename, checksum, size from media order by filename"))
+
+    def getMedia(self, names):
+        "Return [name, checksum, Blob] for the media files NAMES."
+        dir = self.deck.mediaDir()
+        files = []
+        for name in names:
+            self.checkMediaName(name)
+            sum = self.deck.s.scalar(
+                "select checksum from media where filename = :name",
+                name=name)
+            if sum is None:
+                raise SyncError(type="noMedia", name=name)
+            f = open(os.path.join(dir, name), "rb")
+            try:
+                files.append([name, sum, Blob(f.read())])
+            finally:
+                f.close()
+        return files
+
+    def addMedia(self, files):
+        """Store FILES, a list of [name, checksum, Blob]. A file sent without
+        content is linked to the stored file with the same checksum."""
+        if files and not self.deck.mediaDir(create=True):
+            raise SyncError(type="noMediaDir")
+        for (name, sum, blob) in files:
+            self.checkMediaName(name)
+            if blob is None:
+                if not anki.media.linkMediaFile(self.deck, name, sum):
+                    raise SyncError(type="noMedia", name=name)
+                continue
+            if anki.media.dataChecksum(blob.data) != sum:
+                raise SyncError(type="badMedia", name=name)
+            anki.media.addMediaData(self.deck, name, sum, blob.data)
+        self.deck.s.flush()
+
+    def checkMediaName(self, name):
+        "Refuse names which would be stored outside the media directory."
+        if (not name or name.startswith(".") or "/" in name or
+            os.sep in name):
+            raise SyncError(type="badName", name=name)
+
     def getObjsFromKey(self, ids, key):
         return getattr(self, "get" + key.capitalize())(ids)
 
@@ -299,41 +1046,35 @@ class SyncTools(object):
         return m
 
     def mergeFieldModels(self, model, fms):
-        ids = []
+        local = dict([(fm.id, fm) for fm in model.fieldModels])
+        ids = set()
         for fm in fms:
-            local = self.getFieldModel(model, fm)
-            self.applyDict(local, fm)
-            ids.append(fm['id'])
-        for fm in model.fieldModels:
+            if fm['id'] in local:
+                l = local[fm['id']]
+            else:
+                l = FieldModel()
+                model.addFieldModel(l)
+            self.applyDict(l, fm)
+            ids.add(fm['id'])
+        for fm in list(model.fieldModels):
             if fm.id not in ids:
                 self.deck.deleteFieldModel(model, fm)
 
-    def getFieldModel(self, model, remote):
-        for fm in model.fieldModels:
-            if fm.id == remote['id']:
-                return fm
-        fm = FieldModel()
-        model.addFieldModel(fm)
-        return fm
-
     def mergeCardModels(self, model, cms):
-        ids = []
+        local = dict([(cm.id, cm) for cm in model.cardModels])
+        ids = set()
         for cm in cms:
-            local = self.getCardModel(model, cm)
-            self.applyDict(local, cm)
-            ids.append(cm['id'])
-        for cm in model.cardModels:
+            if cm['id'] in local:
+                l = local[cm['id']]
+            else:
+                l = CardModel()
+                model.addCardModel(l)
+            self.applyDict(l, cm)
+            ids.add(cm['id'])
+        for cm in list(model.cardModels):
             if cm.id not in ids:
                 self.deck.deleteCardModel(model, cm)
 
-    def getCardModel(self, model, remote):
-        for cm in model.cardModels:
-            if cm.id == remote['id']:
-                return cm
-        cm = CardModel()
-        model.addCardModel(cm)
-        return cm
-
     def deleteModels(self, ids):
         for id in ids:
             model = self.getModel(id, create=False)
@@ -346,48 +1087,42 @@ class SyncTools(object):
 
     def getFacts(self, ids):
         factIds = ",".join([str(i) for i in ids])
-        return {
-            'facts': self.realTuples(self.deck.s.all("""
+        facts = self.allTuples("""
 select id, modelId, created, modified, tags, spaceUntil, lastCardId from facts
-where id in (%s)""" % factIds)),
-            'fields': self.realTuples(self.deck.s.all("""
+where id in (%s)""" % factIds)
+        fields = self.allTuples("""
 select id, factId, fieldModelId, ordinal, value from fields
-where factId in (%s)""" % factIds))
+where factId in (%s)""" % factIds)
+        if self.binary:
+            facts = PackedRows(packRows(facts, factTypes))
+            fields = PackedRows(packRows(fields, fieldTypes))
+        return {
+            'facts': facts,
+            'fields': fields,
             }
 
     def updateFacts(self, factsdict):
         facts = factsdict['facts']
         fields = factsdict['fields']
+        if isinstance(facts, PackedRows):
+            facts = unpackRows(facts.data)
+            fields = unpackRows(fields.data)
         if not facts:
             return
         # update facts first
-        dlist = [{
-            'id': f[0],
-            'modelId': f[1],
-            'created': f[2],
-            'modified': f[3],
-            'tags': f[4],
-            'spaceUntil': f[5],
-            'lastCardId': f[6]
-            } for f in facts]
-        self.deck.s.execute("""
+        db = self.deck.s.connection()
+        db.execute("""
 insert or replace into facts
 (id, modelId, created, modified, tags, spaceUntil, lastCardId)
-values
-(:id, :modelId, :created, :modified, :tags, :spaceUntil, :lastCardId)""", dlist)
+values (?, ?, ?, ?, ?, ?, ?)""", [tuple(f) for f in facts])
         # now fields
-        dlist = [{
-            'id': f[0],
-            'factId': f[1],
-            'fieldModelId': f[2],
-            'ordinal': f[3],
-            'value': f[4]
-            } for f in fields]
-        self.deck.s.execute("""
+        if fields:
+            db.execute("""
 insert or replace into fields
 (id, factId, fieldModelId, ordinal, value)
-values
-(:id, :factId, :fieldModelId, :ordinal, :value)""", dlist)
+values (?, ?, ?, ?, ?)""", [tuple(f) for f in fields])
+        self.deck.updateTagIndex(factIds=[f[0] for f in facts])
+        self.deck.refreshQueueFacts([f[0] for f in facts])
 
     def deleteFacts(self, ids):
         self.deck.deleteFacts(ids)
@@ -397,53 +1132,24 @@ values
     # in sql for efficiency
 
     def getCards(self, ids):
-        return self.realTuples(self.deck.s.all("""
+        cards = self.allTuples("""
 select id, factId, cardModelId, created, modified, tags, ordinal,
 priority, interval, lastInterval, due, lastDue, factor,
 firstAnswered, reps, successive, averageTime, reviewTime, youngEase0,
 youngEase1, youngEase2, youngEase3, youngEase4, matureEase0,
 matureEase1, matureEase2, matureEase3, matureEase4, yesCount, noCount,
 question, answer, lastFactor from cards
-where id in (%s)""" % ",".join([str(i) for i in ids])))
+where id in (%s)""" % ",".join([str(i) for i in ids]))
+        if self.binary:
+            return PackedRows(packRows(cards, cardTypes))
+        return cards
 
     def updateCards(self, cards):
+        if isinstance(cards, PackedRows):
+            cards = unpackRows(cards.data)
         if not cards:
             return
-        dlist = [{'id': c[0],
-                  'factId': c[1],
-                  'cardModelId': c[2],
-                  'created': c[3],
-                  'modified': c[4],
-                  'tags': c[5],
-                  'ordinal': c[6],
-                  'priority': c[7],
-                  'interval': c[8],
-                  'lastInterval': c[9],
-                  'due': c[10],
-                  'lastDue': c[11],
-                  'factor': c[12],
-                  'firstAnswered': c[13],
-                  'reps': c[14],
-                  'successive': c[15],
-                  'averageTime': c[16],
-                  'reviewTime': c[17],
-                  'youngEase0': c[18],
-                  'youngEase1': c[19],
-                  'youngEase2': c[20],
-                  'youngEase3': c[21],
-                  'youngEase4': c[22],
-                  'matureEase0': c[23],
-                  'matureEase1': c[24],
-                  'matureEase2': c[25],
-                  'matureEase3': c[26],
-                  'matureEase4': c[27],
-                  'yesCount': c[28],
-                  'noCount': c[29],
-                  'question': c[30],
-                  'answer': c[31],
-                  'lastFactor': c[32],
-                  } for c in cards]
-        self.deck.s.execute("""
+        self.deck.s.connection().execute("""
 insert or replace into cards
 (id, factId, cardModelId, created, modified, tags, ordinal,
 priority, interval, lastInterval, due, lastDue, factor,
@@ -451,13 +1157,9 @@ firstAnswered, reps, successive, averageTime, reviewTime, youngEase0,
 youngEase1, youngEase2, youngEase3, youngEase4, matureEase0,
 matureEase1, matureEase2, matureEase3, matureEase4, yesCount, noCount,
 question, answer, lastFactor)
-values
-(:id, :factId, :cardModelId, :created, :modified, :tags, :ordinal,
-:priority, :interval, :lastInterval, :due, :lastDue, :factor,
-:firstAnswered, :reps, :successive, :averageTime, :reviewTime, :youngEase0,
-:youngEase1, :youngEase2, :youngEase3, :youngEase4, :matureEase0,
-:matureEase1, :matureEase2, :matureEase3, :matureEase4, :yesCount,
-:noCount, :question, :answer, :lastFactor)""", dlist)
+values (%s)""" % ", ".join(["?"] * 33), [tuple(c) for c in cards])
+        self.deck.updateTagIndex(cardIds=[c[0] for c in cards])
+        self.deck.refreshQueueCards([c[0] for c in cards])
 
     def deleteCards(self, ids):
         self.deck.deleteCards(ids)
@@ -474,6 +1176,8 @@ values
             del d['failedQueue']
             del d['futureQueue']
             del d['factSpacing']
+            del d['queueCutoff']
+            del d['queueBacklog']
         del d['Session']
         del d['engine']
         del d['s']
@@ -489,17 +1193,21 @@ values
         self.deck.lastSync = self.deck.modified
 
     def bundleStats(self):
-        def bundleStat(stat):
-            s = self.dictFromObj(stat)
+        def bundleStat(row):
+            s = dict(row.items())
             s['day'] = s['day'].toordinal()
             del s['id']
             return s
+        # ensure the global record exists
+        globalStats(self.deck.s)
+        self.deck.s.flush()
         lastDay = date.fromtimestamp(self.deck.lastSync)
         stats = {
-            'global': bundleStat(globalStats(self.deck.s)),
-            'daily': [bundleStat(s) for s in self.deck.s.query(Stats).\
-                      filter(Stats.type == 1).\
-                      filter(Stats.day >= lastDay).all()]
+            'global': bundleStat(self.deck.s.execute(select(
+            [statsTable], statsTable.c.id == 1)).fetchone()),
+            'daily': [bundleStat(s) for s in self.deck.s.execute(select(
+            [statsTable], and_(statsTable.c.type == 1,
+                               statsTable.c.day >= lastDay))).fetchall()]
             }
         return stats
 
@@ -507,39 +1215,265 @@ values
         gs = globalStats(self.deck.s)
         stats['global']['day'] = date.fromordinal(stats['global']['day'])
         self.applyDict(gs, stats['global'])
-        for record in stats['daily']:
+        daily = stats['daily']
+        if not daily:
+            return
+        # existing days are kept; find them in one query
+        for record in daily:
             record['day'] = date.fromordinal(record['day'])
-            stat = self.deck.s.query(Stats).filter_by(type=1).filter_by(
-                day=record['day']).first()
-            if not stat:
-                stat = Stats(1)
-                self.applyDict(stat, record)
-                self.deck.s.save(stat)
-
-    def bundleHistory(self):
-        def bundleHist(hist):
-            h = self.dictFromObj(hist)
-            del h['id']
-            return h
-        hst = self.deck.s.query(CardHistoryEntry).filter(
-            CardHistoryEntry.time > self.deck.lastSync)
-        return [bundleHist(h) for h in hst]
+        days = [r['day'] for r in daily]
+        self.deck.s.flush()
+        existing = set([r[0] for r in self.deck.s.execute(select(
+            [statsTable.c.day], and_(statsTable.c.type == 1,
+                                     statsTable.c.day >= min(days),
+                                     statsTable.c.day <= max(days))))])
+        new = [r for r in daily if r['day'] not in existing]
+        for r in new:
+            r['type'] = 1
+        if new:
+            self.deck.s.execute(statsTable.insert(), new)
+
+    # columns of reviewHistory sent by sync, and their types for packRows()
+    historyCols = ("cardId", "time", "lastInterval", "nextInterval", "ease",
+                   "delay", "lastFactor", "nextFactor", "reps",
+                   "thinkingTime", "yesCount", "noCount")
+    historyTypes = "qdddiddddddd"
+
+    def historyRows(self, after=(0, 0), limit=None):
+        """Return history since the last sync as rows of historyCols. If LIMIT
+        is given, return that many entries in (time, cardId) order, following
+        the entry AFTER."""
+        sql = "select %s from reviewHistory where time > %f" % (
+            ", ".join(self.historyCols), self.deck.lastSync)
+        if not limit:
+            return self.allTuples(sql)
+        # seek past AFTER on the index, rather than skip an offset
+        sql += """ and time >= ? and (time > ? or cardId > ?)
+order by time, cardId limit %d""" % limit
+        return self.allTuples(sql, (after[0], after[0], after[1]))
+
+    def historyKey(self, rows):
+        "Return the (time, cardId) of the last of history ROWS."
+        return (rows[-1][1], rows[-1][0])
+
+    def packHistory(self, rows):
+        if self.binary:
+            return PackedRows(packRows(rows, self.historyTypes))
+        return [dict(zip(self.historyCols, r)) for r in rows]
+
+    def unpackHistory(self, history):
+        "Reverse packHistory()."
+        if isinstance(history, PackedRows):
+            return unpackRows(history.data)
+        return [tuple([h.get(c) for c in self.historyCols])
+                for h in history]
+
+    def bundleHistory(self, after=(0, 0), limit=None):
+        "Return history since the last sync, or LIMIT entries after AFTER."
+        return self.packHistory(self.historyRows(after, limit))
 
     def updateHistory(self, history):
-        for h in history:
-            ent = CardHistoryEntry()
-            self.applyDict(ent, h)
-            self.deck.s.save(ent)
+        self.insertHistory(self.unpackHistory(history))
+
+    def insertHistory(self, rows):
+        "Add history ROWS, skipping entries we already have."
+        if not rows:
+            return
+        # a resumed or restarted sync may send reviews we already have
+        times = [r[1] for r in rows]
+        have = set(self.allTuples("""
+select cardId, time from reviewHistory where time >= %r and time <= %r""" % (
+            min(times), max(times))))
+        if have:
+            rows = [r for r in rows if (r[0], r[1]) not in have]
+            if not rows:
+                return
+        self.deck.s.connection().execute(
+            "insert into reviewHistory (%s) values (%s)" % (
+            ", ".join(self.historyCols),
+            ", ".join(["?"] * len(self.historyCols))), rows)
 
 # Local syncing
 ##########################################################################
 
 class SyncServer(SyncTools):
-    pass
+    """The summaries sent to clients are cached until the deck's modtime
+changes or a sync writes to it, so devices polling with the same lastSync
+don't rerun the queries. The deck is assumed to be otherwise changed only by
+code which calls setModified()."""
+
+    # how many summaries to keep, for different lastSyncs
+    maxSummaries = 8
+
+    def __init__(self, deck=None):
+        SyncTools.__init__(self, deck)
+        self.clearSummaries()
+
+    def summary(self, lastSync):
+        return self.cachedSummary(lastSync, lastSync, lambda s: s)
+
+    def cachedSummary(self, key, lastSync, encode):
+        """Return ENCODE(summary(LASTSYNC)), cached as KEY. Once a summary is
+        empty, those for later lastSyncs are too, until the deck changes, so
+        they're answered without querying the deck."""
+        if self.summaryModified != self.deck.modified:
+            self.clearSummaries()
+            self.summaryModified = self.deck.modified
+        if key not in self.summaries:
+            if (self.unchangedSince is not None and
+                lastSync >= self.unchangedSince):
+                summary = dict([(k, []) for k in (
+                    "cards", "delcards", "facts", "delfacts",
+                    "models", "delmodels")])
+            else:
+                summary = SyncTools.summary(self, lastSync)
+                if not [v for v in summary.values() if v]:
+                    self.unchangedSince = lastSync
+            if len(self.summaries) >= self.maxSummaries:
+                self.summaries = {}
+            self.summaries[key] = encode(summary)
+        return self.summaries[key]
+
+    def clearSummaries(self):
+        # key -> summary, valid while the deck's modtime is summaryModified
+        self.summaries = {}
+        self.summaryModified = None
+        # the lastSync of an empty summary
+        self.unchangedSince = None
+
+    def applyPayload(self, payload):
+        self.clearSummaries()
+        return SyncTools.applyPayload(self, payload)
+
+    def applyChunk(self, chunk):
+        self.clearSummaries()
+        return SyncTools.applyChunk(self, chunk)
 
 class SyncClient(SyncTools):
     pass
 
+# HTTP transport: kept-alive connections to the sync server
+##########################################################################
+
+class HttpTransport(object):
+    """POST forms to a server, reusing connections between calls. Calls
+    marked idempotent are retried with exponential backoff if the server
+    can't be reached. Other calls are only resent if a kept-alive connection
+    turns out to have been closed by the server while idle, before it could
+    read the request: a call the server may have applied isn't repeated."""
+
+    def __init__(self, url, timeout=60, retries=3, backoff=0.5):
+        (scheme, netloc, path) = urlparse.urlsplit(url)[:3]
+        if scheme == "https":
+            self.connClass = httplib.HTTPSConnection
+        else:
+            self.connClass = httplib.HTTPConnection
+        self.netloc = netloc
+        self.path = path
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def post(self, path, fields, idempotent=False):
+        "POST FIELDS, a dict, to PATH and return the response body."
+        (headers, body) = self.encode(fields)
+        tries = 0
+        while True:
+            (conn, reused) = self.getConnection()
+            sent = False
+            try:
+                conn.putrequest("POST", self.path + path,
+                                skip_accept_encoding=True)
+                for (k, v) in headers:
+                    conn.putheader(k, v)
+                conn.endheaders()
+                # the parts are sent as they are, not joined into a copy
+                for part in body:
+                    conn.send(part)
+                    sent = True
+                resp = conn.getresponse()
+                data = resp.read()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if reused and self.closedWhileIdle(e, sent):
+                    continue
+                tries += 1
+                if not idempotent or tries > self.retries:
+                    raise SyncError(type="noResponse")
+                time.sleep(self.backoff * 2 ** (tries - 1))
+                continue
+            if resp.will_close:
+                conn.close()
+            else:
+                self.putConnection(conn)
+            if resp.status != 200:
+                raise SyncError(type="noResponse", status=resp.status)
+            return data
+
+    def closedWhileIdle(self, error, sent):
+        """True if ERROR shows the connection was closed before the server
+        read the request: it failed before any of the body was sent, or the
+        server hung up without a byte of reply. A timeout, or a failure
+        part way through the reply, may follow the call being applied."""
+        if isinstance(error, socket.timeout):
+            return False
+        if not sent:
+            return True
+        if not isinstance(error, httplib.BadStatusLine):
+            return False
+        # older versions of httplib report an empty status line as ''
+        return (error.line in ("", "''") or
+                error.line.startswith("No status line received"))
+
+    def encode(self, fields):
+        """Return the headers and body parts of FIELDS as multipart form data,
+        which, unlike urlencoding, doesn't expand binary values."""
+        boundary = "AnkiSync%016x" % random.getrandbits(64)
+        body = []
+        for (k, v) in fields.items():
+            if isinstance(v, unicode):
+                v = v.encode("utf-8")
+            elif not isinstance(v, str):
+                v = str(v)
+            body.append('--%s\r\nContent-Disposition: form-data; '
+                        'name="%s"\r\n\r\n' % (boundary, k))
+            body.append(v)
+            body.append("\r\n")
+        body.append("--%s--\r\n" % boundary)
+        headers = [
+            ("Content-Type", "multipart/form-data; boundary=%s" % boundary),
+            ("Content-Length", str(sum([len(x) for x in body])))]
+        return (headers, body)
+
+    def getConnection(self):
+        "Return (connection, reused), preferring an idle connection."
+        self.lock.acquire()
+        try:
+            if self.idle:
+                return (self.idle.pop(), True)
+        finally:
+            self.lock.release()
+        return (self.connClass(self.netloc, timeout=self.timeout), False)
+
+    def putConnection(self, conn):
+        self.lock.acquire()
+        try:
+            self.idle.append(conn)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        "Close any idle connections."
+        self.lock.acquire()
+        try:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+        finally:
+            self.lock.release()
+
 # HTTP proxy: act as a server and direct requests to the real server
 ##########################################################################
 
@@ -552,7 +1486,14 @@ class HttpSyncServerProxy(SyncClient):
         self.password = passwd
         self.syncURL="http://anki.ichi2.net/sync/"
         #self.syncURL="http://localhost:5000/sync/"
-        self.protocolVersion = 2
+        self.protocolVersion = 4
+        # set on connect if the server understands packed rows, and media
+        self.binary = False
+        self.mediaSync = False
+        # connection settings, used when the transport is created
+        self.timeout = 60
+        self.retries = 3
+        self.transport = None
 
     def connect(self, clientVersion=""):
         "Check auth, protocol & grab deck list."
@@ -563,6 +1504,8 @@ class HttpSyncServerProxy(SyncClient):
             if d['status'] != "OK":
                 raise SyncError(type="authFailed", status=d['status'])
             self.decks = d['decks']
+            self.binary = d.get('protocol', 2) >= 3
+            self.mediaSync = d.get('protocol', 2) >= 4
 
     def hasDeck(self, deckName):
         self.connect()
@@ -590,49 +1533,322 @@ class HttpSyncServerProxy(SyncClient):
         self.connect()
         return self.decks[self.deckName][1]
 
+    def peerName(self):
+        return u"%s %s %s" % (self.syncURL, self.username, self.deckName)
+
     def applyPayload(self, payload):
         return self.runCmd("applyPayload",
                            payload=self.stuff(payload))
 
+    def applyChunk(self, chunk):
+        return self.runCmd("applyChunk",
+                           chunk=self.stuff(chunk))
+
+    def getChunk(self, request):
+        return self.runCmd("getChunk",
+                           request=self.stuff(request))
+
+    def finishChunks(self):
+        return self.runCmd("finishChunks")
+
+    def mediaSummary(self):
+        return self.runCmd("mediaSummary")
+
+    def getMedia(self, names):
+        return self.runCmd("getMedia", names=self.stuff(names))
+
+    def addMedia(self, files):
+        return self.runCmd("addMedia", files=self.stuff(files))
+
+    # each call is a separate request, so they can be made at once
+    concurrent = True
+
+    # calls which don't change the server, and are safe to repeat
+    idempotentCmds = ("getDecks", "summary", "getChunk", "mediaSummary",
+                      "getMedia")
+
     def runCmd(self, action, **args):
         data = {"d": self.deckName,
                 "p": self.password,
                 "u": self.username}
         data.update(args)
-        data = urllib.urlencode(data)
-        try:
-            f = urllib2.urlopen(self.syncURL + action, data)
-        except (urllib2.URLError, socket.error, socket.timeout):
-            raise SyncError(type="noResponse")
-        ret = f.read()
+        if not self.transport:
+            self.transport = HttpTransport(self.syncURL, self.timeout,
+                                           self.retries)
+        ret = self.transport.post(action, data,
+                                  idempotent=action in self.idempotentCmds)
         if not ret:
             raise SyncError(type="noResponse")
         return self.unstuff(ret)
 
+    def close(self):
+        "Close the connection to the server."
+        if self.transport:
+            self.transport.close()
+
 # HTTP server: respond to proxy requests and return data
 ##########################################################################
 
 class HttpSyncServer(SyncServer):
+    """Each reply is in the format of its request, so one server can talk to
+clients which pack rows and those which don't. Requests without data are
+answered in JSON."""
+
     def __init__(self):
         SyncServer.__init__(self)
-        self.protocolVersion = 2
+        self.protocolVersion = 4
         self.decks = {}
         self.deck = None
 
+    def unstuff(self, data):
+        self.binary = False
+        return SyncServer.unstuff(self, data)
+
+    def stuffText(self, data):
+        "Reply to a request without data."
+        self.binary = False
+        return self.stuff(data)
+
     def summary(self, lastSync):
-        return self.stuff(SyncServer.summary(
-            self, self.unstuff(lastSync)))
+        # the encoded reply is cached, in the client's format
+        lastSync = self.unstuff(lastSync)
+        return self.cachedSummary((lastSync, self.binary), lastSync,
+                                  self.stuff)
 
     def applyPayload(self, payload):
         return self.stuff(SyncServer.applyPayload(self,
             self.unstuff(payload)))
 
+    def applyChunk(self, chunk):
+        return self.stuff(SyncServer.applyChunk(self,
+            self.unstuff(chunk)))
+
+    def getChunk(self, request):
+        return self.stuff(SyncServer.getChunk(self,
+            self.unstuff(request)))
+
+    def finishChunks(self):
+        return self.stuffText(SyncServer.finishChunks(self))
+
+    def mediaSummary(self):
+        return self.stuffText(SyncServer.mediaSummary(self))
+
+    def getMedia(self, names):
+        return self.stuff(SyncServer.getMedia(self, self.unstuff(names)))
+
+    def addMedia(self, files):
+        return self.stuff(SyncServer.addMedia(self, self.unstuff(files)))
+
     def getDecks(self, libanki, client):
-        return self.stuff({
+        return self.stuffText({
             "status": "OK",
             "decks": self.decks,
+            "protocol": self.protocolVersion,
             })
 
     def createDeck(self, name):
         "Create a deck on the server. Not implemented."
-        return self.stuff("OK")
+        return self.stuffText("OK")
+
+# Multi-deck server: serve many users' decks from a pool of open decks
+##########################################################################
+
+class SyncServerPool(object):
+    """Serve sync calls for many users' decks, stored as BASE/user/deck.anki.
+
+Open decks are kept in a bounded LRU pool, so most calls don't pay for
+opening a deck. A deck's database connection can only be used by the thread
+which opened it, so each deck belongs to one worker thread, chosen from its
+name: calls on a deck are serialized, while decks on other workers are served
+in parallel. Authentication is left to the web application."""
+
+    def __init__(self, base, maxDecks=20, threads=4):
+        self.base = base
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # action -> [calls, total time, max time]
+        self.latency = {}
+        self.workers = []
+        for n in range(threads):
+            worker = SyncWorker(self, max(1, maxDecks / threads))
+            worker.start()
+            self.workers.append(worker)
+
+    def handle(self, user, deckName, action, **args):
+        "Serve one request sent by HttpSyncServerProxy.runCmd()."
+        if action == "getDecks":
+            return self.getDecks(user, **args)
+        if action == "createDeck":
+            return self.createDeck(user, **args)
+        return self.call(user, deckName, action, **args)
+
+    def call(self, user, deckName, action, **args):
+        "Run the HttpSyncServer ACTION on a deck, and return the result."
+        def run(server):
+            ret = getattr(server, action)(**args)
+            server.deck.s.commit()
+            return ret
+        start = time.time()
+        try:
+            return self.run(user, deckName, run)
+        finally:
+            self.record(action, time.time() - start)
+
+    def getDecks(self, user, libanki=None, client=None):
+        decks = {}
+        dir = self.userDir(user)
+        if os.path.isdir(dir):
+            for file in os.listdir(dir):
+                if file.endswith(".anki"):
+                    decks[file[:-5]] = self.run(
+                        user, file[:-5],
+                        lambda s: (s.deck.modified, s.deck.lastSync))
+        return SyncTools().stuff({
+            "status": "OK",
+            "decks": decks,
+            "protocol": HttpSyncServer().protocolVersion,
+            })
+
+    def createDeck(self, user, name):
+        if not os.path.isdir(self.userDir(user)):
+            os.makedirs(self.userDir(user))
+        self.run(user, name, lambda s: s.deck.s.commit(), create=True)
+        return SyncTools().stuff({"status": "OK"})
+
+    def run(self, user, deckName, fn, create=False):
+        "Call FN with the deck's HttpSyncServer on its worker thread."
+        key = (user, deckName)
+        self.deckPath(key)
+        worker = self.workers[hash(key) % len(self.workers)]
+        return worker.call(key, fn, create)
+
+    def userDir(self, user):
+        return os.path.join(self.base, user)
+
+    def deckPath(self, key):
+        for name in key:
+            if not name or name.startswith(".") or "/" in name or (
+                os.sep in name):
+                raise SyncError(type="badName", name=name)
+        return os.path.join(self.userDir(key[0]), key[1] + ".anki")
+
+    def record(self, action, taken):
+        self.lock.acquire()
+        try:
+            l = self.latency.setdefault(action, [0, 0.0, 0.0])
+            l[0] += 1
+            l[1] += taken
+            l[2] = max(l[2], taken)
+        finally:
+            self.lock.release()
+
+    def count(self, counter):
+        self.lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return a dict of counters: open decks, cache hits, misses and
+        evictions, and per action (calls, average and max time)."""
+        self.lock.acquire()
+        try:
+            return {
+                'openDecks': sum([len(w.decks) for w in self.workers]),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'latency': dict([(k, (v[0], v[1] / v[0], v[2]))
+                                 for (k, v) in self.latency.items()]),
+                }
+        finally:
+            self.lock.release()
+
+    def close(self):
+        "Close all decks and stop the workers."
+        for worker in self.workers:
+            worker.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+
+class SyncJob(object):
+
+    def __init__(self, key, fn, create):
+        self.key = key
+        self.fn = fn
+        self.create = create
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SyncWorker(threading.Thread):
+    "A thread owning some of a SyncServerPool's decks."
+
+    def __init__(self, pool, maxDecks):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.pool = pool
+        self.maxDecks = maxDecks
+        self.jobs = Queue.Queue()
+        # key -> [server, last used]
+        self.decks = {}
+        self.clock = 0
+
+    def call(self, key, fn, create=False):
+        "Queue FN for the deck KEY, and wait for its result."
+        job = SyncJob(key, fn, create)
+        self.jobs.put(job)
+        job.done.wait()
+        if job.error:
+            raise job.error[0], job.error[1], job.error[2]
+        return job.result
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                job.result = job.fn(self.server(job.key, job.create))
+            except:
+                job.error = sys.exc_info()
+                # the next job would commit whatever was half done
+                if job.key in self.decks:
+                    self.discardDeck(job.key)
+            job.done.set()
+        for key in self.decks.keys():
+            self.closeDeck(key)
+
+    def server(self, key, create):
+        "Return the HttpSyncServer for KEY, opening the deck if necessary."
+        if key in self.decks:
+            self.pool.count('hits')
+            self.clock += 1
+            self.decks[key][1] = self.clock
+            return self.decks[key][0]
+        self.pool.count('misses')
+        path = self.pool.deckPath(key)
+        if not create and not os.path.exists(path):
+            raise SyncError(type="noDeck", name=key[1])
+        if len(self.decks) >= self.maxDecks:
+            lru = min([(v[1], k) for (k, v) in self.decks.items()])[1]
+            self.closeDeck(lru)
+            self.pool.count('evictions')
+        server = HttpSyncServer()
+        server.deck = anki.deck.DeckStorage.Deck(path, rebuild=False,
+                                                 backup=False)
+        self.clock += 1
+        self.decks[key] = [server, self.clock]
+        return server
+
+    def closeDeck(self, key):
+        server = self.decks.pop(key)[0]
+        server.deck.s.commit()
+        server.deck.close()
+
+    def discardDeck(self, key):
+        "Close the deck KEY, rolling back any uncommitted changes."
+        self.decks.pop(key)[0].deck.close()
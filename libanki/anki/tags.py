@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+Tags - an index of the tags on cards and facts
+===============================================
+
+Tags are stored as comma separated strings on cards, facts and models. So
+that cards can be found by tag without parsing every string in the deck, the
+tags of cards and facts are also interned in the tags table, and linked to
+the cards/facts which use them.
+
+The links are updated when the ORM writes a card or fact. Code which changes
+tags in SQL needs to call indexTags()/unindexTags() itself.
+"""
+__docformat__ = 'restructuredtext'
+
+from anki.db import *
+from anki.utils import parseTags, ids2str
+
+tagsTable = Table(
+    'tags', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('tag', UnicodeText, nullable=False),
+    # tags are compared without case
+    Column('key', UnicodeText, nullable=False, unique=True))
+
+cardTagsTable = Table(
+    'cardTags', metadata,
+    Column('cardId', Integer, ForeignKey("cards.id"), nullable=False,
+           index=True),
+    Column('tagId', Integer, ForeignKey("tags.id"), nullable=False,
+           index=True))
+
+factTagsTable = Table(
+    'factTags', metadata,
+    Column('factId', Integer, ForeignKey("facts.id"), nullable=False,
+           index=True),
+    Column('tagId', Integer, ForeignKey("tags.id"), nullable=False,
+           index=True))
+
+# table -> (link table, link column)
+links = {
+    'cards': ('cardTags', 'cardId'),
+    'facts': ('factTags', 'factId'),
+    }
+
+def tagIds(db, tags, create=True):
+    """Return a dict of lowercase tag -> id for the list TAGS. Unknown tags
+    are added, or left out if CREATE is false."""
+    ids = {}
+    for tag in tags:
+        key = tag.lower()
+        if key in ids:
+            continue
+        row = db.execute(text("select id from tags where key = :key"),
+                         {'key': key}).fetchone()
+        if row:
+            ids[key] = row[0]
+        elif create:
+            ids[key] = db.execute(tagsTable.insert(), {
+                'tag': tag, 'key': key}).last_inserted_ids()[0]
+    return ids
+
+def indexTags(db, table, ids=None):
+    "Relink IDS in TABLE (or all of them) to the tags in their tag strings."
+    (linkTable, col) = links[table]
+    if ids is None:
+        db.execute(text("delete from %s" % linkTable))
+        rows = db.execute(text(
+            "select id, tags from %s where tags != ''" % table)).fetchall()
+    else:
+        if not ids:
+            return
+        unindexTags(db, table, ids)
+        rows = db.execute(text(
+            "select id, tags from %s where id in %s and tags != ''" % (
+            table, ids2str(ids)))).fetchall()
+    # most strings are shared by many cards/facts
+    parsed = {}
+    for (id, tags) in rows:
+        if tags not in parsed:
+            parsed[tags] = parseTags(tags)
+    known = tagIds(db, [t for tags in parsed.values() for t in tags])
+    data = []
+    for (id, tags) in rows:
+        for tagId in set([known[t.lower()] for t in parsed[tags]]):
+            data.append({'id': id, 'tagId': tagId})
+    if data:
+        db.execute(text("insert into %s values (:id, :tagId)" % linkTable),
+                   data)
+
+def unindexTags(db, table, ids):
+    "Remove the tag links of IDS in TABLE."
+    (linkTable, col) = links[table]
+    db.execute(text("delete from %s where %s in %s" % (
+        linkTable, col, ids2str(ids))))
+
+class TagIndexExtension(MapperExtension):
+    "Relink the tags of a card/fact when the ORM writes it."
+
+    def __init__(self, table):
+        MapperExtension.__init__(self)
+        self.table = table
+
+    def after_insert(self, mapper, connection, instance):
+        if instance.tags:
+            indexTags(connection, self.table, [instance.id])
+        return EXT_CONTINUE
+
+    def after_update(self, mapper, connection, instance):
+        # the old value is only recorded if the tags were changed
+        old = instance._state.committed_state.get('tags', instance.tags)
+        if old != instance.tags:
+            indexTags(connection, self.table, [instance.id])
+        return EXT_CONTINUE
+
+    def after_delete(self, mapper, connection, instance):
+        unindexTags(connection, self.table, [instance.id])
+        return EXT_CONTINUE
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+Transfer - copying objects between decks in SQL
+=================================================
+
+As in Deck.saveAs(), the deck being read is attached to the connection of the
+deck being written, and rows are copied with insert ... select. The ids to
+copy are first gathered in temporary tables, so the rows never pass through
+Python.
+
+Decks share SQLite's cache, so an export reads the changes the source deck
+has flushed, even if they aren't committed. Attaching a database commits the
+writing connection's pending changes, so a deck being imported into should be
+saved first.
+"""
+__docformat__ = 'restructuredtext'
+
+import time
+from anki.db import *
+from anki.cards import cardsTable
+from anki.facts import factsTable, fieldsTable
+from anki.models import modelsTable, fieldModelsTable, cardModelsTable
+from anki.history import reviewHistoryTable
+from anki.stats import statsTable
+from anki.tags import tagsTable, cardTagsTable, factTagsTable, links
+from anki.deck import decksTable
+
+def attach(deck, path):
+    "Attach the deck at PATH to DECK's connection as 'src'."
+    deck.s.flush()
+    deck.s.statement("attach database :path as src", path=path)
+
+def detach(deck, tables):
+    "Drop the temporary TABLES and detach 'src'."
+    for name in tables:
+        deck.s.statement("drop table if exists temp.%s" % name)
+    deck.s.statement("detach database src")
+
+def collectIds(deck, name, sql=None, **args):
+    """Fill the temporary table NAME with the ids selected by SQL, or leave it
+    empty if SQL is None."""
+    deck.s.statement(
+        "create temporary table if not exists %s (id integer primary key)" %
+        name)
+    deck.s.statement("delete from %s" % name)
+    if sql:
+        deck.s.statement("insert or ignore into %s %s" % (name, sql), **args)
+
+def copyRows(deck, table, where, **args):
+    """Copy the rows of TABLE in 'src' matching WHERE. The columns are named,
+    as decks upgraded in place may have them in a different order."""
+    cols = ", ".join(['"%s"' % c.name for c in table.columns])
+    deck.s.statement("insert into %s (%s) select %s from src.%s where %s" % (
+        table.name, cols, cols, table.name, where), **args)
+
+def exportDeck(deck, path, cardIds=None):
+    """Copy the cards of the deck at PATH into the new, empty DECK, with their
+    facts, models, and tag index. If CARDIDS is given, only those cards are
+    copied. The deck's settings and stats are copied as well."""
+    deck.s.statement("pragma read_uncommitted = 1")
+    attach(deck, path)
+    tables = ["exportCards", "exportFacts", "exportModels"]
+    try:
+        if cardIds is None:
+            collectIds(deck, "exportCards", "select id from src.cards")
+        else:
+            collectIds(deck, "exportCards")
+            deck.s.connection().execute(
+                "insert or ignore into exportCards values (?)",
+                [(id,) for id in cardIds])
+        collectIds(deck, "exportFacts", """
+select factId from src.cards where id in (select id from exportCards)""")
+        collectIds(deck, "exportModels", """
+select modelId from src.facts where id in (select id from exportFacts)""")
+        # the deck and its stats replace the defaults
+        deck.s.statement("delete from decks")
+        copyRows(deck, decksTable, "1")
+        deck.s.statement("update decks set syncName = null, lastSync = 0")
+        deck.s.statement("delete from stats")
+        copyRows(deck, statsTable, "1")
+        # models
+        copyRows(deck, modelsTable, "id in (select id from exportModels)")
+        for table in (fieldModelsTable, cardModelsTable):
+            copyRows(deck, table,
+                     "modelId in (select id from exportModels)")
+        deck.s.statement("""
+update decks set currentModelId = (select min(id) from models)
+where currentModelId not in (select id from models)""")
+        # facts and cards
+        copyRows(deck, factsTable, "id in (select id from exportFacts)")
+        copyRows(deck, fieldsTable, "factId in (select id from exportFacts)")
+        copyRows(deck, cardsTable, "id in (select id from exportCards)")
+        copyRows(deck, reviewHistoryTable,
+                 "cardId in (select id from exportCards)")
+        # the tag index of the copied cards and facts
+        copyRows(deck, cardTagsTable,
+                 "cardId in (select id from exportCards)")
+        copyRows(deck, factTagsTable,
+                 "factId in (select id from exportFacts)")
+        copyRows(deck, tagsTable, """
+id in (select tagId from main.cardTags union
+select tagId from main.factTags)""")
+    finally:
+        detach(deck, tables)
+
+def importDeck(deck, path):
+    """Copy the models, facts and cards of the deck at PATH which DECK
+    doesn't have into DECK. Return the ids of the added (facts, cards).
+
+    As when syncing with the other deck marked older, objects DECK already
+    has are left alone, and those DECK has deleted aren't added back. Cards
+    are added only if their fact and card model are in DECK. The added
+    objects are marked modified, so they're sent on the next sync. Their tags
+    are indexed from the other deck's index."""
+    attach(deck, path)
+    tables = ["importModels", "importFacts", "importCards"]
+    now = time.time()
+    try:
+        collectIds(deck, "importModels", """
+select id from src.models where
+id not in (select id from main.models) and
+id not in (select modelId from main.modelsDeleted)""")
+        copyRows(deck, modelsTable, "id in (select id from importModels)")
+        for table in (fieldModelsTable, cardModelsTable):
+            copyRows(deck, table,
+                     "modelId in (select id from importModels)")
+        deck.s.statement("""
+update models set deckId = :deckId, modified = :now
+where id in (select id from importModels)""", deckId=deck.id, now=now)
+        collectIds(deck, "importFacts", """
+select id from src.facts where
+id not in (select id from main.facts) and
+id not in (select factId from main.factsDeleted) and
+modelId in (select id from main.models)""")
+        copyRows(deck, factsTable, "id in (select id from importFacts)")
+        copyRows(deck, fieldsTable, "factId in (select id from importFacts)")
+        deck.s.statement("""
+update facts set modified = :now
+where id in (select id from importFacts)""", now=now)
+        collectIds(deck, "importCards", """
+select id from src.cards where
+id not in (select id from main.cards) and
+id not in (select cardId from main.cardsDeleted) and
+factId in (select id from main.facts) and
+cardModelId in (select id from main.cardModels)""")
+        copyRows(deck, cardsTable, "id in (select id from importCards)")
+        deck.s.statement("""
+update cards set modified = :now
+where id in (select id from importCards)""", now=now)
+        # the tag index, matching tags by key
+        deck.s.statement("""
+insert into tags (tag, key)
+select tag, key from src.tags where key not in (select key from main.tags)""")
+        for (table, ids) in (("cards", "importCards"),
+                             ("facts", "importFacts")):
+            (linkTable, col) = links[table]
+            deck.s.statement("""
+insert into %(link)s (%(col)s, tagId)
+select l.%(col)s, t.id from src.%(link)s l, src.tags st, main.tags t
+where l.%(col)s in (select id from %(ids)s)
+and st.id = l.tagId and t.key = st.key""" % {
+                'link': linkTable, 'col': col, 'ids': ids})
+        ids = (deck.s.column0("select id from importFacts"),
+               deck.s.column0("select id from importCards"))
+    finally:
+        detach(deck, tables)
+    return ids
@@ -113,30 +113,51 @@ def deleteTags(tagstr, tags):
             pass
     return u", ".join(currentTags)
 
+def ids2str(ids):
+    "Given a list of integers, return a string '(int1,int2,...)'."
+    return "(%s)" % ",".join([str(id) for id in ids])
+
 def stripHTML(s):
     s = re.sub("<.*?>", "", s)
     s = s.replace("&lt;", "<")
     s = s.replace("&gt;", ">")
     return s
 
-def genID(static=[]):
+# the current millisecond, and the random parts used in it
+_idState = [None, {}]
+
+def genID():
     "Generate a random, unique 64bit ID."
+    return genIDs(1)[0]
+
+def genIDs(count):
+    "Generate COUNT random, unique 64bit IDs."
     # 23 bits of randomness, 41 bits of current time
     # random rather than a counter to ensure efficient btree
-    t = long(time.time()*1000)
-    if not static:
-        static.extend([t, {}])
-    else:
-        if static[0] != t:
-            static[0] = t
-            static[1] = {}
-    while 1:
-        rand = random.getrandbits(23)
-        if rand not in static[1]:
-            static[1][rand] = True
-            break
-    x = rand << 41 | t
-    # turn into a signed long
-    if x >= 9223372036854775808L:
-        x -= 18446744073709551616L
-    return x
+    ids = []
+    while len(ids) < count:
+        t = long(time.time()*1000)
+        if _idState[0] != t:
+            _idState[0] = t
+            _idState[1] = {}
+        used = _idState[1]
+        # keep a millisecond at most half full, so collisions stay rare
+        n = min(count - len(ids), (1 << 22) - len(used))
+        if n <= 0:
+            time.sleep(0.001)
+            continue
+        while n:
+            rand = random.getrandbits(23)
+            if rand in used:
+                continue
+            used[rand] = True
+            x = rand << 41 | t
+            # turn into a signed long
+            if x >= 9223372036854775808L:
+                x -= 18446744073709551616L
+            ids.append(x)
+            n -= 1
+    # the random bits are high, so the ids land all over the table's btree;
+    # sorting them just means a bulk insert visits its pages in order
+    ids.sort()
+    return ids
@@ -64,13 +64,41 @@ def test_saveAs():
     # add a card
     f = deck.newFact()
     f['Front'] = u"foo"; f['Back'] = u"bar"
+    f.tags = u"foo"
     deck.addFact(f)
     # save in new deck
     newDeck = deck.saveAs(path)
     assert newDeck.totalCardCount() == 1
+    # the tag index is copied
+    assert len(newDeck.cardIdsWithTags(u"foo")) == 1
+    assert u"foo" in newDeck.allTags()
     newDeck.close()
     deck.close()
 
+def test_staleTagIndex():
+    from anki.deck import DECK_VERSION
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    for (n, tags) in enumerate((u"foo", u"bar", u" , ")):
+        f = deck.newFact()
+        f['Front'] = u"f%d" % n; f['Back'] = u"b%d" % n
+        f.tags = tags
+        deck.addFact(f)
+    deck.s.flush()
+    links = deck.s.all("select * from factTags order by factId")
+    # a deck copied without the index, by a version which didn't keep one
+    deck.s.statement("delete from factTags")
+    deck.version = 0
+    DeckStorage._checkTagIndex(deck)
+    assert deck.s.all("select * from factTags order by factId") == links
+    assert len(deck.cardIdsWithTags(u"foo")) == 1
+    assert deck.version == DECK_VERSION
+    # decks which keep the index aren't scanned
+    deck.s.statement("delete from factTags")
+    DeckStorage._checkTagIndex(deck)
+    assert not deck.s.all("select * from factTags")
+    deck.close()
+
 def test_factAddDelete():
     deck = DeckStorage.Deck()
     deck.addModel(BasicModel())
@@ -137,3 +165,362 @@ def test_modelAddDelete():
     assert deck.totalCardCount() == 0
     deck.s.refresh(deck)
     assert deck.currentModel == None
+
+def test_queueWindow():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    for n in range(5):
+        f = deck.newFact()
+        f['Front'] = u"f%d" % n; f['Back'] = u"b%d" % n
+        deck.addFact(f)
+    # make sure they're due
+    deck.s.statement("update cards set due = due - 60")
+    # only a batch of new cards should be loaded
+    deck.queueLimit = 2
+    deck.rebuildQueue()
+    assert len(deck.acqQueue) == 2
+    assert deck.getStats()['new'] == 5
+    # deleting a card should remove it from the queue
+    id = deck.acqQueue.peek().id
+    deck.deleteCard(id)
+    assert not deck.cardIsQueued(id)
+    # the queue should be topped up as it drains
+    seen = []
+    card = deck.getCard()
+    while card:
+        seen.append(card.id)
+        deck.answerCard(card, 4)
+        # answered cards are due outside the window
+        assert not deck.cardIsQueued(card.id)
+        card = deck.getCard()
+    assert len(seen) == 4 and id not in seen
+    assert deck.getStats()['new'] == 0
+
+def test_queueIdle():
+    import time
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    f = deck.newFact()
+    f['Front'] = u"f"; f['Back'] = u"b"
+    deck.addFact(f)
+    deck.s.statement("update cards set due = due - 60")
+    card = deck.getCard()
+    deck.answerCard(card, 4)
+    # the card is due after the window, so nothing is left to review
+    deck.s.statement("update cards set due = :due",
+                     due=time.time() + deck.queueLookahead * 2)
+    deck.rebuildQueue()
+    assert deck.getCard() is None
+    assert deck.queueBacklog[1] == 0
+    # the app sits idle past the window while the card comes due
+    deck.s.statement("update cards set due = :due", due=time.time() - 60)
+    deck.queueCutoff = time.time() - 30
+    card = deck.getCard()
+    assert card and card.id == f.cards[0].id
+
+def test_refreshQueue():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    for n in range(5):
+        f = deck.newFact()
+        f['Front'] = u"f%d" % n; f['Back'] = u"b%d" % n
+        deck.addFact(f)
+    deck.s.statement("update cards set due = due - 60")
+    ids = deck.s.column0("select id from cards")
+    deck.rebuildQueue()
+    deck.idChunk = 2
+    # cards changed in SQL are reloaded a chunk at a time
+    deck.s.statement("update cards set priority = 0")
+    deck.refreshQueueCards(ids)
+    assert not [id for id in ids if deck.cardIsQueued(id)]
+    deck.s.statement("update cards set priority = 2")
+    deck.refreshQueueFacts(deck.s.column0("select id from facts"))
+    assert len(deck.acqQueue) == 5
+    # with one statement, however many ids there are
+    before = deck.statementCacheStats()
+    deck.refreshQueueCards(ids)
+    after = deck.statementCacheStats()
+    assert after['misses'] == before['misses']
+    assert len(deck.acqQueue) == 5
+
+def test_failedQueue():
+    from anki.deck import FailedQueue, QueueItem
+    q = FailedQueue()
+    # (due, id, modified)
+    for (due, id, mod) in ((10, 1, 5), (20, 2, 3), (30, 3, 1), (100, 4, 0)):
+        q.push(QueueItem(due, id, mod, 2, 1, 0, 0, id, 0, 0))
+    assert q.dueWithin(0, 20) == 2 and q.dueWithin(0, 1000) == 4
+    assert q.peek().id == 1
+    # oldest modified within window, ignoring card 4
+    assert q.popOldestModified(0, 50).id == 3
+    assert q.popOldestModified(0, 50).id == 2
+    assert q.dueWithin(0, 50) == 1 and q.dueWithin(0, 20) == 1
+    # a card failed again after the window was filled
+    q.push(QueueItem(40, 5, -1, 2, 1, 0, 0, 5, 0, 0))
+    assert q.dueWithin(0, 50) == 2 and q.dueWithin(60, 50) == 3
+    assert q.popOldestModified(0, 50).id == 5
+    q.remove(1)
+    assert q.popOldestModified(0, 50) is None
+    assert len(q) == 1 and q.pop().id == 4
+
+def test_revQueue():
+    from anki.deck import CardQueue, QueueItem, revKey
+    q = CardQueue(revKey)
+    now = q.keyTime
+    # (due, id, modified, priority, reps, successive, interval)
+    q.push(QueueItem(now - 100, 1, 0, 2, 1, 1, 10, 1, 0, 0))
+    q.push(QueueItem(now - 5, 2, 0, 2, 1, 1, 1, 2, 0, 0))
+    assert q.peek().id == 1
+    # later on, the card with the shorter interval is more overdue
+    q.rekey(now + 1000)
+    assert len(q) == 2 and q.pop().id == 2 and q.pop().id == 1
+
+def test_statementCache():
+    deck = DeckStorage.Deck()
+    deck.totalCardCount()
+    before = deck.statementCacheStats()
+    deck.totalCardCount()
+    deck.totalCardCount()
+    after = deck.statementCacheStats()
+    assert after['hits'] == before['hits'] + 2
+    assert after['misses'] == before['misses']
+
+def test_answerCards():
+    import random
+    from anki.cards import Card
+    deck = DeckStorage.Deck()
+    m = BasicModel()
+    m.cardModels[1].active = True
+    deck.addModel(m)
+    for n in range(3):
+        f = deck.newFact()
+        f['Front'] = u"f%d" % n; f['Back'] = u"b%d" % n
+        deck.addFact(f)
+    deck.s.statement("update cards set due = due - 60")
+    deck.s.commit()
+    ids = deck.s.column0("select id from cards order by factId, ordinal")
+    answers = zip(ids, (0, 1, 2, 3, 4, 2), (2, 3, 70, 1, 5, 8))
+    def state():
+        # (exact values, times)
+        return ((deck.s.all("""
+select id, interval, factor, reps, successive, yesCount, noCount
+from cards order by id"""),
+                 deck.s.all("""
+select cardId, lastInterval, nextInterval, ease, nextFactor, thinkingTime
+from reviewHistory order by id"""),
+                 deck.s.all("""
+select type, reps, reviewTime, distractedTime, distractedReps, newEase1,
+newEase4 from stats order by type""")),
+                deck.s.column0("select due from cards order by id") +
+                deck.s.column0("select spaceUntil from facts order by id"))
+    def batch():
+        ret = []
+        for (id, ease, t) in answers:
+            card = deck.s.query(Card).get(id)
+            card.fuzz = 1
+            ret.append((card, ease, t))
+        return ret
+    # one at a time
+    deck.rebuildQueue()
+    random.seed(1)
+    for (card, ease, t) in batch():
+        card._thinkingTime = t
+        deck.answerCard(card, ease)
+    (single, times) = state()
+    deck.rollback()
+    # all at once
+    deck.rebuildQueue()
+    random.seed(1)
+    deck.answerCards(batch())
+    (batched, times2) = state()
+    assert batched == single
+    assert len(single[1]) == 6
+    for (a, b) in zip(times, times2):
+        assert abs(a - b) < 5
+    # the written objects are clean
+    assert not deck.s.dirty
+
+def test_typedQueries():
+    import random, time
+    deck = DeckStorage.Deck()
+    m = BasicModel()
+    m.cardModels[1].active = True
+    deck.addModel(m)
+    for n in range(40):
+        f = deck.newFact()
+        f['Front'] = u"f%d" % n; f['Back'] = u"b%d" % n
+        deck.addFact(f)
+    # scatter the cards across all the types
+    random.seed(0)
+    now = time.time()
+    for (id, fid) in deck.s.all("select id, factId from cards"):
+        reps = random.choice((0, 0, 1, 5))
+        deck.s.statement("""
+update cards set priority = :p, reps = :r, successive = :s, due = :d
+where id = :id""", p=random.randint(0, 4), r=reps,
+                         s=reps and random.choice((0, 1, 3)) or 0,
+                         d=now + random.uniform(-86400, 86400), id=id)
+        deck.s.statement("""
+update facts set spaceUntil = :s, lastCardId = :l where id = :id""",
+                         s=random.choice((0, now + random.uniform(-600, 600))),
+                         l=random.choice((None, id, 0)), id=fid)
+    view = lambda type: deck.s.scalar(
+        "select count(id) from typedCards where type = :t", t=type)
+    assert deck.pendingSuccessiveCount() == view(1)
+    assert deck.pendingNewCount() == view(2)
+    assert deck.pendingFailedCount() == deck.s.scalar(
+        "select count(id) from typedCards where due <= :now and type = 0",
+        now=time.time() + deck.collapseTime)
+    # the whole window holds exactly the failed and future cards
+    rows = deck.s.all(deck._typed % 0 + deck._failedCards +
+                      " and cards.due > :lo and cards.due <= :hi union all " +
+                      deck._typed % 3 + deck._futureCards, lo=0, hi=now * 2)
+    assert sorted(map(tuple, rows)) == sorted(map(tuple, deck.s.all(
+        deck._queue + " where type in (0, 3)")))
+    # and counts use an index rather than scanning the deck
+    for sql in (deck._countTyped + deck._revCards,
+                deck._countTyped + deck._acqCards):
+        cur = deck.s.connection().connection.cursor()
+        cur.execute("explain query plan " + sql)
+        plan = " ".join([str(r) for r in cur.fetchall()])
+        assert "SCAN" not in plan
+
+def test_updateAllPriorities():
+    deck = DeckStorage.Deck()
+    m = BasicModel()
+    m.cardModels[1].active = True
+    deck.addModel(m)
+    for (n, tags) in enumerate((u"", u"foo", u"Foo, bar", u"baz,bar")):
+        f = deck.newFact()
+        f['Front'] = u"f%d" % n; f['Back'] = u"b%d" % n
+        f.tags = tags
+        deck.addFact(f)
+    deck.s.statement("update cards set tags = 'qux' where ordinal = 1")
+    def check():
+        tagCache = deck.genTagCache()
+        for (id, tags, pri) in deck.tagsList():
+            assert pri == deck.priorityFromTagString(tags, tagCache)
+    deck.highPriority = u"foo"
+    deck.lowPriority = u"bar,qux"
+    deck.suspended = u"baz"
+    deck.updateAllPriorities()
+    check()
+    assert deck.suspendedCardCount() == 2
+    # only the changed cards are written
+    deck.s.statement("update cards set modified = 0")
+    deck.suspended = u""
+    deck.updateAllPriorities()
+    check()
+    assert deck.s.scalar("select count(id) from cards where modified != 0") == 2
+    # a call that fails part way doesn't break the next one
+    def fail(*args, **kwargs):
+        raise Exception("failed")
+    deck.s.all = fail
+    assertException(Exception, deck.updateAllPriorities)
+    del deck.s.all
+    deck.suspended = u"baz"
+    deck.updateAllPriorities()
+    check()
+    assert deck.suspendedCardCount() == 2
+
+def test_tagIndex():
+    deck = DeckStorage.Deck()
+    m = BasicModel()
+    m.tags = u"Basic"
+    deck.addModel(m)
+    facts = []
+    for (n, tags) in enumerate((u"foo", u"Foo, bar", u"")):
+        f = deck.newFact()
+        f['Front'] = u"f%d" % n; f['Back'] = u"b%d" % n
+        f.tags = tags
+        deck.addFact(f)
+        facts.append(f)
+    deck.s.flush()
+    cards = [f.cards[0].id for f in facts]
+    find = lambda tags: sorted(deck.cardIdsWithTags(tags))
+    # fact tags are matched without case
+    assert find(u"FOO") == sorted(cards[:2])
+    assert find(u"bar, missing") == [cards[1]]
+    # model tags and card model names
+    assert find(u"basic") == sorted(cards)
+    assert find(u"front to BACK") == sorted(cards)
+    # tags changed through the ORM
+    facts[2].tags = u"bar"
+    deck.s.flush()
+    assert find(u"bar") == sorted(cards[1:])
+    # bulk edits
+    deck.addCardTags(cards, u"baz, Foo")
+    assert find(u"baz") == sorted(cards)
+    assert deck.s.scalar("select tags from cards where id = :id",
+                         id=cards[0]) == u"baz, Foo"
+    deck.deleteFactTags([f.id for f in facts], u"FOO")
+    assert deck.s.column0("select tags from facts order by created") == [
+        u"", u"bar", u"bar"]
+    assert find(u"foo") == sorted(cards)
+    deck.deleteCardTags(cards[:2], u"foo")
+    assert find(u"foo") == [cards[2]]
+    counts = dict([(t.lower(), c) for (t, c) in deck.tagCounts()])
+    assert counts == {'foo': 1, 'bar': 2, 'baz': 3, 'basic': 3,
+                      'front to back': 3}
+    # deleted cards are dropped, and a rebuild gives the same result
+    deck.deleteCard(cards[2])
+    assert find(u"baz") == sorted(cards[:2])
+    links = deck.s.all("select * from cardTags order by cardId, tagId")
+    deck.rebuildTagIndex()
+    assert deck.s.all("select * from cardTags order by cardId, tagId") == links
+
+def test_factFields():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    f = deck.newFact()
+    f['Front'] = u"foo"; f['Back'] = u"bar"
+    assert f.keys() == ["Front", "Back"]
+    assert f.items() == [("Front", u"foo"), ("Back", u"bar")]
+    assertException(KeyError, lambda: f['Missing'])
+    assert f.get('Missing', 1) == 1
+    deck.addFact(f)
+    # renaming a field model is seen by existing facts
+    model = f.model
+    deck.renameFieldModel(model, model.fieldModels[0], u"Question")
+    assert f['Question'] == u"foo"
+    assert f.get('Front', None) is None
+    # as is a new one
+    fm = FieldModel(u"Extra", u"", False, False)
+    deck.addFieldModel(model, fm)
+    deck.s.refresh(f)
+    assert f.keys() == ["Question", "Back", "Extra"]
+
+def test_renderFields():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    f = deck.newFact()
+    f['Front'] = u"foo\nbar"; f['Back'] = u"baz"
+    f.tags = u"one"
+    deck.addFact(f)
+    deck.s.flush()
+    card = f.cards[0]
+    cm = card.cardModel
+    cm.qformat = u"%(Front)s|%(text:Front)s|%(tags)s|%(Back)s"
+    def check():
+        for type in ("question", "answer"):
+            for format in ("text", "html"):
+                assert (cm.renderFields(dict(f.items()), cm.cardTags(card),
+                                        type, format) ==
+                        cm.renderQA(card, f, type, format))
+    check()
+    assert cm.renderQA(card, f, "question") == (
+        u"foo\nbar|foo\nbar|one, Front to back|baz")
+    assert '<span class="Front">foo<br>bar</span>|foo\nbar|' in (
+        cm.renderQA(card, f, "question", "html"))
+    cm.qformat = u"%(Missing)s"
+    assert cm.renderQA(card, f, "question") == (
+        u"[invalid format; see model properties]")
+    cm.qformat = u""
+    assert cm.renderQA(card, f, "question") == u"[empty]"
+    check()
+    # bulk updates match
+    cm.qformat = u"%(Front)s %(tags)s"
+    deck.updateCardsFromModel(cm)
+    deck.s.refresh(card)
+    assert card.question == u"foo\nbar one, Front to back"
+    assert card.question == cm.renderQA(card, f, "question")
@@ -43,6 +43,24 @@ def test_export_anki():
     d2 = DeckStorage.Deck(newname)
     assert d2.totalCardCount() == 2
 
+@nose.with_setup(setup1)
+def test_export_anki_bySQL():
+    for bulkSQL in (False, True):
+        e = AnkiExporter(deck)
+        e.bulkSQL = bulkSQL
+        e.limitTags = ['tag']
+        newname = unicode(tempfile.mkstemp()[1])
+        os.unlink(newname)
+        e.exportInto(newname)
+        d2 = DeckStorage.Deck(newname)
+        assert d2.totalCardCount() == 2 and d2.totalFactCount() == 1
+        assert d2.s.scalar("select count() from fields") == 2
+        assert d2.currentModel.name == deck.currentModel.name
+        assert len(d2.cardIdsWithTags(u"tag2")) == 2
+        assert not d2.s.scalar("select sum(reps) from cards")
+        d2.close()
+        os.unlink(newname)
+
 @nose.with_setup(setup1)
 def test_export_textcard():
     e = TextCardExporter(deck)
@@ -52,6 +70,18 @@ def test_export_textcard():
     e.includeTags = True
     e.exportInto(f)
 
+    data = open(f).read()
+    assert e.count == 4 and data.count("\n") == 4
+    assert "foo\tbar\ttag, tag2" in data
+    # limited to a tag, written in small pieces
+    e.limitTags = ['tag2']
+    e.bufferSize = 5
+    e.exportInto(f)
+    assert e.count == 2
+    assert sorted(open(f).read().split("\n")) == [
+        "", "bar\tfoo\ttag, tag2", "foo\tbar\ttag, tag2"]
+    os.unlink(f)
+
 #     # test speed
 #     newname = unicode(tempfile.mkstemp()[1])
 #     os.unlink(newname)
@@ -70,6 +100,15 @@ def test_export_textfact():
     e.includeTags = True
     e.exportInto(f)
 
+    assert e.count == 2
+    assert open(f).read() in ("foo\tbar\ttag, tag2\nbaz\tqux\t",
+                              "baz\tqux\t\nfoo\tbar\ttag, tag2")
+    e.limitTags = ['tag']
+    e.exportInto(f)
+    assert e.count == 1
+    assert open(f).read() == "foo\tbar\ttag, tag2"
+    os.unlink(f)
+
 #    # test speed
 #     newname = unicode(tempfile.mkstemp()[1])
 #     os.unlink(newname)
@@ -6,6 +6,7 @@ from tests.shared import assertException
 from anki.errors import *
 from anki import DeckStorage
 from anki.importing import anki03, anki10, csv, mnemosyne10
+from anki.importing import UniqueIndex, DigestIndex, TableIndex
 from anki.stdmodels import BasicModel
 
 from anki.db import *
@@ -23,6 +24,112 @@ def test_csv():
     assert i.total == 4
     deck.s.close()
 
+def test_csv_batches():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    deck.save()
+    file = unicode(os.path.join(testDir, "importing/text-2fields.txt"))
+    i = csv.TextImporter(deck, file)
+    i.batchSize = 2
+    progress = []
+    i.progress = lambda *args: progress.append(args)
+    i.doImport()
+    # the same result as reading the whole file first
+    assert len(i.log) == 3
+    assert i.total == 4
+    assert deck.totalFactCount() == 4
+    # the file wasn't kept in memory
+    assert not i.lines
+    # a report per batch, and one at the end
+    assert len(progress) == 3
+    (processed, skipped, rate) = progress[-1]
+    assert processed - skipped == 4 and rate > 0
+    # cards checked against the earlier batches
+    deck.save()
+    i = csv.TextImporter(deck, file)
+    i.batchSize = 2
+    i.doImport()
+    assert i.total == 0
+    assert deck.totalFactCount() == 4
+    deck.s.close()
+
+def test_csv_batchesFail():
+    import tempfile
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    deck.save()
+    # invalid UTF-8 well after the first batch
+    (fd, path) = tempfile.mkstemp(suffix=".txt")
+    f = os.fdopen(fd, "w")
+    for n in range(100):
+        f.write("front %d\tback %d\n" % (n, n))
+    f.write("\xff\tbad\n")
+    f.close()
+    try:
+        i = csv.TextImporter(deck, unicode(path))
+        i.batchSize = 10
+        added = []
+        i.progress = lambda *args: added.append(deck.totalFactCount())
+        assertException(ImportFormatError, i.doImport)
+        # batches had been written, but none of them are kept
+        assert added and added[0] > 0
+        assert deck.totalFactCount() == 0 and deck.totalCardCount() == 0
+        assert not deck.s.scalar("select count() from fields")
+        # with unsaved changes, the file is read before anything is added,
+        # rather than rolling the changes back with a failed batch
+        f = deck.newFact()
+        f['Front'] = u"unsaved"; f['Back'] = u"change"
+        deck.addFact(f)
+        i = csv.TextImporter(deck, unicode(path))
+        i.batchSize = 10
+        assertException(ImportFormatError, i.doImport)
+        assert deck.s.column0("select value from fields "
+                              "where value = 'unsaved'")
+        assert deck.totalFactCount() == 1
+    finally:
+        os.unlink(path)
+    deck.s.close()
+
+def test_csv_bulkRows():
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    deck.s.statement("insert into factsDeleted values (1, 0)")
+    file = unicode(os.path.join(testDir, "importing/text-2fields.txt"))
+    i = csv.TextImporter(deck, file)
+    i.doImport()
+    # ids are unique, and rows were filled in with their column defaults
+    assert deck.s.scalar("select count(distinct id) from cards") == 4
+    assert deck.s.scalar("select count(distinct id) from fields") == 8
+    assert not deck.s.scalar("select count() from facts where created = 0")
+    assert deck.s.scalar("select count() from cards where question = ''") == 0
+    assert deck.totalCardCount() == 4
+    # unrelated deletions are kept
+    assert deck.s.scalar("select count() from factsDeleted") == 1
+    deck.s.close()
+
+def test_csv_uniqueIndex():
+    for index in (UniqueIndex, DigestIndex, TableIndex):
+        deck = DeckStorage.Deck()
+        deck.addModel(BasicModel())
+        f = deck.newFact()
+        f['Front'] = u"テスト"
+        f['Back'] = u"existing"
+        deck.addFact(f)
+        file = unicode(os.path.join(testDir, "importing/text-2fields.txt"))
+        i = csv.TextImporter(deck, file)
+        i.uniqueIndex = index
+        i.doImport()
+        # the dupe front in the file, and the one already in the deck
+        assert len(i.log) == 4
+        assert i.total == 3
+        # the next import sees the added cards
+        i = csv.TextImporter(deck, file)
+        i.uniqueIndex = index
+        i.batchSize = 2
+        i.doImport()
+        assert i.total == 0
+        deck.s.close()
+
 def test_mnemosyne10():
     deck = DeckStorage.Deck()
     deck.addModel(BasicModel())
@@ -62,3 +169,32 @@ def test_anki10():
     i.doImport()
     assert i.total == 0
     deck.s.rollback()
+
+def test_anki10_bySQL():
+    file = "/tmp/test10.anki"
+    shutil.copy(unicode(os.path.join(testDir, "importing/test10.anki")), file)
+    counts = []
+    for bulkSQL in (False, True):
+        deck = DeckStorage.Deck()
+        i = anki10.Anki10Importer(deck, file)
+        i.bulkSQL = bulkSQL
+        i.tagsToAdd = u"imported"
+        i.doImport()
+        assert i.total == 2
+        counts.append([deck.s.scalar("select count() from %s" % t)
+                       for t in ("models", "fieldModels", "cardModels",
+                                 "facts", "fields", "cards")] +
+                      sorted(deck.tagCounts()))
+        assert len(deck.cardIdsWithTags(u"imported")) == deck.totalCardCount()
+        if bulkSQL:
+            assert deck.s.scalar("select min(modified) from cards") > 1
+        # nothing is added twice, or added back after deleting
+        deck.deleteFact(deck.s.scalar("select min(id) from facts"))
+        deck.save()
+        i = anki10.Anki10Importer(deck, file)
+        i.bulkSQL = bulkSQL
+        i.doImport()
+        assert i.total == 0
+        deck.close()
+        os.unlink(deck.path)
+    assert counts[0] == counts[1]
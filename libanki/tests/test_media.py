@@ -0,0 +1,73 @@
+# coding: utf-8
+
+import nose, os, tempfile, shutil
+
+from anki import DeckStorage
+from anki.stdmodels import BasicModel
+from anki.media import checksum, scanMedia, rebuildMedia
+
+dir = None
+deck = None
+
+def setup_media():
+    global dir, deck
+    dir = tempfile.mkdtemp()
+    deck = DeckStorage.Deck(os.path.join(dir, "media.anki"))
+    deck.addModel(BasicModel())
+
+def teardown_media():
+    deck.close()
+    shutil.rmtree(dir)
+
+def writeFile(name, data):
+    path = os.path.join(dir, name)
+    open(path, "wb").write(data)
+    return path
+
+@nose.with_setup(setup_media, teardown_media)
+def test_addMedia():
+    path = writeFile("foo.JPG", "hello")
+    name = deck.addMedia(path)
+    assert name == checksum(path) + ".jpg"
+    assert open(os.path.join(deck.mediaDir(), name)).read() == "hello"
+    # the same content is stored once
+    assert deck.addMedia(writeFile("bar.jpg", "hello")) == name
+    assert os.listdir(deck.mediaDir()) == [name]
+    assert deck.s.all("select filename, size, checksum from media") == [
+        (name, 5, checksum(path))]
+    assert deck.addMedia(writeFile("baz.jpg", "world")) != name
+
+@nose.with_setup(setup_media, teardown_media)
+def test_rebuildMedia():
+    used = deck.addMedia(writeFile("foo.png", "foo"))
+    unused = deck.addMedia(writeFile("bar.mp3", "bar"))
+    f = deck.newFact()
+    f['Front'] = u'<img src="%s">' % used
+    f['Back'] = u'[sound:%s] <img src="%s">' % (used, used)
+    deck.addFact(f)
+    # files copied in by hand are picked up, and removed files dropped
+    open(os.path.join(deck.mediaDir(), "extra.txt"), "w").write("x")
+    os.unlink(os.path.join(deck.mediaDir(), unused))
+    assert rebuildMedia(deck) == ["extra.txt"]
+    assert deck.s.scalar("select refCount from media where filename = :f",
+                         f=used) == 3
+    assert not deck.s.scalar("select 1 from media where filename = :f",
+                             f=unused)
+    # known files aren't read again
+    open(os.path.join(deck.mediaDir(), "extra.txt"), "w").write("changed")
+    scanMedia(deck)
+    assert deck.s.scalar("select size from media where filename = :f",
+                         f=u"extra.txt") == 1
+
+@nose.with_setup(setup_media, teardown_media)
+def test_saveAsMedia():
+    name = deck.addMedia(writeFile("foo.png", "foo"))
+    newDeck = deck.saveAs(os.path.join(dir, "copy.anki"))
+    try:
+        assert newDeck.s.column0("select filename from media") == [name]
+        old = os.stat(os.path.join(deck.mediaDir(), name))
+        new = os.stat(os.path.join(newDeck.mediaDir(), name))
+        # the files are linked, not copied
+        assert old.st_ino == new.st_ino
+    finally:
+        newDeck.close()
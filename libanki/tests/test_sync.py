@@ -1,6 +1,6 @@
 # coding: utf-8
 
-import nose, os
+import nose, os, cgi, threading, BaseHTTPServer, tempfile, shutil
 from tests.shared import assertException
 
 from anki.errors import *
@@ -8,6 +8,8 @@ from anki import DeckStorage
 from anki.db import *
 from anki.stdmodels import BasicModel, JapaneseModel
 from anki.sync import SyncClient, SyncServer, HttpSyncServer, HttpSyncServerProxy
+from anki.sync import PackedRows, packRows, unpackRows, dumpBinary, loadBinary
+from anki.sync import mergeSorted, HttpTransport, SyncServerPool, Blob
 from anki.stats import dailyStats, globalStats
 from anki.facts import Fact
 from anki.cards import Card
@@ -209,6 +211,128 @@ def test_localsync_threeway():
     client2.sync()
     assert deck3.totalCardCount() == 5
 
+@nose.with_setup(setup_local, teardown)
+def test_localsync_chunked():
+    client.chunkSize = 1
+    client.sync()
+    assert deck1.totalFactCount() == 2 and deck1.totalCardCount() == 4
+    assert deck2.totalFactCount() == 2 and deck2.totalCardCount() == 4
+    assert deck1.modified == deck2.modified
+    assert deck1.lastSync == deck2.lastSync == deck1.modified
+    # history and stats in both directions
+    for (deck, other) in ((deck1, deck2), (deck2, deck1)):
+        deck.rebuildQueue()
+        deck.answerCard(deck.getCard(), 4)
+        deck.setModified()
+        client.sync()
+        assert other.s.scalar("select count(id) from reviewHistory") == (
+            deck.s.scalar("select count(id) from reviewHistory"))
+        assert globalStats(other.s).reps == globalStats(deck.s).reps
+    assert deck1.s.scalar("select count(id) from reviewHistory") == 2
+    # deletions
+    deck1.deleteFact(deck1.s.scalar("select id from facts limit 1"))
+    client.sync()
+    assert deck2.totalFactCount() == 1 and deck2.totalCardCount() == 2
+
+@nose.with_setup(setup_local, teardown)
+def test_localsync_resume():
+    client.chunkSize = 1
+    client.sync()
+    base = deck1.lastSync
+    assert base
+    deck2.rebuildQueue()
+    deck2.answerCard(deck2.getCard(), 4)
+    deck2.setModified()
+    # die after the server has handed over its deck
+    def fail(deck):
+        raise Exception()
+    client.updateDeck = fail
+    assertException(Exception, client.sync)
+    # the position is the last history entry received
+    last = tuple(deck2.s.first("select time, cardId from reviewHistory"))
+    assert client.loadCheckpoint() == {
+        'lastSync': base, 'phase': u"getHistory", 'position': last,
+        'serverModified': deck2.modified}
+    assert deck1.lastSync != deck2.lastSync
+    # the retry starts from the same point, not from scratch
+    del client.updateDeck
+    requests = []
+    getChunk = server.getChunk
+    def spy(request):
+        requests.append(request)
+        return getChunk(request)
+    server.getChunk = spy
+    client.sync()
+    assert client.lastSync == base
+    assert not [r for r in requests if r['key'] in ("cards", "facts")]
+    assert [r['after'] for r in requests if r['key'] == "history"] == [last]
+    assert deck1.s.scalar("select count() from reviewHistory") == 1
+    assert deck1.lastSync == deck2.lastSync
+    assert not client.loadCheckpoint()
+    # interrupted again, but another device syncs before the retry
+    del server.getChunk
+    deck2.setModified()
+    client.updateDeck = fail
+    assertException(Exception, client.sync)
+    deck3 = DeckStorage.Deck()
+    deck3.addModel(BasicModel())
+    f = deck3.newFact()
+    f['Front'] = u"other"; f['Back'] = u"device"
+    deck3.addFact(f)
+    client3 = SyncClient(deck3)
+    client3.setServer(server)
+    client3.sync()
+    assert deck2.s.scalar("select count() from facts") == 3
+    # the checkpoint is stale, so the retry starts from scratch
+    del client.updateDeck
+    client.sync()
+    assert client.lastSync == 0
+    assert deck1.s.scalar("select count() from facts") == 3
+    assert deck1.lastSync == deck2.lastSync
+    assert not client.loadCheckpoint()
+    deck3.close()
+
+@nose.with_setup(setup_local, teardown)
+def test_localsync_pipelined():
+    client.pipelined = True
+    client.chunkSize = 1
+    client.sync()
+    assert deck1.totalFactCount() == 2 and deck1.totalCardCount() == 4
+    assert deck2.totalFactCount() == 2 and deck2.totalCardCount() == 4
+    assert deck1.lastSync == deck2.lastSync == deck1.modified
+    for (deck, other) in ((deck1, deck2), (deck2, deck1)):
+        deck.rebuildQueue()
+        deck.answerCard(deck.getCard(), 4)
+        deck.setModified()
+        client.sync()
+        assert other.s.scalar("select count(id) from reviewHistory") == (
+            deck.s.scalar("select count(id) from reviewHistory"))
+    assert not client.loadCheckpoint()
+    for phase in ("summary", "models", "facts", "cards", "history", "deck"):
+        assert phase in client.timingReport()
+    assert client.timings['cards']['server'] > 0
+
+@nose.with_setup(setup_local, teardown)
+def test_summaryCache():
+    # repeat calls are served from the cache
+    sum = server.summary(0)
+    assert server.summary(0) is sum
+    assert len(sum['cards']) == 2
+    deck2.setModified()
+    assert server.summary(0) is not sum
+    # once nothing has changed since a lastSync, later ones don't query
+    assert not server.summary(deck2.modified)['cards']
+    def fail(*args, **kargs):
+        raise Exception()
+    deck2.s.all = fail
+    assert not server.summary(deck2.modified + 10)['cards']
+    assertException(Exception, lambda: server.summary(1))
+    del deck2.s.all
+    # a sync's writes clear the cache
+    sum = server.summary(0)
+    server.applyChunk({'history': []})
+    assert server.summary(0) is not sum
+
 # @nose.with_setup(setup_local, teardown)
 # def test_localsync_upgradeAndSync():
 #     base = "/home/resolve/tango-test.anki"
@@ -252,6 +376,78 @@ def test_localsync_threeway():
 
 #     client.sync()
 
+def test_mergeSorted():
+    assert list(mergeSorted([(3, 1), (1, 2)], [(2, 5), (3, 4), (4, 0)])) == [
+        (1, 2, None), (2, None, 5), (3, 1, 4), (4, None, 0)]
+    assert list(mergeSorted([], [(1, 2)])) == [(1, None, 2)]
+    # summaries are read through the modified indices
+    deck = DeckStorage.Deck()
+    cur = deck.s.connection().connection.cursor()
+    for table in ("cards", "facts", "models"):
+        cur.execute("explain query plan select id, modified from %s "
+                    "where modified > 0" % table)
+        assert "ix_%s_modified" % table in str(cur.fetchall())
+
+def test_packRows():
+    rows = [(1, 2.5, u"caf\xe9", None, 0),
+            (2**62, -1.0, u"", 3, 0)]
+    assert unpackRows(packRows(rows, "qdsqi")) == rows
+    assert unpackRows(packRows([], "qdsqi")) == []
+    data = loadBinary(dumpBinary({'a': [1, u"x"],
+                                  'b': {'c': PackedRows(packRows(rows,
+                                                                 "qdsqi"))}}))
+    assert data['a'] == [1, u"x"]
+    assert unpackRows(data['b']['c'].data) == rows
+
+@nose.with_setup(setup_local, teardown)
+def test_historyAndStats():
+    deck1.answerCard(deck1.getCard(), 4)
+    deck1.s.flush()
+    for binary in (False, True):
+        client.binary = binary
+        server.binary = binary
+        history = client.bundleHistory()
+        assert len(history) == 1
+        server.updateHistory(history)
+    # the second copy is skipped
+    assert deck2.s.all("select cardId, ease from reviewHistory") == [
+        (deck1.s.scalar("select cardId from reviewHistory"), 4)]
+    # days the server already has are kept
+    stats = client.bundleStats()
+    assert len(stats['daily']) == 1
+    globalStats(deck2.s)
+    dailyStats(deck2.s)
+    server.updateStats(stats)
+    assert dailyStats(deck2.s).reps == 0
+    assert globalStats(deck2.s).reps == 1
+    assert deck2.s.scalar("select count() from stats") == 2
+
+@nose.with_setup(setup_local, teardown)
+def test_historyBatches():
+    # several reviews at the same time, which batches must not split or skip
+    keys = [(t, id) for t in (100.5, 200.5)
+            for id in deck1.s.column0("select id from cards")]
+    for (t, id) in keys:
+        deck1.s.statement("""
+insert into reviewHistory (cardId, time, lastInterval, nextInterval, ease,
+delay, lastFactor, nextFactor, reps, thinkingTime, yesCount, noCount)
+values (:id, :t, 0, 1, 4, 0, 2.5, 2.5, 1, 1, 1, 0)""", id=id, t=t)
+    rows = []
+    after = (0, 0)
+    while True:
+        batch = client.historyRows(after, 1)
+        if not batch:
+            break
+        rows.extend(batch)
+        after = client.historyKey(batch)
+    assert [(r[1], r[0]) for r in rows] == sorted(keys)
+    # batches seek on the index
+    cur = deck1.s.connection().connection.cursor()
+    cur.execute("explain query plan select cardId from reviewHistory "
+                "where time >= 1 and (time > 1 or cardId > 1) "
+                "order by time, cardId limit 1")
+    assert "ix_reviewHistory_time" in str(cur.fetchall())
+
 # Remote tests
 ##########################################################################
 
@@ -273,6 +469,19 @@ def setup_remote():
     server.deck = deck2
     server.decks = {"test": (deck2.modified, 0)}
 
+@nose.with_setup(setup_remote, teardown)
+def test_remoteReplyFormat():
+    # each reply is in the format of its request
+    import zlib, simplejson
+    from anki.sync import BINARY_MAGIC
+    request = {'key': 'history', 'after': (0, 0), 'limit': 10}
+    reply = server.getChunk(zlib.compress(dumpBinary(request)))
+    assert zlib.decompress(reply).startswith(BINARY_MAGIC)
+    reply = server.getChunk(zlib.compress(simplejson.dumps(request)))
+    assert not zlib.decompress(reply).startswith(BINARY_MAGIC)
+    server.getChunk(zlib.compress(dumpBinary(request)))
+    assert not zlib.decompress(server.finishChunks()).startswith(BINARY_MAGIC)
+
 @nose.with_setup(setup_remote, teardown)
 def test_remotesync_fromserver():
     # deck two was modified last
@@ -285,3 +494,336 @@ def test_remotesync_toserver():
     deck1.setModified()
     client.sync()
     assert deck2.modified == deck1.modified
+
+@nose.with_setup(setup_remote, teardown)
+def test_remotesync_chunked():
+    client.chunkSize = 1
+    client.sync()
+    assert deck1.totalCardCount() == 4
+    assert deck2.totalCardCount() == 4
+    assert deck2.modified == deck1.modified
+
+@nose.with_setup(setup_remote, teardown)
+def test_remotesync_json():
+    # an older server doesn't report a protocol, and gets plain JSON
+    server.getDecks = lambda libanki, client: server.stuff({
+        "status": "OK", "decks": server.decks})
+    client.sync()
+    assert not server.binary
+    assert deck1.totalCardCount() == 4
+    assert deck2.totalCardCount() == 4
+
+@nose.with_setup(setup_remote, teardown)
+def test_remotesync_summaryCache():
+    sum = server.summary(server.stuff(0))
+    assert server.summary(server.stuff(0)) is sum
+    client.sync()
+    assert deck1.totalCardCount() == 4
+    assert server.summary(server.stuff(0)) is not sum
+
+# HTTP tests
+##########################################################################
+
+class TestHttpSyncServer(HttpSyncServer):
+
+    calls = 0
+
+    def cardCount(self):
+        return self.stuff(self.deck.totalCardCount())
+
+    def countCall(self):
+        self.calls += 1
+        return self.stuff(self.calls)
+
+class SyncHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Pass posted forms to an HttpSyncServer, keeping connections alive."
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    # drop this many requests without a reply
+    failures = 0
+    # run this many requests, but drop the connection part way through the
+    # reply
+    cutoffs = 0
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        SyncHandler.connections += 1
+
+    def do_POST(self):
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD': 'POST'})
+        if SyncHandler.failures:
+            SyncHandler.failures -= 1
+            self.close_connection = 1
+            return
+        args = dict([(k, form.getvalue(k)) for k in form.keys()
+                     if k not in ("d", "p", "u")])
+        ret = getattr(self.server.sync, self.path.split("/")[-1])(**args)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(ret)))
+        self.end_headers()
+        if SyncHandler.cutoffs:
+            SyncHandler.cutoffs -= 1
+            self.wfile.write(ret[:len(ret) / 2])
+            self.close_connection = 1
+            return
+        self.wfile.write(ret)
+
+    def log_message(self, *args):
+        pass
+
+httpd = None
+
+def serve(started):
+    # decks can only be used from the thread which opened them
+    global httpd
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    deck.currentModel.cardModels[1].active = True
+    f = deck.newFact()
+    f['Front'] = u"baz"; f['Back'] = u"qux"
+    deck.addFact(f)
+    httpd = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), SyncHandler)
+    httpd.sync = TestHttpSyncServer()
+    httpd.sync.deck = deck
+    httpd.sync.decks = {"test": (deck.modified, 0)}
+    started.set()
+    httpd.serve_forever(poll_interval=0.05)
+    httpd.server_close()
+
+def setup_http():
+    global client
+    setup_local()
+    SyncHandler.connections = 0
+    SyncHandler.failures = 0
+    SyncHandler.cutoffs = 0
+    started = threading.Event()
+    threading.Thread(target=serve, args=(started,)).start()
+    started.wait()
+    proxy = HttpSyncServerProxy("test", "foo")
+    proxy.deckName = "test"
+    proxy.syncURL = "http://127.0.0.1:%d/sync/" % httpd.server_address[1]
+    client = SyncClient(deck1)
+    client.setServer(proxy)
+
+def teardown_http():
+    client.server.close()
+    httpd.shutdown()
+
+@nose.with_setup(setup_http, teardown_http)
+def test_httpsync():
+    client.sync()
+    assert deck1.totalCardCount() == 4
+    assert client.server.runCmd("cardCount") == 4
+    # every call went over the one connection
+    assert SyncHandler.connections == 1
+
+@nose.with_setup(setup_http, teardown_http)
+def test_httpsync_retries():
+    proxy = client.server
+    proxy.transport = HttpTransport(proxy.syncURL, retries=2, backoff=0.01)
+    SyncHandler.failures = 2
+    # getDecks can be retried
+    proxy.connect()
+    assert SyncHandler.connections == 3
+    # other calls are only resent if a kept-alive connection was closed
+    SyncHandler.failures = 1
+    proxy.runCmd("cardCount")
+    assert SyncHandler.connections == 4
+    proxy.transport.close()
+    SyncHandler.failures = 1
+    assertException(SyncError, lambda: proxy.runCmd("cardCount"))
+    # retries are bounded
+    SyncHandler.failures = 3
+    assertException(SyncError, lambda: proxy.runCmd(
+        "summary", lastSync=proxy.stuff(0)))
+    SyncHandler.failures = 0
+    assert proxy.runCmd("summary", lastSync=proxy.stuff(0))
+    # a call the server ran on a kept-alive connection isn't run again if
+    # the reply is lost
+    assert proxy.runCmd("countCall") == 1
+    SyncHandler.cutoffs = 1
+    assertException(SyncError, lambda: proxy.runCmd("countCall"))
+    assert proxy.runCmd("countCall") == 3
+
+# Multi-deck server tests
+##########################################################################
+
+def poolProxy(pool, user, deckName):
+    proxy = HttpSyncServerProxy(user, "pass")
+    proxy.deckName = deckName
+    proxy.runCmd = lambda action, **args: proxy.unstuff(
+        pool.handle(user, deckName, action, **args))
+    return proxy
+
+@nose.with_setup(setup_local, teardown)
+def test_serverPool():
+    base = tempfile.mkdtemp()
+    pool = SyncServerPool(base, maxDecks=2, threads=2)
+    try:
+        proxy = poolProxy(pool, "alice", "mine")
+        proxy.connect()
+        assert proxy.decks == {}
+        proxy.createDeck("mine")
+        client.setServer(proxy)
+        client.sync()
+        assert pool.run("alice", "mine",
+                        lambda s: s.deck.totalCardCount()) == 2
+        # an action which fails part way leaves the deck unchanged
+        def fail(s):
+            s.deck.s.statement("delete from cards")
+            raise Exception()
+        assertException(Exception, lambda: pool.run("alice", "mine", fail))
+        assert pool.run("alice", "mine",
+                        lambda s: s.deck.totalCardCount()) == 2
+        assertException(Exception, lambda: pool.call(
+            "alice", "mine", "applyChunk", chunk=proxy.stuff({
+                'key': 'cards', 'deleted': deck1.s.column0(
+                    "select id from cards"), 'deck': {}, 'stats': None})))
+        assert pool.run("alice", "mine",
+                        lambda s: s.deck.totalCardCount()) == 2
+        proxy = poolProxy(pool, "alice", "mine")
+        assert proxy.availableDecks() == ["mine"]
+        assert proxy.modified() == deck1.modified
+        assertException(SyncError, lambda: poolProxy(
+            pool, "alice", "../mine").runCmd("summary",
+                                             lastSync=proxy.stuff(0)))
+        # more decks than the pool holds, used at once
+        errors = []
+        def use(user):
+            try:
+                p = poolProxy(pool, user, "deck")
+                p.connect()
+                p.createDeck("deck")
+                for n in range(5):
+                    p.summary(0)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=use, args=(u,))
+                   for u in ("bob", "carol", "dave", "erin")]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors
+        stats = pool.stats()
+        assert stats['openDecks'] <= 2
+        assert stats['evictions'] >= 3
+        assert stats['hits'] and stats['misses']
+        assert stats['latency']['summary'][0] >= 20
+    finally:
+        pool.close()
+        shutil.rmtree(base)
+
+@nose.with_setup(setup_local, teardown)
+def test_serverPool_pipelined():
+    base = tempfile.mkdtemp()
+    pool = SyncServerPool(base, threads=1)
+    try:
+        proxy = poolProxy(pool, "alice", "mine")
+        proxy.connect()
+        proxy.createDeck("mine")
+        # batches are sent from another thread
+        threads = {}
+        runCmd = proxy.runCmd
+        def spy(action, **args):
+            threads.setdefault(action, set()).add(threading.currentThread())
+            return runCmd(action, **args)
+        proxy.runCmd = spy
+        client.setServer(proxy)
+        client.pipelined = True
+        client.chunkSize = 1
+        client.sync()
+        for action in ("summary", "applyChunk"):
+            assert threading.currentThread() not in threads[action]
+        assert pool.run("alice", "mine",
+                        lambda s: s.deck.totalCardCount()) == 2
+        # and from the server
+        deck3 = DeckStorage.Deck()
+        client2 = SyncClient(deck3)
+        client2.setServer(poolProxy(pool, "alice", "mine"))
+        client2.pipelined = True
+        client2.sync()
+        assert deck3.totalCardCount() == 2
+        # deletions
+        deck1.deleteFact(deck1.s.scalar("select id from facts"))
+        client.sync()
+        assert pool.run("alice", "mine",
+                        lambda s: s.deck.totalCardCount()) == 0
+        # errors on the sender reach the caller
+        def fail(action, **args):
+            if action == "applyChunk":
+                raise SyncError(type="noResponse")
+            return runCmd(action, **args)
+        proxy.runCmd = fail
+        client.setServer(proxy)
+        deck1.setModified()
+        f = deck1.newFact()
+        f['Front'] = u"new"; f['Back'] = u"fact"
+        deck1.addFact(f)
+        assertException(SyncError, client.sync)
+        assert client.loadCheckpoint()
+    finally:
+        pool.close()
+        shutil.rmtree(base)
+
+@nose.with_setup(setup_local, teardown)
+def test_serverPool_media():
+    base = tempfile.mkdtemp()
+    pool = SyncServerPool(base, threads=1)
+    try:
+        local = DeckStorage.Deck(os.path.join(base, "local.anki"))
+        names = []
+        for data in ("foo", "bar", "baz"):
+            path = os.path.join(base, "file.txt")
+            open(path, "w").write(data)
+            names.append(local.addMedia(path))
+        # the same content under another name
+        shutil.copy(os.path.join(local.mediaDir(), names[0]),
+                    os.path.join(local.mediaDir(), "copy.txt"))
+        proxy = poolProxy(pool, "alice", "mine")
+        proxy.connect()
+        assert proxy.mediaSync
+        proxy.createDeck("mine")
+        sent = []
+        runCmd = proxy.runCmd
+        def spy(action, **args):
+            if action == "addMedia":
+                sent.append([f[2] and f[2].data for f in
+                             proxy.unstuff(args['files'])])
+            return runCmd(action, **args)
+        proxy.runCmd = spy
+        client = SyncClient(local)
+        client.setServer(proxy)
+        client.mediaChunkBytes = 2
+        client.sync()
+        # one file per batch, and the copy is linked on the server
+        assert sorted(sent) == [[None], ["bar"], ["baz"], ["foo"]]
+        def serverMedia(s):
+            return s.deck.s.column0("select filename from media")
+        assert sorted(pool.run("alice", "mine", serverMedia)) == sorted(
+            names + ["copy.txt"])
+        # and fetched by another client
+        other = DeckStorage.Deck(os.path.join(base, "other.anki"))
+        client = SyncClient(other)
+        client.setServer(poolProxy(pool, "alice", "mine"))
+        client.sync()
+        assert sorted(os.listdir(other.mediaDir())) == sorted(
+            names + ["copy.txt"])
+        assert open(os.path.join(other.mediaDir(), "copy.txt")).read() == (
+            "foo")
+        # nothing is sent once both sides have everything
+        sent[:] = []
+        client = SyncClient(local)
+        client.setServer(proxy)
+        client.sync()
+        assert not sent
+        # corrupt or misnamed files are refused
+        assertException(SyncError, lambda: proxy.addMedia([
+            [u"new.txt", names[0].split(".")[0], Blob("other")]]))
+        assertException(SyncError, lambda: proxy.getMedia([u"../mine.anki"]))
+        local.close()
+        other.close()
+    finally:
+        pool.close()
+        shutil.rmtree(base)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+History & stats sync benchmark
+===============================
+
+Bundles review history and daily stats on one deck and applies them to
+another, as a full sync does. The old code went through the ORM, saving one
+CardHistoryEntry per review and querying for each day's stats. As that takes
+too long for a large history, it's timed on the first OLD rows and scaled.
+
+    python tools/bench_history.py [reviews] [old]
+"""
+
+import os, sys, time, random
+from datetime import date
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from anki import DeckStorage
+from anki.sync import SyncTools
+from anki.stats import Stats, statsTable
+from anki.history import CardHistoryEntry
+
+DAYS = 1500
+
+# The old code
+##########################################################################
+
+def oldBundleHistory(tools, limit):
+    res = []
+    for h in tools.deck.s.query(CardHistoryEntry).filter(
+        CardHistoryEntry.time > tools.deck.lastSync).limit(limit):
+        h = tools.dictFromObj(h)
+        del h['id']
+        res.append(h)
+    return res
+
+def oldUpdateHistory(tools, history):
+    for h in history:
+        ent = CardHistoryEntry()
+        tools.applyDict(ent, h)
+        tools.deck.s.save(ent)
+    tools.deck.s.flush()
+
+def oldUpdateStats(tools, stats):
+    for record in stats['daily']:
+        record['day'] = date.fromordinal(record['day'])
+        stat = tools.deck.s.query(Stats).filter_by(type=1).filter_by(
+            day=record['day']).first()
+        if not stat:
+            stat = Stats(1)
+            tools.applyDict(stat, record)
+            tools.deck.s.save(stat)
+    tools.deck.s.flush()
+
+# Runs
+##########################################################################
+
+def setup(count):
+    random.seed(0)
+    deck = DeckStorage.Deck()
+    now = time.time()
+    deck.s.connection().execute("""
+insert into reviewHistory (cardId, time, lastInterval, nextInterval, ease,
+delay, lastFactor, nextFactor, reps, thinkingTime, yesCount, noCount)
+values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", [
+        (random.randint(1, 50000), now - n * 60, random.uniform(0, 100),
+         random.uniform(0, 100), random.randint(1, 4), random.uniform(0, 10),
+         2.5, 2.5, random.randint(1, 20), random.uniform(0, 60),
+         random.randint(0, 20), random.randint(0, 5))
+        for n in xrange(count)])
+    today = date.today().toordinal()
+    deck.s.execute(statsTable.insert(), [
+        {'type': 1, 'day': date.fromordinal(today - n),
+         'reps': random.randint(0, 200)} for n in range(DAYS)])
+    deck.s.flush()
+    return deck
+
+def timed(fn, *args):
+    t = time.time()
+    ret = fn(*args)
+    return (ret, time.time() - t)
+
+def report(name, rows, bundled, applied, scale=1):
+    print "%-12s %8d rows  bundle %6.2fs  apply %6.2fs" % (
+        name, rows, bundled * scale, applied * scale)
+
+if __name__ == "__main__":
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 1000000
+    old = min(count, len(sys.argv) > 2 and int(sys.argv[2]) or 20000)
+    src = setup(count)
+    tools = SyncTools(src)
+    print "%d reviews, %d days of stats" % (count, DAYS)
+    # history
+    (hist, bundled) = timed(oldBundleHistory, tools, old)
+    (x, applied) = timed(oldUpdateHistory, SyncTools(DeckStorage.Deck()), hist)
+    report("old (scaled)", count, bundled, applied, float(count) / old)
+    (hist, bundled) = timed(tools.bundleHistory)
+    (x, applied) = timed(SyncTools(DeckStorage.Deck()).updateHistory, hist)
+    report("new", count, bundled, applied)
+    tools.binary = True
+    (hist, bundled) = timed(tools.bundleHistory)
+    (x, applied) = timed(SyncTools(DeckStorage.Deck()).updateHistory, hist)
+    report("new packed", count, bundled, applied)
+    # daily stats
+    tools.binary = False
+    stats = tools.bundleStats()
+    dst = SyncTools(DeckStorage.Deck())
+    (x, applied) = timed(oldUpdateStats, dst, stats)
+    print "stats: old apply %.2fs," % applied,
+    stats = tools.bundleStats()
+    dst = SyncTools(DeckStorage.Deck())
+    (x, applied) = timed(dst.updateStats, stats)
+    print "new apply %.2fs" % applied
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+Pipelined sync benchmark
+=========================
+
+Syncs a new deck to a SyncServerPool and back to an empty deck, in batches,
+first one call at a time (syncChunks) and then pipelined. Each server call is
+delayed by LATENCY seconds, as if it went over the network. The pipelined runs
+report where the time went in each phase.
+
+    python tools/bench_pipeline.py [facts] [latency] [chunk]
+"""
+
+import os, sys, time, tempfile, shutil
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from anki import DeckStorage
+from anki.stdmodels import BasicModel
+from anki.sync import SyncClient, SyncServerPool, HttpSyncServerProxy
+
+def setup(count):
+    deck = DeckStorage.Deck()
+    deck.addModel(BasicModel())
+    deck.currentModel.cardModels[1].active = True
+    for n in xrange(count):
+        f = deck.newFact()
+        f['Front'] = u"front %d" % n
+        f['Back'] = u"back %d" % n
+        deck.addFact(f)
+    deck.s.flush()
+    return deck
+
+def proxy(pool, deckName, latency):
+    p = HttpSyncServerProxy("bench", "pass")
+    p.deckName = deckName
+    def runCmd(action, **args):
+        time.sleep(latency)
+        return p.unstuff(pool.handle("bench", deckName, action, **args))
+    p.runCmd = runCmd
+    p.connect()
+    return p
+
+def run(name, pool, deck, latency, chunk, pipelined):
+    server = proxy(pool, name, latency)
+    server.createDeck(name)
+    for (what, d) in (("up", deck), ("down", DeckStorage.Deck())):
+        client = SyncClient(d)
+        client.setServer(server)
+        client.chunkSize = chunk
+        client.pipelined = pipelined
+        t = time.time()
+        client.sync()
+        print "%-10s %-4s %6.2fs" % (name, what, time.time() - t)
+        if pipelined:
+            print client.timingReport()
+        if what == "up":
+            # leave the source deck as it was for the next run
+            d.lastSync = 0
+            d.s.statement("delete from syncState")
+            d.s.flush()
+
+if __name__ == "__main__":
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 2000
+    latency = len(sys.argv) > 2 and float(sys.argv[2]) or 0.05
+    chunk = len(sys.argv) > 3 and int(sys.argv[3]) or 500
+    deck = setup(count)
+    base = tempfile.mkdtemp()
+    pool = SyncServerPool(base)
+    try:
+        print "%d facts, %d cards, batches of %d, %.3fs latency" % (
+            count, count * 2, chunk, latency)
+        run("sequential", pool, deck, latency, chunk, False)
+        run("pipelined", pool, deck, latency, chunk, True)
+    finally:
+        pool.close()
+        shutil.rmtree(base)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+Scheduler queue benchmark
+==========================
+
+Builds the four scheduler queues for a synthetic deck, using the old
+per-queue item classes (compared with __cmp__) and the current QueueItem
+with precomputed keys, and reports build time, time to drain the queues and
+approximate memory per queued card. The new queues are faster to drain but
+not smaller: each card also has a heap entry holding its key, and a slot in
+the index by card id used for point updates, which is reported separately.
+
+    python tools/bench_queue.py [cards]
+"""
+
+import os, sys, time, random
+from heapq import heapify, heappop
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from anki.deck import QueueItem, CardQueue, dueKey, revKey, acqRandomKey
+
+# The old representation
+##########################################################################
+
+class OldItem(object):
+    __slots__ = ['due', 'id', 'modified', 'priority', 'reps', 'successive',
+                 'interval', 'factId', 'ordinal', 'created']
+    def __init__(self, due, id, modified, priority, reps, successive, interval,
+                 factId, ordinal, created):
+        self.due = due
+        self.id = id
+        self.modified = modified
+        self.priority = priority
+        self.reps = reps
+        self.successive = successive
+        self.interval = interval
+        self.factId = factId
+        self.ordinal = ordinal
+        self.created = created
+
+class FailedItem(OldItem):
+    __slots__ = []
+    def __cmp__(self, other):
+        return cmp(self.due, other.due)
+
+class RevItem(OldItem):
+    __slots__ = []
+    def __cmp__(self, other):
+        ret = cmp(other.priority, self.priority)
+        if ret != 0:
+            return ret
+        return cmp(self.interval / float(time.time() - self.due),
+                   other.interval / float(time.time() - other.due))
+
+class AcqRandomItem(OldItem):
+    __slots__ = []
+    def __cmp__(self, other):
+        ret = cmp(other.priority, self.priority)
+        if ret != 0:
+            return ret
+        ret = cmp(self.factId, other.factId)
+        if ret != 0:
+            return ret
+        return cmp(self.ordinal, other.ordinal)
+
+FutureItem = FailedItem
+
+# Synthetic deck
+##########################################################################
+
+def genRows(count):
+    "Return typedCards-style rows: (type, due, id, modified, ...)."
+    random.seed(0)
+    now = time.time()
+    rows = []
+    for n in xrange(count):
+        type = random.choice((0, 1, 2, 2, 3, 3, 3))
+        if type == 3:
+            due = now + random.uniform(60, 86400 * 30)
+        else:
+            due = now - random.uniform(60, 86400 * 30)
+        reps = type != 2 and random.randint(1, 20) or 0
+        rows.append((type, due, n + 1, now - random.uniform(0, 86400),
+                     random.randint(1, 4), reps, type == 1 and reps or 0,
+                     random.uniform(0, 100), n / 2, n % 2, now - n))
+    return rows
+
+def sizeOf(obj):
+    "Approximate size of OBJ and the tuples inside it."
+    size = sys.getsizeof(obj)
+    if isinstance(obj, tuple):
+        for x in obj:
+            # the due time is shared with the item
+            if not isinstance(x, float) or x is not obj[-1].due:
+                size += sizeOf(x)
+    return size
+
+# Runs
+##########################################################################
+
+def buildOld(rows):
+    classes = (FailedItem, RevItem, AcqRandomItem, FutureItem)
+    queues = []
+    for t in range(4):
+        q = [classes[t](*x[1:]) for x in rows if x[0] == t]
+        heapify(q)
+        queues.append(q)
+    return queues
+
+def drainOld(queues):
+    for q in queues:
+        while q:
+            heappop(q)
+
+def buildNew(rows):
+    queues = [CardQueue(k) for k in (dueKey, revKey, acqRandomKey, dueKey)]
+    for t in range(4):
+        queues[t].extend([QueueItem(*x[1:]) for x in rows if x[0] == t])
+    return queues
+
+def drainNew(queues):
+    for q in queues:
+        while q:
+            q.pop()
+
+def run(name, build, drain, rows, perCard):
+    t = time.time()
+    queues = build(rows)
+    built = time.time() - t
+    (heap, index) = perCard(queues)
+    t = time.time()
+    drain(queues)
+    drained = time.time() - t
+    print ("%-5s build %6.2fs  drain %6.2fs  ~%d bytes/card in heaps, "
+           "%d in id index" % (name, built, drained, heap, index))
+
+def oldPerCard(queues):
+    items = [i for q in queues for i in q]
+    return (sum([sys.getsizeof(i) for i in items]) / len(items), 0)
+
+def newPerCard(queues):
+    # item + entry tuple and its keys
+    entries = [e for q in queues for e in q.heap]
+    size = sum([sizeOf(e) for e in entries])
+    # the old queues had no way to find a card by id
+    index = sum([sys.getsizeof(q.ids) for q in queues])
+    return (size / len(entries), index / len(entries))
+
+if __name__ == "__main__":
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 500000
+    rows = genRows(count)
+    print "%d cards" % count
+    run("old", buildOld, drainOld, rows, oldPerCard)
+    run("new", buildNew, drainNew, rows, newPerCard)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+Card rendering benchmark
+=========================
+
+Renders the question of facts with 10 fields, using the old field access (a
+linear scan of the fields, resolving each name through its field model) and
+the current name -> field index. The index is measured both cold (rebuilt for
+every fact, as when facts are freshly loaded) and warm. It then rerenders all
+the cards after a template change, with one query per card (renderQASQL) and
+with the bulk updateCardQA().
+
+    python tools/bench_render.py [renders]
+"""
+
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from anki import DeckStorage
+from anki.models import Model, FieldModel, CardModel
+from anki.facts import Fact
+
+FIELDS = 10
+# distinct facts; renders cycle through them
+POOL = 1000
+
+# The old field access
+##########################################################################
+
+def oldGetItem(self, key):
+    try:
+        return [f.value for f in self.fields if f.name == key][0]
+    except IndexError:
+        raise KeyError
+
+def oldItems(self):
+    # what dict.update(fact) did
+    return [(k, self[k]) for k in [field.name for field in self.fields]]
+
+# Runs
+##########################################################################
+
+def setup():
+    deck = DeckStorage.Deck()
+    m = Model(u"Bench")
+    m.tags = u""
+    names = [u"Field %d" % n for n in range(FIELDS)]
+    for name in names:
+        m.addFieldModel(FieldModel(name, u"", False, False))
+    m.addCardModel(CardModel(u"Card", u"", u"<br>".join(
+        ["%%(%s)s" % n for n in names]), u"%%(%s)s" % names[0]))
+    deck.addModel(m)
+    cards = []
+    for n in range(POOL):
+        f = deck.newFact()
+        for name in names:
+            f[name] = u"%s of fact %d" % (name, n)
+        deck.addFact(f)
+        cards.append(f.cards[0])
+    return (deck, cards)
+
+def render(cards, count, cold):
+    t = time.time()
+    for n in xrange(count):
+        card = cards[n % POOL]
+        if cold:
+            card.fact._fieldKey = None
+        card.cardModel.renderQA(card, card.fact, "question")
+    return time.time() - t
+
+def oldUpdate(deck, cm):
+    return [{'q': cm.renderQASQL('q', fid), 'a': cm.renderQASQL('a', fid)}
+            for fid in deck.s.column0("select factId from cards")]
+
+def bulk(deck, cards):
+    deck.s.flush()
+    cm = cards[0].cardModel
+    for (name, fn) in (("sql", lambda: oldUpdate(deck, cm)),
+                       ("bulk", lambda: deck.updateCardsFromModel(cm))):
+        t = time.time()
+        fn()
+        taken = time.time() - t
+        print "%-10s %6.2fs  %5.1fus/card" % (name, taken,
+                                              taken * 1000000 / POOL)
+
+def run(name, cards, count, cold=False):
+    taken = render(cards, count, cold)
+    print "%-10s %6.2fs  %5.1fus/fact" % (name, taken,
+                                          taken * 1000000 / count)
+
+if __name__ == "__main__":
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+    (deck, cards) = setup()
+    print "%d renders of facts with %d fields" % (count, FIELDS)
+    (getItem, items) = (Fact.__getitem__, Fact.items)
+    Fact.__getitem__, Fact.items = oldGetItem, oldItems
+    run("old", cards, count)
+    Fact.__getitem__, Fact.items = getItem, items
+    run("new cold", cards, count, cold=True)
+    run("new warm", cards, count)
+    print "rerendering %d cards" % POOL
+    bulk(deck, cards)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+Sync encoding benchmark
+========================
+
+Sends changed cards from one deck to another, encoded as JSON lists (protocol
+2) and as packed columns (protocol 3), and reports the bytes on the wire and
+the time taken to encode, decode and apply them. The JSON rows are applied the
+old way, with a dict built for every row.
+
+    python tools/bench_sync.py [cards]
+"""
+
+import os, sys, time, random
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from anki import DeckStorage
+from anki.sync import SyncTools, PackedRows, packRows, unpackRows, cardTypes
+
+# The old apply
+##########################################################################
+
+cols = """id, factId, cardModelId, created, modified, tags, ordinal,
+priority, interval, lastInterval, due, lastDue, factor,
+firstAnswered, reps, successive, averageTime, reviewTime, youngEase0,
+youngEase1, youngEase2, youngEase3, youngEase4, matureEase0,
+matureEase1, matureEase2, matureEase3, matureEase4, yesCount, noCount,
+question, answer, lastFactor""".replace("\n", " ").split(", ")
+
+def oldUpdateCards(tools, cards):
+    dlist = [dict([(cols[n], c[n]) for n in range(33)]) for c in cards]
+    tools.deck.s.execute("insert or replace into cards (%s) values (%s)" % (
+        ", ".join(cols), ", ".join([":" + c for c in cols])), dlist)
+    tools.deck.updateTagIndex(cardIds=[c[0] for c in cards])
+    tools.deck.refreshQueueCards([c[0] for c in cards])
+
+# Runs
+##########################################################################
+
+def setup(count):
+    random.seed(0)
+    deck = DeckStorage.Deck()
+    now = time.time()
+    rows = []
+    for n in xrange(count):
+        reps = random.randint(0, 30)
+        rows.append(tuple(
+            [n + 1, n / 2 + 1, 1, now - n, now - random.uniform(0, 86400),
+             u"", n % 2, 2, random.uniform(0, 100), 0.0,
+             now + random.uniform(-86400, 86400 * 30), 0.0, 2.5, now - n,
+             reps, reps / 2, random.uniform(0, 10), random.uniform(0, 300)] +
+            [random.randint(0, 5) for i in range(12)] +
+            [u"question %d" % n, u"answer %d" % n, 2.5]))
+    deck.s.connection().execute(
+        "insert into cards (%s) values (%s)" % (
+        ", ".join(cols), ", ".join(["?"] * 33)), rows)
+    return deck
+
+def run(name, src, dst, binary, apply):
+    ids = src.s.column0("select id from cards")
+    sender = SyncTools(src)
+    receiver = SyncTools(dst)
+    sender.binary = binary
+    t = time.time()
+    data = sender.stuff(sender.getCards(ids))
+    encoded = time.time() - t
+    t = time.time()
+    cards = receiver.unstuff(data)
+    if isinstance(cards, PackedRows):
+        cards = unpackRows(cards.data)
+    decoded = time.time() - t
+    t = time.time()
+    apply(receiver, cards)
+    applied = time.time() - t
+    dst.s.rollback()
+    print "%-7s %9d bytes  encode %5.2fs  decode %5.2fs  apply %5.2fs" % (
+        name, len(data), encoded, decoded, applied)
+
+if __name__ == "__main__":
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+    src = setup(count)
+    dst = DeckStorage.Deck()
+    print "%d changed cards" % count
+    run("json", src, dst, False, oldUpdateCards)
+    run("packed", src, dst, True, SyncTools.updateCards)
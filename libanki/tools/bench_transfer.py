@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU GPL, version 3 or later; http://www.gnu.org/copyleft/gpl.html
+
+"""\
+Deck transfer benchmark
+========================
+
+Builds a deck with two cards per fact, then exports it to a new .anki file
+and imports that file into an empty deck, once through the sync code and once
+with insert ... select (anki.transfer).
+
+    python tools/bench_transfer.py [facts]
+"""
+
+import os, sys, time, tempfile, shutil
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from anki import DeckStorage
+from anki.stdmodels import BasicModel
+from anki.importing import csv
+from anki.importing.anki10 import Anki10Importer
+from anki.exporting import AnkiExporter
+
+def setup(dir, count):
+    deck = DeckStorage.Deck(os.path.join(dir, "source.anki"))
+    deck.addModel(BasicModel())
+    deck.currentModel.cardModels[1].active = True
+    path = os.path.join(dir, "source.txt")
+    f = open(path, "w")
+    for n in xrange(count):
+        f.write("front %d\tback %d\n" % (n, n))
+    f.close()
+    i = csv.TextImporter(deck, unicode(path))
+    i.batchSize = 5000
+    i.tagsToAdd = u"bench"
+    i.doImport()
+    deck.save()
+    return deck
+
+def run(name, dir, deck, bulkSQL):
+    path = os.path.join(dir, "%s.anki" % name)
+    e = AnkiExporter(deck)
+    e.bulkSQL = bulkSQL
+    t = time.time()
+    e.exportInto(path)
+    print "%-5s export %6.2fs" % (name, time.time() - t)
+    d = DeckStorage.Deck(os.path.join(dir, "%s-import.anki" % name))
+    i = Anki10Importer(d, path)
+    i.bulkSQL = bulkSQL
+    t = time.time()
+    i.doImport()
+    print "%-5s import %6.2fs (%d cards)" % (
+        name, time.time() - t, d.totalCardCount())
+    d.close()
+
+if __name__ == "__main__":
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 50000
+    dir = tempfile.mkdtemp()
+    try:
+        deck = setup(dir, count)
+        print "%d facts, %d cards" % (count, deck.totalCardCount())
+        run("sync", dir, deck, False)
+        run("sql", dir, deck, True)
+        deck.close()
+    finally:
+        shutil.rmtree(dir)